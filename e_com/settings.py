@@ -53,6 +53,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'my_site.middleware.StaticFilesMiddleware',
+    'my_site.middleware.MetricsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -65,7 +67,8 @@ ROOT_URLCONF = 'e_com.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        #the django backend with render times reported to my_site.middleware.MetricsMiddleware
+        'BACKEND': 'my_site.metrics.TimedDjangoTemplates',
         'DIRS': [
             BASE_DIR / 'templates'
         ],
@@ -99,6 +102,36 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+
+# the cart summaries, catalog version and rendition records are invalidated across workers through this cache,
+# so outside development CACHE_URL has to point at a shared one (redis, memcached), a per-process cache would
+# leave the other workers serving stale data
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://') if DEBUG else env.cache('CACHE_URL')
+}
+
+# how long the nav bar cart summary is kept before it is recomputed (seconds)
+CART_SUMMARY_TIMEOUT = 60 * 15
+
+# where open carts are kept, my_site.cart.CacheCartBackend keeps them in the cache and writes them to the
+# database on the way into checkout or when manage.py flush_carts runs, it needs a cache shared between
+# processes (CACHE_URL) and refuses to start on a per-process one
+CART_BACKEND = env('CART_BACKEND', default='my_site.cart.DatabaseCartBackend')
+
+# how long an untouched cart stays in the cache with the cache backend, run flush_carts more often than this
+CART_CACHE_TIMEOUT = 60 * 60 * 24
+
+# how long anonymous catalog pages are cached, edits retire them straight away via the catalog version
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# coupon lookups are cached in each process, a save clears the process it happens in and the others
+# pick the change up within the timeout (seconds)
+COUPON_CACHE_SIZE = 1024
+COUPON_CACHE_TIMEOUT = 60
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -142,9 +175,25 @@ STATICFILES_DIRS = [
     BASE_DIR / 'static'
 ]
 
+STATICFILES_STORAGE = 'my_site.staticfiles.CompressedManifestStaticFilesStorage'
+
+# left out of manage.py build_static, the templates only use the minified bootstrap bundle and stylesheet
+STATIC_BUILD_IGNORE = [
+    '*.map',
+    'css/bootstrap.css',
+    'css/bootstrap-grid*',
+    'css/bootstrap-reboot*',
+    'js/bootstrap.js',
+    'js/bootstrap.min.js',
+    'js/bootstrap.bundle.js',
+]
+
 MEDIA_ROOT = BASE_DIR / 'inventory_images'
 MEDIA_URL = '/inventory_images/'
 
+# processes that resize uploaded product images into renditions, 0 resizes in the request instead
+IMAGE_RENDITION_WORKERS = env.int('IMAGE_RENDITION_WORKERS', default=2)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -158,5 +207,18 @@ STRIPE_PUBLIC_KEY = 'pk_test_51JAyEpFoScc12fVdLxCGCfMpP1WQXKnWo06i353TInqa4D2PQv
 
 STRIPE_SECRET_KEY = env('STRIPE_SKEY')
 
+# Payment gateway, my_site.payments.FakeGateway with OPTIONS like {"latency": 0.3, "failure_rate": 0.05}
+# charges nothing and is meant for load testing checkout locally
+PAYMENT_GATEWAY = {
+    'BACKEND': env('PAYMENT_GATEWAY', default='my_site.payments.StripeGateway'),
+    'OPTIONS': env.json('PAYMENT_GATEWAY_OPTIONS', default={})
+}
+
+# send checkout to the async payment view, for deployments served through e_com/asgi.py
+ASYNC_PAYMENT_VIEW = env.bool('ASYNC_PAYMENT_VIEW', default=False)
+
+# bearer token prometheus sends when it scrapes /metrics, staff can always look at it
+METRICS_TOKEN = env('METRICS_TOKEN', default='')
+
 # Email Backend
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
@@ -1,20 +1,71 @@
 from django.contrib import admin
 
+from .pagination import EstimatedCountPaginator
+from .exports import ORDER_COLUMNS, PAYMENT_COLUMNS, REFUND_COLUMNS, order_rows, streaming_csv_response
 from .models import Artist, Product, Review, ShoppingCartOrderItem, ShoppingCartOrder, Payment, Coupon, Refund, Address
+from .refunds import PENDING, process_refunds
 
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'date_of_creation', 'price', 'artist')
+    list_display = ('name', 'date_of_creation', 'price', 'artist', 'rating_count', 'units_sold', 'units_sold_7d', 'units_sold_30d')
+    list_select_related = ('artist',)
+    search_fields = ['=slug', 'name']
+    autocomplete_fields = ['artist']
     prepopulated_fields = {'slug': ('shortened_name',)}
+    readonly_fields = ('rating_count', 'rating_sum', 'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5',
+                       'units_sold', 'revenue', 'units_sold_7d', 'units_sold_30d')
+
+
+def pay_out_refunds(ModelAdmin, request, refunds):
+    #accepts the pending refunds and sends them to the gateway, orders are only marked granted once the money has moved
+    refunds.filter(status=PENDING).update(accepted=True)
+    counts = process_refunds(refunds)
+    ModelAdmin.message_user(request, f"{counts['S']} refunded, {counts['P']} will be retried, {counts['F']} failed")
 
 
 def make_refund_accepted(ModelAdmin, request, queryset):
-    queryset.update(refund_requested=False, refund_granted=True)
+    pay_out_refunds(ModelAdmin, request, Refund.objects.filter(order__in=queryset))
+
+
+make_refund_accepted.short_description = 'Accept and pay out the refunds requested on these orders'
+
+
+def accept_and_refund(ModelAdmin, request, queryset):
+    pay_out_refunds(ModelAdmin, request, queryset)
+
+
+accept_and_refund.short_description = 'Accept and pay out the selected refunds'
+
+
+#the exports stream values() rows, so selecting every order on every page is fine
+
+def export_orders_csv(ModelAdmin, request, queryset):
+    return streaming_csv_response('orders', order_rows(queryset), ORDER_COLUMNS)
+
+
+export_orders_csv.short_description = 'Export selected orders with their items as CSV'
+
+
+def export_payments_csv(ModelAdmin, request, queryset):
+    return streaming_csv_response('payments', queryset.order_by('id'), PAYMENT_COLUMNS)
+
+
+export_payments_csv.short_description = 'Export selected payments as CSV'
+
+
+def export_refunds_csv(ModelAdmin, request, queryset):
+    return streaming_csv_response('refunds', queryset.order_by('id'), REFUND_COLUMNS)
+
 
+export_refunds_csv.short_description = 'Export selected refunds as CSV'
 
-make_refund_accepted.short_description = 'Update orders to refund granted'
 
+class LargeTableAdmin(admin.ModelAdmin):
+    #changelists over millions of rows: estimated page counts and no second COUNT(*) for the unfiltered total
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
-class ShoppingCartOrderAdmin(admin.ModelAdmin):
+
+class ShoppingCartOrderAdmin(LargeTableAdmin):
     list_display = (
         'user',
         'ordered', 
@@ -27,6 +78,14 @@ class ShoppingCartOrderAdmin(admin.ModelAdmin):
         'payment',
         'coupon'
     )
+    #the addresses and payments print their user's name
+    list_select_related = (
+        'user',
+        'billing_address__user',
+        'shipping_address__user',
+        'payment__user',
+        'coupon'
+    )
     list_display_links = (
         'user',
         'billing_address',
@@ -34,21 +93,32 @@ class ShoppingCartOrderAdmin(admin.ModelAdmin):
         'payment',
         'coupon'
     )
-    list_filter = ('user', 
+    #one entry per user doesn't scale, orders are found by searching for the username instead
+    list_filter = (
         'ordered', 
         'being_delivered', 
         'recieved', 
         'refund_requested', 
         'refund_granted'
     )
+    #exact matches so the username and ref_code indexes are used
     search_fields = [
-        'user__username',
-        'ref_code'
+        '=user__username',
+        '=ref_code'
     ]
-    actions = [make_refund_accepted]
+    autocomplete_fields = ['user', 'items', 'billing_address', 'shipping_address', 'payment', 'coupon']
+    actions = [make_refund_accepted, export_orders_csv]
 
 
-class AddressAdmin(admin.ModelAdmin):
+class ShoppingCartOrderItemAdmin(LargeTableAdmin):
+    list_display = ('user', 'item', 'quantity', 'ordered')
+    list_select_related = ('user', 'item')
+    list_filter = ('ordered',)
+    search_fields = ['=user__username', '=item__slug']
+    autocomplete_fields = ['user', 'item']
+
+
+class AddressAdmin(LargeTableAdmin):
     list_display = (
         'user',
         'street_address',
@@ -58,33 +128,70 @@ class AddressAdmin(admin.ModelAdmin):
         'address_type',
         'default'
     )
+    list_select_related = ('user',)
     list_filter = (
         'default',
         'address_type',
         'country'
     )
     search_fields = [
-        'user',
-        'street_address',
-        'apartment',
-        'zip'
+        '=user__username',
+        '=zip_code'
     ]
+    autocomplete_fields = ['user']
+
+class PaymentAdmin(LargeTableAdmin):
+    list_display = ('user', 'stripe_charge_id', 'amount', 'timestamp')
+    list_select_related = ('user',)
+    search_fields = ['=stripe_charge_id', '=user__username']
+    autocomplete_fields = ['user']
+    actions = [export_payments_csv]
+
+
+class RefundAdmin(admin.ModelAdmin):
+    list_display = ('order', 'email', 'accepted', 'status', 'attempts', 'gateway_refund_id', 'processed_at')
+    list_filter = ('status', 'accepted')
+    list_select_related = ('order__user',)
+    autocomplete_fields = ['order']
+    readonly_fields = ('status', 'attempts', 'claimed_at', 'processed_at', 'gateway_refund_id', 'error')
+    actions = [accept_and_refund, export_refunds_csv]
+
+
+class CouponAdmin(admin.ModelAdmin):
+    list_display = ('code', 'amount', 'active', 'valid_from', 'expires_at', 'used', 'max_uses')
+    search_fields = ['=code']
+    readonly_fields = ('used',)
+
+    def save_model(self, request, obj, form, change):
+        #used only moves through the conditional update at redemption, an edit mustn't write back the count it loaded
+        if change:
+            obj.save(update_fields=[field.name for field in obj._meta.concrete_fields if field.name not in ('id', 'used')])
+        else:
+            super().save_model(request, obj, form, change)
+
+
+class ArtistAdmin(admin.ModelAdmin):
+    search_fields = ['name']
+
 
-class ReviewAdmin(admin.ModelAdmin):
+class ReviewAdmin(LargeTableAdmin):
     list_display = (
         'user',
         'product',
         'comment',
-        'rating'
+        'rating',
+        'verified_purchase'
     )
+    list_select_related = ('user', 'product')
+    autocomplete_fields = ['user', 'product']
 
 
-admin.site.register(Artist)
+admin.site.register(Artist, ArtistAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(Review, ReviewAdmin)
-admin.site.register(ShoppingCartOrderItem)
+admin.site.register(ShoppingCartOrderItem, ShoppingCartOrderItemAdmin)
 admin.site.register(ShoppingCartOrder, ShoppingCartOrderAdmin)
-admin.site.register(Payment)
-admin.site.register(Coupon)
-admin.site.register(Refund)
+admin.site.register(Payment, PaymentAdmin)
+admin.site.register(Coupon, CouponAdmin)
+admin.site.register(Refund, RefundAdmin)
 admin.site.register(Address, AddressAdmin)
\ No newline at end of file
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class MySiteConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'my_site'
+
+    def ready(self):
+        from . import signals
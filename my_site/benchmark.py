@@ -0,0 +1,158 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Address, Artist, Coupon, Product, Review, ShoppingCartOrder, ShoppingCartOrderItem
+from .search import get_search_backend
+
+import math
+import statistics
+import time
+import tracemalloc
+from datetime import timedelta
+from io import StringIO
+
+
+SCHOOLS = ('France', 'Italy', 'Dutch', 'Spain', 'Flemish')
+SEARCH_WORDS = ('river', 'portrait', 'garden', 'harbour', 'saint', 'winter')
+BENCHMARK_USERNAME = 'benchmark'
+BENCHMARK_PASSWORD = 'benchmark-pass'
+
+
+def seed(products=500, users=50, orders=200):
+    #a storefront shaped dataset: artists, products spread over the schools, reviews and an order history
+    Artist.objects.bulk_create(Artist(name=f'Artist {i}') for i in range(max(products // 10, 1)))
+    #read back rather than trusting bulk_create, sqlite doesn't hand the primary keys back
+    artists = list(Artist.objects.order_by('id'))
+    Product.objects.bulk_create(
+        Product(
+            name=f'{SEARCH_WORDS[i % len(SEARCH_WORDS)]} study {i}',
+            shortened_name=f'study {i}',
+            slug=f'study-{i}',
+            history=f'A {SEARCH_WORDS[(i * 7) % len(SEARCH_WORDS)]} painted in the {SCHOOLS[i % len(SCHOOLS)]} manner',
+            price=10 + i % 90,
+            school=SCHOOLS[i % len(SCHOOLS)],
+            artist=artists[i % len(artists)],
+            image='images/benchmark.jpg',
+        )
+        for i in range(products)
+    )
+    product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+
+    shopper = User.objects.create_user(BENCHMARK_USERNAME, password=BENCHMARK_PASSWORD)
+    User.objects.bulk_create(User(username=f'benchmark-{i}') for i in range(users))
+    reviewers = list(User.objects.filter(username__startswith='benchmark-'))
+    if reviewers:
+        Review.objects.bulk_create(
+            Review(user=reviewers[i % len(reviewers)], product_id=product_ids[i % len(product_ids)],
+                   rating=1 + i % 5, comment='benchmark review text')
+            for i in range(products * 2)
+        )
+        #bulk_create skips the signals that keep the rating aggregates current
+        call_command('rebuild_ratings', stdout=StringIO())
+
+    Coupon.objects.create(code='BENCH', amount=5)
+    Address.objects.create(user=shopper, street_address='1 Main St', apartment='1', country='FR',
+                           zip_code='75001', address_type='S', default=True)
+
+    now = timezone.now()
+    for i in range(orders):
+        order = ShoppingCartOrder.objects.create(user=shopper, ref_code=f'bench{i:015d}',
+                                                 ordered_date=now - timedelta(hours=i), ordered=True)
+        lines = ShoppingCartOrderItem.objects.bulk_create(
+            ShoppingCartOrderItem(user=shopper, item_id=product_ids[(i + n) % len(product_ids)], ordered=True)
+            for n in range(3)
+        )
+        if not lines[0].pk:
+            lines = list(ShoppingCartOrderItem.objects.filter(user=shopper, ordered=True).order_by('-id')[:3])
+        order.items.add(*lines)
+
+    get_search_backend().update_products(Product.objects.all())
+    cache.clear()
+    return {'products': products, 'users': users, 'orders': orders}
+
+
+def scenarios():
+    #(name, url, query string), run in this order so the checkout pages have a cart
+    first = Product.objects.order_by('id').values_list('slug', flat=True).first()
+    deep_school = Product.objects.order_by('-id').values_list('school', flat=True).first()
+    return [
+        ('starting_page', reverse('starting_page'), {}),
+        ('all_products', reverse('all_products', kwargs={'school': 'all'}), {}),
+        ('all_products_school', reverse('all_products', kwargs={'school': deep_school}), {'sort': 'price'}),
+        ('product_detail', reverse('product', kwargs={'slug': first}), {}),
+        ('product_search', reverse('product_search'), {'q': 'river study'}),
+        ('add_to_cart', reverse('add_to_cart', kwargs={'slug': first}), {}),
+        ('order_summary', reverse('order_summary'), {}),
+        ('checkout', reverse('checkout'), {}),
+        ('remove_single_item_from_cart', reverse('remove_single_item_from_cart', kwargs={'slug': first}), {}),
+        ('my_orders', reverse('my_orders'), {}),
+    ]
+
+
+def percentile(samples, fraction):
+    #nearest rank, good enough for a few hundred samples and exact for small ones
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def run(iterations=50, warmup=5, clear_cache=False):
+    #drives every scenario through a logged in test client, anonymous catalog pages would just measure the page cache
+    client = Client()
+    client.login(username=BENCHMARK_USERNAME, password=BENCHMARK_PASSWORD)
+    results = {}
+    for name, url, params in scenarios():
+        for _ in range(warmup):
+            client.get(url, params)
+
+        timings = []
+        queries = []
+        for _ in range(iterations):
+            if clear_cache:
+                cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = client.get(url, params)
+                timings.append(time.perf_counter() - start)
+            queries.append(len(captured))
+
+        #allocations are measured on a separate pass, tracemalloc slows everything down too much to time with it on
+        tracemalloc.start()
+        try:
+            allocated = []
+            for _ in range(min(iterations, 10)):
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                client.get(url, params)
+                allocated.append(tracemalloc.get_traced_memory()[1] - before)
+        finally:
+            tracemalloc.stop()
+
+        results[name] = {
+            'status': response.status_code,
+            'p50_ms': round(percentile(timings, 0.5) * 1000, 3),
+            'p95_ms': round(percentile(timings, 0.95) * 1000, 3),
+            'mean_ms': round(statistics.mean(timings) * 1000, 3),
+            'queries': max(queries),
+            'peak_alloc_kib': round(statistics.median(allocated) / 1024, 1),
+        }
+    return results
+
+
+def compare(results, baseline, threshold=0.2):
+    #a scenario regresses when its p95 grows by more than threshold, or it makes more queries than it used to
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current['queries'] > previous['queries']:
+            regressions.append(f"{name}: queries {previous['queries']} -> {current['queries']}")
+    return regressions
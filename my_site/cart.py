@@ -0,0 +1,369 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, Prefetch
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .metrics import record_cache
+from .models import Product, ShoppingCartOrder, ShoppingCartOrderItem
+from .sales import line_revenue, quote
+
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+
+
+CART_SUMMARY_KEY = 'cart_summary:{}'
+#seconds a cart lock is held at most and how long a click waits between tries for it
+CART_LOCK_TIMEOUT = 5
+CART_LOCK_WAIT = 0.01
+
+#what a cart mutation did, the views turn these into messages
+ADDED = 'added'
+UPDATED = 'updated'
+REMOVED = 'removed'
+NOT_IN_CART = 'not_in_cart'
+
+
+def active_order_queryset():
+    #coupon is joined in, the items and their products come back in one extra query however long the cart is
+    return ShoppingCartOrder.objects.select_related('coupon').prefetch_related(
+        Prefetch('items', queryset=ShoppingCartOrderItem.objects.select_related('item').order_by('id'))
+    )
+
+
+def get_active_order(user):
+    return active_order_queryset().get(user=user, ordered=False)
+
+
+def cart_summary_key(user_id):
+    return CART_SUMMARY_KEY.format(user_id)
+
+
+def summarize(rows):
+    #rows of (quantity, price, discount_price), the discount is a float column so lines are priced like the sales counters price them
+    count = 0
+    subtotal = Decimal('0')
+    for quantity, price, discount_price in rows:
+        count += 1
+        subtotal += line_revenue(quantity, price, discount_price)
+    return {
+        'count': count,
+        'subtotal': subtotal
+    }
+
+
+def compute_cart_summary(user):
+    #one query over the open cart lines
+    rows = ShoppingCartOrderItem.objects.filter(
+        shoppingcartorder__user=user,
+        shoppingcartorder__ordered=False
+    ).values_list('quantity', 'item__price', 'item__discount_price')
+    return summarize(rows)
+
+
+def get_cart_summary(user):
+    #memoized on the user object so the summary is only looked up once per request
+    summary = getattr(user, '_cart_summary', None)
+    if summary is not None:
+        return summary
+
+    key = cart_summary_key(user.pk)
+    summary = cache.get(key)
+    record_cache(summary is not None)
+    if summary is None:
+        summary = get_cart_backend().compute_summary(user)
+        cache.set(key, summary, settings.CART_SUMMARY_TIMEOUT)
+    user._cart_summary = summary
+    return summary
+
+
+def invalidate_cart_summary(user):
+    cache.delete(cart_summary_key(user.pk))
+    if hasattr(user, '_cart_summary'):
+        del user._cart_summary
+
+
+#cart mutations, the partial unique constraints on open carts and open lines make these safe under concurrent clicks
+
+def open_lines(user, product):
+    return ShoppingCartOrderItem.objects.filter(user=user, item=product, ordered=False)
+
+
+def get_or_create_open_order(user):
+    order = ShoppingCartOrder.objects.filter(user=user, ordered=False).only('id').first()
+    if order is not None:
+        return order
+    try:
+        with transaction.atomic():
+            return ShoppingCartOrder.objects.create(user=user, ordered_date=timezone.now())
+    except IntegrityError:
+        #somebody else opened the cart first
+        return ShoppingCartOrder.objects.only('id').get(user=user, ordered=False)
+
+
+def delete_lines(lines):
+    #two statements: the guarded DELETE on the lines hands back the ids it removed, then their link rows go
+    #a concurrent add either waits for the delete or has already taken its line out of the match, so no open line loses its link
+    #the link rows' foreign key is only checked at commit, which lets them outlive their line between the two
+    where, params = lines.query.get_compiler(lines.db).compile(lines.query.where)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'DELETE FROM {quote(ShoppingCartOrderItem)} WHERE {where} RETURNING {quote(ShoppingCartOrderItem, "id")}',
+            params
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    if ids:
+        ShoppingCartOrder.items.through.objects.filter(shoppingcartorderitem_id__in=ids).delete()
+    return len(ids)
+
+
+def add_item(user, product):
+    lines = open_lines(user, product)
+    with transaction.atomic():
+        #the usual case, the product is already in the cart: a single UPDATE
+        if lines.update(quantity=F('quantity') + 1):
+            result = UPDATED
+        else:
+            order = get_or_create_open_order(user)
+            try:
+                with transaction.atomic():
+                    order_item = ShoppingCartOrderItem.objects.create(user=user, item=product)
+                order.items.add(order_item)
+                result = ADDED
+            except IntegrityError:
+                #a concurrent click created the line, count this click against it
+                lines.update(quantity=F('quantity') + 1)
+                result = UPDATED
+    invalidate_cart_summary(user)
+    return result
+
+
+def remove_item(user, product):
+    with transaction.atomic():
+        result = REMOVED if delete_lines(open_lines(user, product)) else NOT_IN_CART
+    invalidate_cart_summary(user)
+    return result
+
+
+def remove_single_item(user, product):
+    lines = open_lines(user, product)
+    with transaction.atomic():
+        #the last unit takes the whole line out, otherwise the quantity goes down by one
+        if delete_lines(lines.filter(quantity__lte=1)):
+            result = REMOVED
+        elif lines.update(quantity=F('quantity') - 1):
+            result = UPDATED
+        else:
+            result = NOT_IN_CART
+    invalidate_cart_summary(user)
+    return result
+
+
+#cart backends, the views and the cart_item_count filter only talk to whichever one CART_BACKEND names
+
+class DatabaseCartBackend:
+    #every click goes straight to ShoppingCartOrderItem, the default
+
+    def add_item(self, user, product):
+        return add_item(user, product)
+
+    def remove_item(self, user, product):
+        return remove_item(user, product)
+
+    def remove_single_item(self, user, product):
+        return remove_single_item(user, product)
+
+    def compute_summary(self, user):
+        return compute_cart_summary(user)
+
+    def get_active_order(self, user):
+        return get_active_order(user)
+
+    def flush(self, user):
+        pass
+
+    def clear(self, user):
+        pass
+
+
+@contextmanager
+def cache_lock(key, timeout=CART_LOCK_TIMEOUT):
+    #cache.add only succeeds for one caller, the timeout frees a lock whose holder died
+    while not cache.add(key, True, timeout):
+        time.sleep(CART_LOCK_WAIT)
+    try:
+        yield
+    finally:
+        cache.delete(key)
+
+
+class CacheCartBackend:
+    #open carts live in the cache as {product_id: quantity} and are written behind to the database,
+    #when the customer heads into checkout or when manage.py flush_carts runs
+    #a click reads and rewrites the cart under a per-user lock so concurrent clicks don't lose each other's updates
+    #dirty carts are flagged under a key of their own and indexed in DIRTY_BUCKETS sets, flush_all only reads the sets
+    DIRTY_BUCKETS = 64
+
+    def __init__(self):
+        #a per-process cache would give every worker carts of its own
+        if isinstance(caches['default'], (LocMemCache, DummyCache)):
+            raise ImproperlyConfigured('CacheCartBackend needs a cache shared between processes, set CACHE_URL')
+
+    def key(self, user_id):
+        return f'cart:{user_id}'
+
+    def lock_key(self, user_id):
+        return f'cart:lock:{user_id}'
+
+    def dirty_key(self, user_id):
+        return f'cart:dirty:{user_id}'
+
+    def bucket_key(self, bucket):
+        return f'cart:dirty_bucket:{bucket}'
+
+    def load(self, user):
+        lines = cache.get(self.key(user.pk))
+        if lines is None:
+            #nothing cached yet, start from whatever is already in the database
+            lines = dict(ShoppingCartOrderItem.objects.filter(
+                shoppingcartorder__user=user,
+                shoppingcartorder__ordered=False
+            ).values_list('item_id', 'quantity'))
+        return lines
+
+    def save(self, user, lines):
+        cache.set(self.key(user.pk), lines, settings.CART_CACHE_TIMEOUT)
+        self.mark_dirty(user)
+        invalidate_cart_summary(user)
+
+    def add_item(self, user, product):
+        with cache_lock(self.lock_key(user.pk)):
+            lines = self.load(user)
+            result = UPDATED if product.pk in lines else ADDED
+            lines[product.pk] = lines.get(product.pk, 0) + 1
+            self.save(user, lines)
+        return result
+
+    def remove_item(self, user, product):
+        with cache_lock(self.lock_key(user.pk)):
+            lines = self.load(user)
+            if lines.pop(product.pk, None) is None:
+                return NOT_IN_CART
+            self.save(user, lines)
+        return REMOVED
+
+    def remove_single_item(self, user, product):
+        with cache_lock(self.lock_key(user.pk)):
+            lines = self.load(user)
+            quantity = lines.get(product.pk)
+            if quantity is None:
+                return NOT_IN_CART
+            if quantity > 1:
+                lines[product.pk] = quantity - 1
+                result = UPDATED
+            else:
+                del lines[product.pk]
+                result = REMOVED
+            self.save(user, lines)
+        return result
+
+    def compute_summary(self, user):
+        lines = self.load(user)
+        prices = Product.objects.filter(pk__in=lines).values_list('id', 'price', 'discount_price')
+        return summarize((lines[product_id], price, discount_price) for product_id, price, discount_price in prices)
+
+    def get_active_order(self, user):
+        #the order pages work off the real ShoppingCartOrder, so the cart is persisted on the way into checkout
+        self.flush(user)
+        return get_active_order(user)
+
+    def flush(self, user):
+        #marked clean before the cart is read, a save made while this runs marks it dirty again
+        self.mark_clean(user)
+        lines = cache.get(self.key(user.pk))
+        if lines is None:
+            return
+        try:
+            self.write(user, lines)
+        except Exception:
+            self.mark_dirty(user)
+            raise
+
+    def write(self, user, lines):
+        with transaction.atomic():
+            existing = {
+                line.item_id: line
+                for line in ShoppingCartOrderItem.objects.filter(
+                    shoppingcartorder__user=user, shoppingcartorder__ordered=False)
+            }
+            changed = []
+            for product_id, line in existing.items():
+                if product_id in lines and line.quantity != lines[product_id]:
+                    line.quantity = lines[product_id]
+                    changed.append(line)
+            ShoppingCartOrderItem.objects.bulk_update(changed, ['quantity'])
+
+            removed = [line.pk for product_id, line in existing.items() if product_id not in lines]
+            if removed:
+                delete_lines(ShoppingCartOrderItem.objects.filter(pk__in=removed))
+
+            added = [product_id for product_id in lines if product_id not in existing]
+            if added:
+                order = get_or_create_open_order(user)
+                new_lines = [
+                    ShoppingCartOrderItem.objects.create(user=user, item_id=product_id, quantity=lines[product_id])
+                    for product_id in added
+                ]
+                order.items.add(*new_lines)
+
+    def flush_all(self):
+        #the periodic write-behind, returns how many carts were written
+        #each bucket is swapped for an empty one, a cart saved after that is indexed again for the next run
+        flushed = 0
+        for bucket in range(self.DIRTY_BUCKETS):
+            key = self.bucket_key(bucket)
+            with cache_lock(f'{key}:lock'):
+                user_ids = cache.get(key)
+                if user_ids:
+                    cache.set(key, set(), None)
+            if not user_ids:
+                continue
+            for user in get_user_model().objects.filter(pk__in=user_ids):
+                self.flush(user)
+                flushed += 1
+        return flushed
+
+    def mark_dirty(self, user):
+        #only the save that flags a clean cart touches the index, later saves stop at the cache.add
+        #the flag lives as long as the cart does, so a flag whose index entry was lost can't block reindexing for good
+        if cache.add(self.dirty_key(user.pk), True, settings.CART_CACHE_TIMEOUT):
+            key = self.bucket_key(user.pk % self.DIRTY_BUCKETS)
+            with cache_lock(f'{key}:lock'):
+                user_ids = cache.get(key, set())
+                user_ids.add(user.pk)
+                cache.set(key, user_ids, None)
+
+    def mark_clean(self, user):
+        #the index entry stays until flush_all swaps the bucket out, flushing a clean cart again is harmless
+        cache.delete(self.dirty_key(user.pk))
+
+    def clear(self, user):
+        #after checkout the cached cart has been paid for
+        cache.delete(self.key(user.pk))
+        self.mark_clean(user)
+
+
+_backends = {}
+
+
+def get_cart_backend():
+    backend = settings.CART_BACKEND
+    if backend not in _backends:
+        _backends[backend] = import_string(backend)()
+    return _backends[backend]
@@ -0,0 +1,186 @@
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .metrics import record_cache
+from .models import Product, ProductRecommendation
+
+import hashlib
+import threading
+
+
+PRODUCT_COUNTS_KEY = 'catalog:product_counts'
+CATALOG_VERSION_KEY = 'catalog:version'
+RECOMMENDATION_LIMIT = 4
+
+
+def get_product_counts():
+    #one GROUP BY for every school at once, dropped by the Product save/delete signals
+    counts = cache.get(PRODUCT_COUNTS_KEY)
+    if counts is None:
+        rows = Product.objects.values_list('school').annotate(n=Count('id')).order_by()
+        counts = dict(rows)
+        counts['all'] = sum(counts.values())
+        cache.set(PRODUCT_COUNTS_KEY, counts, None)
+    return counts
+
+
+def get_product_count(school):
+    return get_product_counts().get(school, 0)
+
+
+def invalidate_product_counts():
+    cache.delete(PRODUCT_COUNTS_KEY)
+
+
+def get_catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, 1, None)
+        version = cache.get(CATALOG_VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    #every cached page key contains the version, so one increment retires all of them at once
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        cache.add(CATALOG_VERSION_KEY, 2, None)
+
+
+def get_recommendations(product, limit=RECOMMENDATION_LIMIT):
+    #precomputed by manage.py build_recommendations, one indexed read cached until the catalog version moves on
+    key = f'catalog:recommendations:{get_catalog_version()}:{product.pk}:{limit}'
+    products = cache.get(key)
+    record_cache(products is not None)
+    if products is None:
+        rows = ProductRecommendation.objects.filter(product=product).select_related('recommended').order_by('rank')
+        products = [row.recommended for row in rows[:limit]]
+        cache.set(key, products, settings.CATALOG_CACHE_TIMEOUT)
+    return products
+
+
+class CacheStats:
+    #per-process hit/miss counters, cheap enough to bump on every request
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def hit(self):
+        record_cache(True)
+        with self.lock:
+            self.hits += 1
+
+    def miss(self):
+        record_cache(False)
+        with self.lock:
+            self.misses += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+catalog_cache_stats = CacheStats()
+
+
+def catalog_page_key(request):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'catalog:page:{get_catalog_version()}:{path}'
+
+
+def catalog_validators_key(request):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'catalog:validators:{get_catalog_version()}:{path}'
+
+
+def is_cacheable_request(request):
+    #only anonymous GETs render the same html for everybody, and a queued message is somebody's own
+    return (
+        request.method in ('GET', 'HEAD')
+        and not request.user.is_authenticated
+        and not len(get_messages(request))
+    )
+
+
+def is_cacheable_response(request, response):
+    return (
+        response.status_code == 200
+        and not response.cookies
+        and not request.META.get('CSRF_COOKIE_USED')
+    )
+
+
+class CatalogCacheMixin:
+    def dispatch(self, request, *args, **kwargs):
+        if not is_cacheable_request(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        key = catalog_page_key(request)
+        response = cache.get(key)
+        if response is not None:
+            catalog_cache_stats.hit()
+            return response
+
+        catalog_cache_stats.miss()
+        response = super().dispatch(request, *args, **kwargs)
+
+        def store(response):
+            if is_cacheable_response(request, response):
+                cache.set(key, response, settings.CATALOG_CACHE_TIMEOUT)
+
+        if hasattr(response, 'add_post_render_callback'):
+            response.add_post_render_callback(store)
+        else:
+            store(response)
+        return response
+
+
+def catalog_validators(timestamps, *extra):
+    #(etag, last modified) from the newest updated_at among the rows a page is built from
+    #counts go into the etag as well so a deleted row changes it even when nothing newer was saved
+    timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+    if not timestamps:
+        return None, None
+    last_modified = max(timestamps)
+    fingerprint = ':'.join(str(value) for value in (*timestamps, *extra))
+    return f'"{hashlib.md5(fingerprint.encode()).hexdigest()}"', last_modified
+
+
+class ConditionalCatalogMixin:
+    #answers revalidations with a 304 from one aggregate query, before the page cache or any template is touched
+    #views provide get_validators() returning (etag, last_modified)
+
+    def get_validators(self):
+        raise NotImplementedError
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_cacheable_request(request):
+            return super().dispatch(request, *args, **kwargs)
+
+        #kept next to the cached page under the same catalog version, so a page cache hit stays query free
+        key = catalog_validators_key(request)
+        validators = cache.get(key)
+        if validators is None:
+            etag, last_modified = self.get_validators()
+            validators = (etag, int(last_modified.timestamp()) if last_modified else None)
+            cache.set(key, validators, settings.CATALOG_CACHE_TIMEOUT)
+        etag, timestamp = validators
+        if etag is None:
+            return super().dispatch(request, *args, **kwargs)
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().dispatch(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(timestamp)
+        return response
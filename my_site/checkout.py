@@ -0,0 +1,63 @@
+from django.db import IntegrityError, transaction
+
+from .cart import get_cart_backend, invalidate_cart_summary
+from .coupons import redeem_order_coupon
+from .models import Payment, ShoppingCartOrder, ShoppingCartOrderItem
+from .purchases import record_purchases
+from .sales import record_sales
+
+import random
+import string
+import uuid
+
+
+def create_ref_code():
+    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
+
+
+def create_idempotency_key():
+    return uuid.uuid4().hex
+
+
+def find_finalized_payment(idempotency_key):
+    return Payment.objects.filter(idempotency_key=idempotency_key).first()
+
+
+class OrderAlreadyFinalized(Exception):
+    #raised inside the checkout transaction to roll it back, the order was paid for through another payment form
+    pass
+
+
+def finalize_order(order, user, charge_id, amount, idempotency_key):
+    #records the payment, closes the order, indexes what was bought and counts the sales in a fixed number of statements however many lines the cart has
+    #returns (payment, created), created is False when the order had already been paid for:
+    #a second submit of the same payment form trips the unique idempotency key and gets the first payment back
+    #a second payment form for the same cart finds the order already closed and gets the order's payment back,
+    #its own charge is recorded nowhere and is the caller's to refund
+    #the coupon's use is taken here, CouponError comes out with everything rolled back when it has been used up
+    try:
+        with transaction.atomic():
+            payment = Payment.objects.create(
+                stripe_charge_id=charge_id,
+                user=user,
+                amount=amount,
+                idempotency_key=idempotency_key
+            )
+            closed = ShoppingCartOrder.objects.filter(pk=order.pk, ordered=False).update(
+                ordered=True,
+                payment=payment,
+                ref_code=create_ref_code()
+            )
+            if not closed:
+                raise OrderAlreadyFinalized
+            redeem_order_coupon(order)
+            ShoppingCartOrderItem.objects.filter(shoppingcartorder=order, ordered=False).update(ordered=True)
+            record_purchases(order, user)
+            record_sales(order)
+    except IntegrityError:
+        return find_finalized_payment(idempotency_key), False
+    except OrderAlreadyFinalized:
+        return Payment.objects.filter(shoppingcartorder=order).first(), False
+    get_cart_backend().clear(user)
+    invalidate_cart_summary(user)
+    return payment, True
@@ -0,0 +1,113 @@
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .metrics import record_cache
+from .models import Coupon, ShoppingCartOrder
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class CouponError(Exception):
+    #message is what the customer gets to see
+    message = 'This coupon can not be used'
+
+    def __init__(self, message=None):
+        if message:
+            self.message = message
+        super().__init__(self.message)
+
+
+class CouponCache:
+    #code -> (expires, coupon or None) for this process, least recently used first
+    #unknown codes are kept too, so a campaign's typos don't reach the database either
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, code):
+        #(found, coupon), found is False when the code isn't cached or its entry has expired
+        with self.lock:
+            entry = self.entries.get(code)
+            if entry is None:
+                return False, None
+            expires, coupon = entry
+            if expires <= time.monotonic():
+                del self.entries[code]
+                return False, None
+            self.entries.move_to_end(code)
+            return True, coupon
+
+    def set(self, code, coupon):
+        with self.lock:
+            self.entries[code] = (time.monotonic() + self.timeout, coupon)
+            self.entries.move_to_end(code)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+coupon_cache = CouponCache(settings.COUPON_CACHE_SIZE, settings.COUPON_CACHE_TIMEOUT)
+
+
+def get_coupon(code):
+    #the cached coupon's used count goes stale, the limit is only ever checked by redeem_coupon
+    found, coupon = coupon_cache.get(code)
+    record_cache(found)
+    if not found:
+        coupon = Coupon.objects.filter(code=code).order_by('id').first()
+        coupon_cache.set(code, coupon)
+    return coupon
+
+
+def redeem_coupon(coupon, now=None):
+    #one conditional UPDATE, the database hands out the last uses so concurrent redemptions can't go over max_uses
+    now = now or timezone.now()
+    available = (
+        (Q(max_uses__isnull=True) | Q(used__lt=F('max_uses')))
+        & (Q(valid_from__isnull=True) | Q(valid_from__lte=now))
+        & (Q(expires_at__isnull=True) | Q(expires_at__gt=now))
+    )
+    return Coupon.objects.filter(available, pk=coupon.pk, active=True).update(used=F('used') + 1) == 1
+
+
+def used_up(coupon):
+    #a read without locks to turn customers away early, the limit itself is only enforced by redeem_coupon
+    return coupon.max_uses is not None and Coupon.objects.filter(pk=coupon.pk, used__gte=F('max_uses')).exists()
+
+
+def apply_coupon(order, code):
+    #the coupon only goes onto the cart here, its use is taken when the order is paid for so abandoned carts hold none
+    coupon = get_coupon(code)
+    if coupon is None:
+        raise CouponError('This coupon does not exist')
+    if not coupon.is_valid(timezone.now()):
+        raise CouponError('This coupon is not valid anymore')
+    if used_up(coupon):
+        raise CouponError('This coupon has been used up')
+
+    open_order = ShoppingCartOrder.objects.filter(pk=order.pk, ordered=False)
+    if not open_order.exclude(coupon=coupon).update(coupon=coupon):
+        if open_order.exists():
+            raise CouponError('This coupon is already on your order')
+        raise ShoppingCartOrder.DoesNotExist
+    order.coupon = coupon
+    return coupon
+
+
+def redeem_order_coupon(order, now=None):
+    #runs inside the checkout transaction, a coupon used up by the time the order is paid for rolls the checkout back
+    if order.coupon_id and not redeem_coupon(order.coupon, now):
+        raise CouponError('This coupon has been used up')
+
+
+def drop_coupon(order):
+    ShoppingCartOrder.objects.filter(pk=order.pk, ordered=False, coupon_id=order.coupon_id).update(coupon=None)
+    order.coupon = None
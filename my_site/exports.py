@@ -0,0 +1,83 @@
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Payment, Refund, ShoppingCartOrder
+
+import csv
+
+
+CHUNK_SIZE = 2000
+
+#(csv header, values() lookup) for each export, orders come out one row per cart line
+ORDER_COLUMNS = (
+    ('order_id', 'id'),
+    ('ref_code', 'ref_code'),
+    ('user', 'user__username'),
+    ('ordered', 'ordered'),
+    ('ordered_date', 'ordered_date'),
+    ('product', 'items__item__name'),
+    ('quantity', 'items__quantity'),
+    ('price', 'items__item__price'),
+    ('discount_price', 'items__item__discount_price'),
+    ('payment_charge_id', 'payment__stripe_charge_id'),
+    ('payment_amount', 'payment__amount'),
+    ('coupon', 'coupon__code'),
+    ('coupon_amount', 'coupon__amount'),
+    ('being_delivered', 'being_delivered'),
+    ('recieved', 'recieved'),
+    ('refund_requested', 'refund_requested'),
+    ('refund_granted', 'refund_granted'),
+)
+
+PAYMENT_COLUMNS = (
+    ('payment_id', 'id'),
+    ('charge_id', 'stripe_charge_id'),
+    ('user', 'user__username'),
+    ('amount', 'amount'),
+    ('timestamp', 'timestamp'),
+    ('idempotency_key', 'idempotency_key'),
+)
+
+REFUND_COLUMNS = (
+    ('refund_id', 'id'),
+    ('order_id', 'order_id'),
+    ('ref_code', 'order__ref_code'),
+    ('email', 'email'),
+    ('reason', 'reason'),
+    ('accepted', 'accepted'),
+    ('refund_granted', 'order__refund_granted'),
+)
+
+
+class Echo:
+    #csv.writer wants a file, this one hands each line straight back so it can be yielded
+    def write(self, value):
+        return value
+
+
+def csv_lines(queryset, columns, chunk_size=CHUNK_SIZE):
+    #values() rows straight off a (server side, on postgres) cursor, no model instances and nothing held on to
+    writer = csv.writer(Echo())
+    yield writer.writerow([header for header, lookup in columns])
+    rows = queryset.values_list(*[lookup for header, lookup in columns])
+    for row in rows.iterator(chunk_size=chunk_size):
+        yield writer.writerow(row)
+
+
+def order_rows(queryset):
+    #the left join through items keeps orders without lines, ordering by id keeps an order's lines together
+    return queryset.order_by('id', 'items__id')
+
+
+EXPORTS = {
+    'orders': (lambda: order_rows(ShoppingCartOrder.objects.all()), ORDER_COLUMNS),
+    'payments': (lambda: Payment.objects.order_by('id'), PAYMENT_COLUMNS),
+    'refunds': (lambda: Refund.objects.order_by('id'), REFUND_COLUMNS),
+}
+
+
+def streaming_csv_response(name, queryset, columns):
+    filename = f"{name}-{timezone.now().strftime('%Y%m%d-%H%M%S')}.csv"
+    response = StreamingHttpResponse(csv_lines(queryset, columns), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
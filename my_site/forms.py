@@ -4,7 +4,8 @@ from django.contrib.auth.models import User
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
 
-from .models import Review, ShoppingCartOrderItem, Product
+from .models import Review
+from .purchases import reviewable_products
 
 PAYMENT_CHOICES = (
     ('S', 'Stripe'),
@@ -114,13 +115,12 @@ class ReviewForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         user = kwargs.pop('user')
         super(ReviewForm, self).__init__(*args, **kwargs)
-        ordered_product_ids = ShoppingCartOrderItem.objects.filter(user=user, ordered=True).values_list('item_id', flat=True)
-
-        self.fields['product'].queryset = Product.objects.filter(id__in=ordered_product_ids)
+        #only products the user has bought and not reviewed yet, read from the purchase index
+        self.fields['product'].queryset = reviewable_products(user)
 
     class Meta:
         model = Review
-        exclude = ['user', 'date']
+        exclude = ['user', 'date', 'verified_purchase']
         widgets = {
             'product': forms.Select(attrs={
                 'class': 'form-control'
@@ -0,0 +1,109 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.cache import cache
+
+from PIL import Image
+
+import hashlib
+import os
+import threading
+
+
+#the product cards are at most about 350px wide, the detail page goes up to 1024
+RENDITION_WIDTHS = (320, 640, 1024)
+RENDITION_FORMATS = (
+    ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    ('webp', 'WEBP', {'quality': 80, 'method': 6}),
+)
+RENDITION_DIR = 'renditions'
+RENDITIONS_KEY = 'renditions:{}'
+#an upload without renditions is looked at again after this many seconds, a build may be under way in another process
+MISSING_RENDITIONS_TIMEOUT = 60
+
+
+def rendition_name(name, width, extension):
+    #images/starry_night.jpg -> renditions/images/starry_night-320w.webp
+    stem = os.path.splitext(name)[0]
+    return f'{RENDITION_DIR}/{stem}-{width}w.{extension}'
+
+
+def build_renditions(media_root, name, force=False):
+    #runs in a worker process, so it only deals in paths and returns the renditions it wrote
+    source = os.path.join(media_root, name)
+    written = []
+    try:
+        source_mtime = os.path.getmtime(source)
+        with Image.open(source) as original:
+            original.load()
+            if original.mode not in ('RGB', 'L'):
+                original = original.convert('RGB')
+            for width in RENDITION_WIDTHS:
+                #never upscale, the browser can do that for free
+                if width > original.width:
+                    continue
+                height = round(original.height * width / original.width)
+                resized = None
+                for extension, image_format, options in RENDITION_FORMATS:
+                    target = os.path.join(media_root, rendition_name(name, width, extension))
+                    if not force and os.path.exists(target) and os.path.getmtime(target) >= source_mtime:
+                        continue
+                    if resized is None:
+                        resized = original.resize((width, height), Image.LANCZOS)
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    resized.save(target, image_format, **options)
+                    written.append(rendition_name(name, width, extension))
+    except (OSError, ValueError):
+        #a missing or unreadable upload keeps being served as it is
+        return written
+    return written
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=settings.IMAGE_RENDITION_WORKERS)
+        return _pool
+
+
+def renditions_key(name):
+    return RENDITIONS_KEY.format(hashlib.md5(name.encode()).hexdigest())
+
+
+def record_renditions(name):
+    #[(extension, width), ...] on disk for an upload, looked up once a build instead of on every render
+    #runs in this process rather than the worker's, so the record lands in the cache the templates read
+    found = [
+        (extension, width)
+        for extension, image_format, options in RENDITION_FORMATS
+        for width in RENDITION_WIDTHS
+        if os.path.exists(os.path.join(settings.MEDIA_ROOT, rendition_name(name, width, extension)))
+    ]
+    cache.set(renditions_key(name), found, None if found else MISSING_RENDITIONS_TIMEOUT)
+    return found
+
+
+def schedule_renditions(name):
+    #the resizing happens in another process so saving a product in the admin doesn't wait for it
+    if not settings.IMAGE_RENDITION_WORKERS:
+        written = build_renditions(str(settings.MEDIA_ROOT), name)
+        record_renditions(name)
+        return written
+    job = get_pool().submit(build_renditions, str(settings.MEDIA_ROOT), name)
+    job.add_done_callback(lambda job: record_renditions(name))
+    return job
+
+
+def available_renditions(name):
+    #{extension: [(width, url), ...]} from the record the last build left, the disk is only checked when there is none
+    found = cache.get(renditions_key(name))
+    if found is None:
+        found = record_renditions(name)
+    renditions = {}
+    for extension, width in found:
+        renditions.setdefault(extension, []).append((width, settings.MEDIA_URL + rendition_name(name, width, extension)))
+    return renditions
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from my_site import benchmark
+
+import json
+import platform
+
+
+class Command(BaseCommand):
+    help = 'Seed a throwaway test database and time the storefront views, optionally against a saved baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=500)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--orders', type=int, default=200)
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--clear-cache', action='store_true', help='Empty the cache before every timed request')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--compare', help='Baseline JSON file written by an earlier --output')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='How much slower p95 may get before it counts as a regression, 0.2 is 20%%')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['results']
+
+        #the same isolation the test runner uses, nothing is written to the real database
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            dataset = benchmark.seed(options['products'], options['users'], options['orders'])
+            results = benchmark.run(options['iterations'], options['warmup'], options['clear_cache'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        report = {
+            'meta': {
+                'dataset': dataset,
+                'iterations': options['iterations'],
+                'database': connection.vendor,
+                'python': platform.python_version(),
+                'debug': settings.DEBUG,
+            },
+            'results': results,
+        }
+
+        self.stdout.write(f"{'scenario':<30} {'p50 ms':>9} {'p95 ms':>9} {'queries':>8} {'alloc KiB':>10}")
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<30} {result['p50_ms']:>9} {result['p95_ms']:>9} {result['queries']:>8} {result['peak_alloc_kib']:>10}")
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+
+        if baseline is not None:
+            regressions = benchmark.compare(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError('Regressions against the baseline:\n' + '\n'.join(regressions))
+            self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
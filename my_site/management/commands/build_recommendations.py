@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from my_site.catalog import bump_catalog_version
+from my_site.recommendations import METRICS, build_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Score co-purchased products from the finished orders and store the top ones for each product'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--metric', choices=METRICS, default='cosine')
+        parser.add_argument('--top-k', type=int, default=10)
+        parser.add_argument('--min-support', type=int, default=2,
+                            help='Orders two products need to share before they are recommended together')
+        parser.add_argument('--chunk-size', type=int, default=100000, help='Order lines read per chunk')
+
+    def handle(self, *args, **options):
+        written, baskets = build_recommendations(options['metric'], options['top_k'], options['min_support'],
+                                                 options['chunk_size'])
+        #cached product pages and recommendation lists are keyed on the catalog version
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'{written} recommendations written from {baskets} orders'))
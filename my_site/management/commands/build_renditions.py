@@ -0,0 +1,29 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from my_site.images import build_renditions, record_renditions
+from my_site.models import Product
+
+import os
+
+
+class Command(BaseCommand):
+    help = 'Generate the thumbnail and WebP renditions for every product image that is missing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+        parser.add_argument('--force', action='store_true', help='Rebuild renditions that are already up to date')
+
+    def handle(self, *args, **options):
+        names = Product.objects.exclude(image='').exclude(image__isnull=True).values_list(
+            'image', flat=True).distinct().order_by()
+        media_root = str(settings.MEDIA_ROOT)
+        written = 0
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            jobs = [(name, pool.submit(build_renditions, media_root, name, options['force'])) for name in names.iterator()]
+            for name, job in jobs:
+                written += len(job.result())
+                record_renditions(name)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} renditions for {len(jobs)} images'))
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from my_site import staticfiles
+
+
+class Command(BaseCommand):
+    help = 'collectstatic for production: hashed names, .gz/.br siblings, no source maps or unused bundles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-clear', action='store_false', dest='clear',
+                            help='Keep files from earlier builds in STATIC_ROOT')
+
+    def handle(self, *args, **options):
+        #collectstatic on its own gets by with gzip only, a production build without the .br files is a mistake
+        if staticfiles.brotli is None:
+            raise CommandError('brotli is not installed, install requirements.txt before building the static files')
+        #the compression itself happens in CompressedManifestStaticFilesStorage.post_process
+        call_command(
+            'collectstatic',
+            interactive=False,
+            clear=options['clear'],
+            ignore_patterns=list(settings.STATIC_BUILD_IGNORE),
+            verbosity=options['verbosity'],
+            stdout=self.stdout,
+        )
@@ -0,0 +1,89 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from my_site.models import Address, Coupon, Product, ShoppingCartOrder, ShoppingCartOrderItem
+
+import re
+
+
+def hot_queries():
+    #the lookups every page view or checkout step makes, the values only need to be of the right type
+    return {
+        'open cart': ShoppingCartOrder.objects.filter(user_id=1, ordered=False),
+        'open cart line': ShoppingCartOrderItem.objects.filter(user_id=1, item_id=1, ordered=False),
+        'default address': Address.objects.filter(user_id=1, address_type='S', default=True),
+        'order history': ShoppingCartOrder.objects.filter(user_id=1, ordered=True).order_by('-ordered_date', '-id'),
+        'refund lookup': ShoppingCartOrder.objects.filter(ref_code='abcdefghij0123456789'),
+        'coupon': Coupon.objects.filter(code='SPRING'),
+        'school listing': Product.objects.filter(school='France').order_by('id'),
+        'product page': Product.objects.filter(slug='water-lilies'),
+        'best sellers': Product.objects.order_by('-units_sold', 'id'),
+        'trending': Product.objects.order_by('-units_sold_7d', 'id'),
+    }
+
+
+def is_sequential_scan(plan):
+    if connection.vendor == 'postgresql':
+        return 'Seq Scan' in plan
+    #sqlite says SEARCH when it uses an index and a bare SCAN <table> when it reads the whole table
+    return re.search(r'\bSCAN (?!.*\bUSING\b)', plan) is not None
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot lookups and fail if any of them falls back to a sequential scan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=1000,
+                            help='Rows to add to each table before explaining, they are rolled back afterwards')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['seed']:
+                self.seed(options['seed'])
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('ANALYZE')
+                    #makes a missing index show up even on tables small enough that a seq scan would be cheaper
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+            failures = []
+            for name, queryset in hot_queries().items():
+                plan = queryset.explain()
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{name}:\n{plan}\n')
+                if is_sequential_scan(plan):
+                    failures.append(f'{name}: {plan}')
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError('Sequential scans on hot paths:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS(f'{len(hot_queries())} hot queries use an index'))
+
+    def seed(self, rows):
+        now = timezone.now()
+        users = User.objects.bulk_create(User(username=f'plan-check-{i}') for i in range(rows))
+        products = Product.objects.bulk_create(
+            Product(name=f'plan check {i}', shortened_name=f'plan check {i}', slug=f'plan-check-{i}',
+                    history='', price=10, school=('France', 'Italy', 'Dutch')[i % 3])
+            for i in range(rows)
+        )
+        if not users[0].pk:
+            #backends without RETURNING leave the primary keys unset
+            users = list(User.objects.filter(username__startswith='plan-check-'))
+            products = list(Product.objects.filter(slug__startswith='plan-check-'))
+        Coupon.objects.bulk_create(Coupon(code=f'PLAN{i}', amount=5) for i in range(rows))
+        Address.objects.bulk_create(
+            Address(user=user, street_address='', apartment='', country='FR', zip_code='',
+                    address_type=('B', 'S')[i % 2], default=i % 4 < 2)
+            for i, user in enumerate(users)
+        )
+        ShoppingCartOrder.objects.bulk_create(
+            ShoppingCartOrder(user=user, ref_code=f'plan{i:016d}', ordered_date=now, ordered=True)
+            for i, user in enumerate(users)
+        )
+        ShoppingCartOrderItem.objects.bulk_create(
+            ShoppingCartOrderItem(user=user, item=product, ordered=True)
+            for user, product in zip(users, products)
+        )
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from my_site.exports import CHUNK_SIZE, EXPORTS, csv_lines
+
+
+class Command(BaseCommand):
+    help = 'Stream orders (one row per cart line), payments or refunds as CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', choices=sorted(EXPORTS))
+        parser.add_argument('--output', help='Write to this file instead of standard output')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        queryset, columns = EXPORTS[options['export']]
+        lines = csv_lines(queryset(), columns, options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from my_site.cart import get_cart_backend
+
+
+class Command(BaseCommand):
+    help = 'Write the carts held by the cache cart backend to the database, meant to run from cron'
+
+    def handle(self, *args, **options):
+        backend = get_cart_backend()
+        if not hasattr(backend, 'flush_all'):
+            self.stdout.write('The cart backend keeps carts in the database already, nothing to flush')
+            return
+        flushed = backend.flush_all()
+        self.stdout.write(self.style.SUCCESS(f'Flushed {flushed} carts'))
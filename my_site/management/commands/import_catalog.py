@@ -0,0 +1,185 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from my_site.catalog import bump_catalog_version, invalidate_product_counts
+from my_site.models import Artist, Product
+from my_site.search import get_search_backend
+
+import csv
+import io
+import json
+import sys
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+
+REQUIRED_FIELDS = ('name', 'shortened_name', 'history', 'price', 'school')
+#everything an import may set, updates add updated_at themselves since they skip auto_now
+PRODUCT_FIELDS = ('name', 'shortened_name', 'date_of_creation', 'history', 'price', 'discount_price',
+                  'school', 'artist_id', 'image', 'slug')
+
+
+def read_rows(stream, file_format):
+    if file_format == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield None
+
+
+def text(row, field):
+    #JSON lines can carry numbers where CSV always has strings
+    value = row.get(field)
+    return '' if value is None else str(value).strip()
+
+
+def clean_row(row):
+    #returns the product fields for one input row, raises ValueError when it can't be imported
+    if not isinstance(row, dict):
+        raise ValueError('not a JSON object')
+    missing = [field for field in REQUIRED_FIELDS if not text(row, field)]
+    if missing:
+        raise ValueError(f"missing {', '.join(missing)}")
+    try:
+        price = Decimal(text(row, 'price'))
+        discount_price = float(text(row, 'discount_price')) if text(row, 'discount_price') else None
+    except (InvalidOperation, ValueError):
+        raise ValueError('price and discount_price have to be numbers')
+
+    return {
+        'name': text(row, 'name'),
+        'shortened_name': text(row, 'shortened_name'),
+        'date_of_creation': text(row, 'date_of_creation') or None,
+        'history': text(row, 'history'),
+        'price': price,
+        'discount_price': discount_price,
+        'school': text(row, 'school'),
+        'artist': text(row, 'artist'),
+        #an empty name, the same as a product saved without an image
+        'image': text(row, 'image'),
+        #what Product.save() would have set, bulk_create and bulk_update don't call it
+        'slug': slugify(text(row, 'shortened_name')),
+    }
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Command(BaseCommand):
+    help = 'Stream a CSV or JSON lines catalog into Product, upserting on the slug in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or .jsonl file, - reads standard input")
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        #artist name -> id, far fewer artists than artworks so this stays small
+        self.artists = {}
+        self.created = self.updated = self.unchanged = self.skipped = 0
+
+        if path == '-':
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline='')
+            self.load(stream, file_format, options['batch_size'])
+        else:
+            try:
+                with open(path, encoding='utf-8', newline='') as stream:
+                    self.load(stream, file_format, options['batch_size'])
+            except FileNotFoundError:
+                raise CommandError(f'{path} does not exist')
+
+        #the bulk queries skip the Product signals, so the shared caches are dropped once at the end
+        invalidate_product_counts()
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'{self.created} products created, {self.updated} updated, {self.unchanged} unchanged, {self.skipped} rows skipped'))
+        self.stdout.write('Run manage.py build_renditions to generate the image renditions for new images')
+
+    def load(self, stream, file_format, batch_size):
+        rows = enumerate(read_rows(stream, file_format), start=1)
+        for batch in batches(rows, batch_size):
+            products = {}
+            for line, row in batch:
+                try:
+                    product = clean_row(row)
+                except ValueError as e:
+                    self.skipped += 1
+                    self.stderr.write(f'row {line}: {e}')
+                    continue
+                #the last row for a slug wins, like it would on a second import
+                products[product['slug']] = product
+            if products:
+                with transaction.atomic():
+                    self.save_batch(list(products.values()))
+
+    def resolve_artists(self, names):
+        missing = {name for name in names if name and name not in self.artists}
+        if not missing:
+            return
+        existing = Artist.objects.filter(name__in=missing).values_list('name', 'id')
+        self.artists.update(existing)
+        new = [Artist(name=name) for name in missing if name not in self.artists]
+        if new:
+            Artist.objects.bulk_create(new)
+            #read back, sqlite doesn't return primary keys from bulk_create
+            self.artists.update(Artist.objects.filter(name__in=[artist.name for artist in new]).values_list('name', 'id'))
+
+    def save_batch(self, rows):
+        self.resolve_artists(row['artist'] for row in rows)
+        for row in rows:
+            row['artist_id'] = self.artists.get(row['artist'])
+
+        existing = {}
+        current = Product.objects.filter(slug__in=[row['slug'] for row in rows]).order_by('-id').values(
+            'id', *PRODUCT_FIELDS)
+        for product in current:
+            #when a slug is already shared by several rows the oldest one is updated
+            existing[product['slug']] = product
+
+        to_create = []
+        to_update = []
+        for row in rows:
+            product = existing.get(row['slug'])
+            if product is None:
+                to_create.append(Product(**{field: row[field] for field in PRODUCT_FIELDS}))
+            elif any(product[field] != row[field] for field in PRODUCT_FIELDS):
+                #a refresh mostly sends rows that haven't changed, those are left alone
+                to_update.append((product['id'], row))
+
+        Product.objects.bulk_create(to_create)
+        self.update_products(to_update)
+        self.created += len(to_create)
+        self.updated += len(to_update)
+        self.unchanged += len(rows) - len(to_create) - len(to_update)
+
+        if to_create or to_update:
+            get_search_backend().update_products(Product.objects.filter(slug__in=[row['slug'] for row in rows]))
+
+    def update_products(self, updates):
+        #one prepared UPDATE run with executemany, bulk_update's CASE WHEN per field costs milliseconds a row in python
+        if not updates:
+            return
+        fields = [Product._meta.get_field(name) for name in PRODUCT_FIELDS + ('updated_at',)]
+        assignments = ', '.join(f'{connection.ops.quote_name(field.column)} = %s' for field in fields)
+        sql = f'UPDATE {connection.ops.quote_name(Product._meta.db_table)} SET {assignments} WHERE {connection.ops.quote_name(Product._meta.pk.column)} = %s'
+        now = timezone.now()
+        params = []
+        for product_id, row in updates:
+            values = dict(row, updated_at=now)
+            params.append([field.get_db_prep_save(values[field.attname], connection) for field in fields] + [product_id])
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, params)
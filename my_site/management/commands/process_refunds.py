@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from my_site.refunds import process_refunds
+
+
+class Command(BaseCommand):
+    help = 'Pay out the accepted refunds through the payment gateway, safe to run again after a crash or next to another run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50, help='Refunds claimed at a time')
+        parser.add_argument('--workers', type=int, default=8, help='Gateway calls in flight at once')
+
+    def handle(self, *args, **options):
+        counts = process_refunds(batch_size=options['batch_size'], workers=options['workers'])
+        self.stdout.write(self.style.SUCCESS(
+            f"{counts['S']} refunded, {counts['P']} will be retried, {counts['F']} failed"))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from my_site.models import PurchasedProduct
+from my_site.purchases import rebuild_purchases
+
+
+class Command(BaseCommand):
+    help = 'Fill the purchased products index from the finished orders and badge the matching reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        verified = rebuild_purchases(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{PurchasedProduct.objects.count()} purchases indexed, {verified} reviews marked as verified purchases'))
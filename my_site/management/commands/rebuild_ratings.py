@@ -0,0 +1,42 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from my_site.models import Product, Review, RATING_STARS, rating_star
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the rating count, sum and histogram stored on every product from the reviews'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        #there are only 50 possible ratings, so grouping by (product, rating) keeps the result small
+        rows = Review.objects.filter(product__isnull=False).values('product_id', 'rating').annotate(
+            n=Count('id')).order_by()
+
+        totals = defaultdict(lambda: {'rating_count': 0, 'rating_sum': Decimal('0')})
+        for row in rows.iterator():
+            product_totals = totals[row['product_id']]
+            product_totals['rating_count'] += row['n']
+            product_totals['rating_sum'] += row['rating'] * row['n']
+            bucket = f"rating_{rating_star(row['rating'])}"
+            product_totals[bucket] = product_totals.get(bucket, 0) + row['n']
+
+        fields = ['rating_count', 'rating_sum'] + [f'rating_{star}' for star in RATING_STARS]
+        products = []
+        for product_id, product_totals in totals.items():
+            product = Product(pk=product_id)
+            for field in fields:
+                setattr(product, field, product_totals.get(field, 0))
+            products.append(product)
+
+        with transaction.atomic():
+            Product.objects.update(**{field: 0 for field in fields})
+            Product.objects.bulk_update(products, fields, batch_size=options['batch_size'])
+
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt ratings for {len(products)} products'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from my_site.sales import rebuild_sales
+
+
+class Command(BaseCommand):
+    help = 'Recalculate the daily sales buckets and the sales counters stored on every product from the order history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            buckets, products = rebuild_sales(options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {buckets} daily sales rows for {products} products'))
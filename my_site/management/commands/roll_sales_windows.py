@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from my_site.catalog import bump_catalog_version
+from my_site.sales import roll_sales_windows
+
+
+class Command(BaseCommand):
+    help = 'Recount the rolling sales windows on the products from the daily buckets, run once a day after midnight'
+
+    def handle(self, *args, **options):
+        updated = roll_sales_windows()
+        #the trending listings are cached pages, a new day's ranking should show up straight away
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(f'Rolled the sales windows of {updated} products'))
@@ -0,0 +1,158 @@
+from django.template.backends.django import DjangoTemplates, Template, reraise
+from django.template import TemplateDoesNotExist
+
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+#prometheus' default latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RequestMetrics:
+    #what one request spent its time on, filled in by the middleware, the template backend and the timers
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.payment_time = 0.0
+        #nested templates are timed inside their parent, only the outermost render is added up
+        self.rendering = 0
+
+    def server_timing(self, total):
+        #durations in milliseconds as the Server-Timing header wants them
+        entries = [
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f}',
+            f'cache;desc="hit={self.cache_hits} miss={self.cache_misses}"',
+        ]
+        if self.payment_time:
+            entries.append(f'pay;dur={self.payment_time * 1000:.1f}')
+        entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+
+current_request = contextvars.ContextVar('current_request_metrics', default=None)
+
+
+def record_cache(hit):
+    metrics = current_request.get()
+    if metrics is None:
+        return
+    if hit:
+        metrics.cache_hits += 1
+    else:
+        metrics.cache_misses += 1
+
+
+@contextmanager
+def payment_timer():
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = current_request.get()
+        if metrics is not None:
+            metrics.payment_time += time.perf_counter() - start
+
+
+def query_timer(execute, sql, params, many, context):
+    #a connection.execute_wrapper, installed on each thread's connections by the middleware
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics = current_request.get()
+        if metrics is not None:
+            metrics.queries += 1
+            metrics.db_time += time.perf_counter() - start
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = current_request.get()
+        if metrics is None:
+            return super().render(context, request)
+        metrics.rendering += 1
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.rendering -= 1
+            if not metrics.rendering:
+                metrics.template_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    #the stock django backend, with every render timed into the current request's metrics
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return TimedTemplate(self.engine.get_template(template_name), self)
+        except TemplateDoesNotExist as exc:
+            reraise(exc, self)
+
+
+class Registry:
+    #per-process totals, each worker process exposes its own and prometheus sums them up
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.buckets = defaultdict(lambda: [0] * len(LATENCY_BUCKETS))
+        self.counts = defaultdict(int)
+        self.sums = defaultdict(float)
+        self.totals = defaultdict(int)
+
+    def observe(self, view, status, duration, metrics):
+        with self.lock:
+            buckets = self.buckets[view]
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if duration <= bound:
+                    buckets[index] += 1
+            self.counts[view] += 1
+            self.sums[view] += duration
+            self.totals[('http_responses_total', view, status)] += 1
+            self.totals[('db_queries_total', view)] += metrics.queries
+            self.totals[('db_query_seconds_total', view)] += metrics.db_time
+            self.totals[('template_render_seconds_total', view)] += metrics.template_time
+            self.totals[('cache_hits_total', view)] += metrics.cache_hits
+            self.totals[('cache_misses_total', view)] += metrics.cache_misses
+            self.totals[('payment_seconds_total', view)] += metrics.payment_time
+
+    def render(self):
+        #prometheus text exposition format 0.0.4
+        with self.lock:
+            lines = [
+                '# HELP http_request_duration_seconds Time spent answering a request, by view',
+                '# TYPE http_request_duration_seconds histogram',
+            ]
+            for view in sorted(self.buckets):
+                for bound, count in zip(LATENCY_BUCKETS, self.buckets[view]):
+                    lines.append(f'http_request_duration_seconds_bucket{{view="{view}",le="{bound}"}} {count}')
+                lines.append(f'http_request_duration_seconds_bucket{{view="{view}",le="+Inf"}} {self.counts[view]}')
+                lines.append(f'http_request_duration_seconds_sum{{view="{view}"}} {self.sums[view]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{view="{view}"}} {self.counts[view]}')
+
+            names = sorted({key[0] for key in self.totals})
+            for name in names:
+                lines.append(f'# TYPE {name} counter')
+                for key in sorted(key for key in self.totals if key[0] == name):
+                    labels = f'view="{key[1]}"'
+                    if name == 'http_responses_total':
+                        labels += f',status="{key[2]}"'
+                    value = self.totals[key]
+                    lines.append(f'{name}{{{labels}}} {value:.6f}' if isinstance(value, float) else f'{name}{{{labels}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
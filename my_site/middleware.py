@@ -0,0 +1,166 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.db import connections
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+import asyncio
+import mimetypes
+import os
+import time
+
+from .metrics import RequestMetrics, current_request, query_timer, registry
+from .staticfiles import ENCODING_EXTENSIONS
+
+
+#a year, hashed names change whenever their content does
+HASHED_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+UNHASHED_CACHE_CONTROL = 'public, max-age=60'
+
+
+def accepted_encodings(header):
+    #Accept-Encoding: gzip, deflate, br;q=0.9 -> {'gzip', 'deflate', 'br'}, anything with q=0 is refused
+    accepted = set()
+    for part in header.split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class DualModeMiddleware:
+    #runs in whichever mode the handler below it does, under ASGI an async view keeps the event loop
+    #instead of being pushed through async_to_sync onto a worker thread
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            #the marker django's own MiddlewareMixin sets, it makes the instance pass as a coroutine function
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        return self.handle(request)
+
+    def handle(self, request):
+        raise NotImplementedError
+
+    async def __acall__(self, request):
+        raise NotImplementedError
+
+
+class StaticFilesMiddleware(DualModeMiddleware):
+    #serves the collectstatic output from STATIC_ROOT, picking the precompressed sibling the client accepts
+    #anything that isn't under STATIC_URL, or isn't in STATIC_ROOT, goes on to the views as usual
+
+    def is_static(self, request):
+        return request.method in ('GET', 'HEAD') and request.path.startswith(settings.STATIC_URL)
+
+    def handle(self, request):
+        if self.is_static(request):
+            response = self.serve(request, request.path[len(settings.STATIC_URL):])
+            if response is not None:
+                return response
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        if self.is_static(request):
+            #the stat and open calls go to a thread rather than block the event loop
+            response = await sync_to_async(self.serve, thread_sensitive=False)(
+                request, request.path[len(settings.STATIC_URL):])
+            if response is not None:
+                return response
+        return await self.get_response(request)
+
+    def serve(self, request, name):
+        try:
+            path = safe_join(settings.STATIC_ROOT, name)
+        except ValueError:
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        stat = os.stat(path)
+        if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
+            response = HttpResponseNotModified()
+            self.add_headers(response, name)
+            return response
+
+        content_type, _ = mimetypes.guess_type(path)
+        accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        encoding = None
+        for candidate in ('br', 'gzip'):
+            if candidate in accepted and os.path.isfile(path + ENCODING_EXTENSIONS[candidate]):
+                encoding = candidate
+                path += ENCODING_EXTENSIONS[candidate]
+                break
+
+        response = FileResponse(open(path, 'rb'), content_type=content_type or 'application/octet-stream')
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if encoding:
+            response['Content-Encoding'] = encoding
+        self.add_headers(response, name)
+        return response
+
+    def add_headers(self, response, name):
+        response['Vary'] = 'Accept-Encoding'
+        is_hashed = getattr(staticfiles_storage, 'is_hashed', None)
+        response['Cache-Control'] = HASHED_CACHE_CONTROL if is_hashed and is_hashed(name) else UNHASHED_CACHE_CONTROL
+
+
+def install_query_timers():
+    #connections belong to the thread that runs the queries, under ASGI that is the sync_to_async thread not the event loop
+    #the timer stays installed, it only records while a request's metrics are current
+    for connection in connections.all():
+        if query_timer not in connection.execute_wrappers:
+            connection.execute_wrappers.append(query_timer)
+
+
+class MetricsMiddleware(DualModeMiddleware):
+    #times every request into a Server-Timing header and the per view totals behind /metrics
+    #the per query cost is two perf_counter calls, cheap enough to leave on in production
+
+    def handle(self, request):
+        install_query_timers()
+        request_metrics = RequestMetrics()
+        token = current_request.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, request_metrics, start)
+
+    async def __acall__(self, request):
+        await sync_to_async(install_query_timers)()
+        request_metrics = RequestMetrics()
+        #sync_to_async copies the context, so the ORM and template work of an async view lands in these metrics too
+        token = current_request.set(request_metrics)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, request_metrics, start)
+
+    def finish(self, request, response, request_metrics, start):
+        duration = time.perf_counter() - start
+        response['Server-Timing'] = request_metrics.server_timing(duration)
+        registry.observe(view_label(request), response.status_code, duration, request_metrics)
+        return response
+
+
+def view_label(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched'
+    return match.view_name or match._func_path
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.4 on 2026-10-18 20:32
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+#the GIN index and the backfill only make sense on postgres, other databases use the in-memory search backend
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        'CREATE INDEX my_site_product_search_gin ON my_site_product USING gin (search_vector)'
+    )
+    schema_editor.execute("""
+        UPDATE my_site_product SET search_vector =
+            setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce((SELECT a.name FROM my_site_artist a WHERE a.id = artist_id), '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(school, '')), 'C') ||
+            setweight(to_tsvector('english', coalesce(history, '')), 'D')
+    """)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS my_site_product_search_gin')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_site', '0009_product_ratings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 3.2.4 on 2026-10-18 20:36
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_open_carts(apps, schema_editor):
+    #the old cart views could leave duplicate open carts and lines behind, fold them together so the constraints apply
+    ShoppingCartOrder = apps.get_model('my_site', 'ShoppingCartOrder')
+    ShoppingCartOrderItem = apps.get_model('my_site', 'ShoppingCartOrderItem')
+
+    duplicate_users = ShoppingCartOrder.objects.filter(ordered=False).values('user_id').annotate(
+        n=Count('id')).filter(n__gt=1).values_list('user_id', flat=True)
+    for user_id in duplicate_users:
+        orders = list(ShoppingCartOrder.objects.filter(user_id=user_id, ordered=False).order_by('id'))
+        keep = orders[0]
+        for order in orders[1:]:
+            keep.items.add(*order.items.all())
+            order.delete()
+
+    #lines that were taken out of a cart used to stay behind as open rows
+    ShoppingCartOrderItem.objects.filter(ordered=False, shoppingcartorder__isnull=True).delete()
+
+    duplicate_lines = ShoppingCartOrderItem.objects.filter(ordered=False).values('user_id', 'item_id').annotate(
+        n=Count('id'), keep_id=Min('id'), total=Sum('quantity')).filter(n__gt=1)
+    for line in duplicate_lines:
+        ShoppingCartOrderItem.objects.filter(pk=line['keep_id']).update(quantity=line['total'])
+        ShoppingCartOrderItem.objects.filter(
+            user_id=line['user_id'], item_id=line['item_id'], ordered=False).exclude(pk=line['keep_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_site', '0011_product_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_open_carts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='shoppingcartorder',
+            constraint=models.UniqueConstraint(condition=models.Q(('ordered', False)), fields=('user',), name='one_open_cart_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='shoppingcartorderitem',
+            constraint=models.UniqueConstraint(condition=models.Q(('ordered', False)), fields=('user', 'item'), name='one_open_line_per_product'),
+        ),
+    ]
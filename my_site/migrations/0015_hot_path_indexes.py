@@ -0,0 +1,33 @@
+# Generated by Django 3.2.4 on 2026-10-18 20:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_site', '0014_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(condition=models.Q(('default', True)), fields=['user', 'address_type'], name='address_default_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='coupon',
+            index=models.Index(fields=['code'], name='coupon_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['school', 'id'], name='product_school_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shoppingcartorder',
+            index=models.Index(condition=models.Q(('ordered', True)), fields=['user', '-ordered_date', '-id'], name='order_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shoppingcartorder',
+            index=models.Index(fields=['ref_code'], name='order_ref_code_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.2.4 on 2026-10-18 21:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_site', '0015_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['zip_code'], name='address_zip_code_idx'),
+        ),
+    ]
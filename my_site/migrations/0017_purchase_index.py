@@ -0,0 +1,34 @@
+# Generated by Django 3.2.4 on 2026-10-18 21:01
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('my_site', '0016_address_zip_code_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='review',
+            name='verified_purchase',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='PurchasedProduct',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_purchased_at', models.DateTimeField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='my_site.product')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='purchasedproduct',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='one_purchase_row_per_product'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.4 on 2026-10-18 21:10
+
+from django.db import migrations, models
+
+
+def settle_granted_refunds(apps, schema_editor):
+    #refunds granted before the processor existed were paid out by hand, they mustn't be paid out again
+    Refund = apps.get_model('my_site', 'Refund')
+    Refund.objects.filter(order__refund_granted=True).update(status='S')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('my_site', '0020_coupon_limits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refund',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='gateway_refund_id',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='refund',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('R', 'Processing'), ('S', 'Refunded'), ('F', 'Failed')], default='P', max_length=1),
+        ),
+        migrations.AddIndex(
+            model_name='refund',
+            index=models.Index(fields=['status', 'id'], name='refund_status_id_idx'),
+        ),
+        migrations.RunPython(settle_granted_refunds, migrations.RunPython.noop),
+    ]
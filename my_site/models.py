@@ -1,4 +1,7 @@
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Now
+from django.contrib.postgres.search import SearchVectorField
 from django.contrib.auth.models import User
 from django.core.validators import MinLengthValidator, MinValueValidator, MaxValueValidator
 from django.utils.text import slugify
@@ -14,9 +17,27 @@ ADDRESS_CHOICES = (
     ('S', 'Shipping')
 )
 
+RATING_STARS = (1, 2, 3, 4, 5)
+
+#where a refund is in my_site.refunds, processing rows have been claimed by a worker and not settled yet
+REFUND_STATUS_CHOICES = (
+    ('P', 'Pending'),
+    ('R', 'Processing'),
+    ('S', 'Refunded'),
+    ('F', 'Failed')
+)
+
+
+def rating_star(rating):
+    #which histogram bucket a review lands in, ratings are rounded to the nearest whole star
+    star = int(Decimal(rating).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    return min(max(star, 1), 5)
+
 
 class Artist(models.Model):
     name = models.CharField(max_length=255)
+    #the conditional GETs on the catalog pages are worked out from these timestamps
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -33,6 +54,23 @@ class Product(models.Model):
     artist = models.ForeignKey(Artist, on_delete=models.SET_NULL, null=True)
     image = models.ImageField(upload_to='images', null=True)
     slug = models.SlugField()
+    #review aggregates, kept up to date by the Review signals and rebuilt with manage.py rebuild_ratings
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.DecimalField(max_digits=12, decimal_places=1, default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+    #weighted name/artist/school/history vector, GIN indexed and kept current by the search backend
+    search_vector = SearchVectorField(null=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+    #sales counters, added to at checkout alongside the ProductSalesDay buckets
+    #the windowed ones are recounted from the buckets each day by manage.py roll_sales_windows
+    units_sold = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units_sold_7d = models.PositiveIntegerField(default=0)
+    units_sold_30d = models.PositiveIntegerField(default=0)
     
     
 
@@ -56,6 +94,40 @@ class Product(models.Model):
             'slug': self.slug
         })
 
+    class Meta:
+        #backs the keyset orderings offered by AllProductView
+        indexes = [
+            models.Index(fields=['price', 'id'], name='product_price_id_idx'),
+            models.Index(fields=['-rating_count', 'id'], name='product_rating_count_id_idx'),
+            #the per school listings
+            models.Index(fields=['school', 'id'], name='product_school_id_idx'),
+            #best sellers and trending
+            models.Index(fields=['-units_sold', 'id'], name='product_units_sold_id_idx'),
+            models.Index(fields=['-units_sold_7d', 'id'], name='product_units_7d_id_idx'),
+        ]
+
+    @property
+    def average_rating(self):
+        if self.rating_count:
+            return (self.rating_sum / self.rating_count).quantize(Decimal('0.1'), rounding=ROUND_HALF_UP)
+        return None
+
+    @property
+    def rating_histogram(self):
+        return {star: getattr(self, f'rating_{star}') for star in RATING_STARS}
+
+    @staticmethod
+    def apply_rating(product_id, rating, sign=1):
+        #sign is 1 when a review is added and -1 when it is taken away, F() keeps concurrent reviews from clobbering each other
+        star = rating_star(rating)
+        Product.objects.filter(pk=product_id).update(**{
+            'rating_count': F('rating_count') + sign,
+            'rating_sum': F('rating_sum') + sign * Decimal(rating),
+            f'rating_{star}': F(f'rating_{star}') + sign,
+            #update() skips auto_now, the product page shows the rating so it has changed
+            'updated_at': Now()
+        })
+
 
 
 #this is to link between the product and the shopping cart order itself, once added to cart an order becomes this class
@@ -81,6 +153,10 @@ class ShoppingCartOrderItem(models.Model):
 
     class Meta:
         verbose_name_plural = 'Order Item(link between)'
+        constraints = [
+            #a product appears once in an open cart, extra clicks bump the quantity
+            models.UniqueConstraint(fields=['user', 'item'], condition=models.Q(ordered=False), name='one_open_line_per_product'),
+        ]
 
 class Address(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -96,12 +172,20 @@ class Address(models.Model):
 
     class Meta:
         verbose_name_plural = 'Addresses'
+        indexes = [
+            #checkout looks up the user's default billing/shipping address
+            models.Index(fields=['user', 'address_type'], condition=models.Q(default=True), name='address_default_idx'),
+            #the admin's exact zip code search
+            models.Index(fields=['zip_code'], name='address_zip_code_idx'),
+        ]
 
 class Payment(models.Model):
     stripe_charge_id = models.CharField(max_length=50)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True)
     amount = models.FloatField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    #one per payment form, makes a double submitted checkout a no-op
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
 
     def __str__(self):
         return self.user.username
@@ -110,10 +194,28 @@ class Payment(models.Model):
 class Coupon(models.Model):
     code = models.CharField(max_length=15)
     amount = models.IntegerField()
+    active = models.BooleanField(default=True)
+    valid_from = models.DateTimeField(blank=True, null=True)
+    expires_at = models.DateTimeField(blank=True, null=True)
+    #empty for no limit, used only goes up through the conditional update in my_site.coupons
+    max_uses = models.PositiveIntegerField(blank=True, null=True)
+    used = models.PositiveIntegerField(default=0)
 
     def __str__(self):
         return self.code
 
+    def is_valid(self, now):
+        return (
+            self.active
+            and (self.valid_from is None or self.valid_from <= now)
+            and (self.expires_at is None or now < self.expires_at)
+        )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['code'], name='coupon_code_idx'),
+        ]
+
 
 class ShoppingCartOrder(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -144,7 +246,11 @@ class ShoppingCartOrder(models.Model):
 
     def get_total(self):
         total = 0
-        for order_item in self.items.all():
+        order_items = self.items.all()
+        #reuse the rows when the order was loaded with items prefetched, otherwise join the products in one go
+        if 'items' not in getattr(self, '_prefetched_objects_cache', {}):
+            order_items = order_items.select_related('item')
+        for order_item in order_items:
             total += order_item.get_final_price()
         if self.coupon:
             total -= self.coupon.amount 
@@ -152,6 +258,15 @@ class ShoppingCartOrder(models.Model):
 
     class Meta:
         verbose_name_plural = 'Order'
+        constraints = [
+            models.UniqueConstraint(fields=['user'], condition=models.Q(ordered=False), name='one_open_cart_per_user'),
+        ]
+        indexes = [
+            #my orders pages through a user's finished orders newest first
+            models.Index(fields=['user', '-ordered_date', '-id'], condition=models.Q(ordered=True), name='order_history_idx'),
+            #refund requests look orders up by reference
+            models.Index(fields=['ref_code'], name='order_ref_code_idx'),
+        ]
 
 
 class Review(models.Model):
@@ -160,18 +275,89 @@ class Review(models.Model):
     rating = models.DecimalField(max_digits=2, decimal_places=1, validators=[MinValueValidator(Decimal('0.1')), MaxValueValidator(Decimal('5.0'))])
     comment = models.TextField(validators=[MinLengthValidator(10)])
     date = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    #set when the review was written through the purchase index, shown as a badge on the product page
+    verified_purchase = models.BooleanField(default=False)
 
     def __str__(self):
         return str(self.user) 
 
 
+class PurchasedProduct(models.Model):
+    #one row per product a user has paid for, filled in when checkout finalizes an order and by manage.py rebuild_purchases
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    first_purchased_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.user} bought {self.product}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='one_purchase_row_per_product'),
+        ]
+
+
+class ProductSalesDay(models.Model):
+    #units and revenue per product per day, the rolling windows on Product are summed from these
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    day = models.DateField()
+    units = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f'{self.product} on {self.day}'
+
+    class Meta:
+        constraints = [
+            #the upsert target at checkout, and the index the window sums read
+            models.UniqueConstraint(fields=['product', 'day'], name='one_sales_row_per_day'),
+        ]
+
+
+class ProductRecommendation(models.Model):
+    #the top co-purchased products for each product, written in bulk by manage.py build_recommendations
+    product = models.ForeignKey(Product, related_name='recommendations', on_delete=models.CASCADE)
+    recommended = models.ForeignKey(Product, related_name='+', on_delete=models.CASCADE)
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    computed_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.product} -> {self.recommended}'
+
+    class Meta:
+        constraints = [
+            #also the index the product page reads its recommendations through, in rank order
+            models.UniqueConstraint(fields=['product', 'rank'], name='one_recommendation_per_rank'),
+        ]
+
+
 class Refund(models.Model):
     order = models.ForeignKey(ShoppingCartOrder, on_delete=models.CASCADE)
     reason = models.TextField()
     accepted = models.BooleanField(default=False)
     email = models.EmailField()
+    #accepted refunds are paid out by manage.py process_refunds or the admin action
+    status = models.CharField(max_length=1, choices=REFUND_STATUS_CHOICES, default='P')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    gateway_refund_id = models.CharField(max_length=50, blank=True)
+    error = models.TextField(blank=True)
 
     def __str__(self):
         return f'{self.pk}'
 
+    @property
+    def idempotency_key(self):
+        #the same for every attempt, so a refund retried after a crash is paid out once
+        return f'refund-{self.pk}'
+
+    class Meta:
+        indexes = [
+            #the processor's claim query
+            models.Index(fields=['status', 'id'], name='refund_status_id_idx'),
+        ]
+
 
@@ -0,0 +1,117 @@
+from django.core import signing
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+import json
+
+
+#cursors are signed so that a client can't hand us arbitrary filter values
+CURSOR_SALT = 'my_site.pagination'
+
+
+def encode_cursor(values):
+    return signing.dumps([str(value) for value in values], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(token):
+    try:
+        return signing.loads(token, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        return None
+
+
+def keyset_filter(keys, values, reverse=False):
+    #builds (a < x) OR (a = x AND b < y) OR ... for the sort keys, flipped for the previous page
+    condition = Q()
+    for index, key in enumerate(keys):
+        field = key.lstrip('-')
+        descending = key.startswith('-') != reverse
+        lookup = 'lt' if descending else 'gt'
+        branch = Q(**{f'{field}__{lookup}': values[index]})
+        for previous_key, previous_value in zip(keys[:index], values[:index]):
+            branch &= Q(**{previous_key.lstrip('-'): previous_value})
+        condition |= branch
+    return condition
+
+
+def flip_ordering(keys):
+    return [key[1:] if key.startswith('-') else f'-{key}' for key in keys]
+
+
+class KeysetPage:
+    def __init__(self, object_list, keys, has_next, has_previous):
+        self.object_list = object_list
+        self.keys = keys
+        self.has_next = has_next
+        self.has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def cursor_for(self, obj):
+        return encode_cursor([getattr(obj, key.lstrip('-')) for key in self.keys])
+
+    @property
+    def next_cursor(self):
+        if self.has_next:
+            return self.cursor_for(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous:
+            return self.cursor_for(self.object_list[0])
+
+
+def keyset_paginate(queryset, keys, per_page, after=None, before=None):
+    #keys is an ordering such as ['-ordered_date', '-id'], the last key has to be unique
+    #only ever fetches per_page + 1 rows, so deep pages cost the same as the first one
+    after = decode_cursor(after) if after else None
+    before = decode_cursor(before) if before else None
+
+    if before and len(before) == len(keys):
+        qs = queryset.filter(keyset_filter(keys, before, reverse=True)).order_by(*flip_ordering(keys))
+        rows = list(qs[:per_page + 1])
+        has_previous = len(rows) > per_page
+        rows = rows[:per_page]
+        rows.reverse()
+        return KeysetPage(rows, keys, has_next=True, has_previous=has_previous)
+
+    qs = queryset.order_by(*keys)
+    has_previous = False
+    if after and len(after) == len(keys):
+        qs = qs.filter(keyset_filter(keys, after))
+        has_previous = True
+    rows = list(qs[:per_page + 1])
+    has_next = len(rows) > per_page
+    return KeysetPage(rows[:per_page], keys, has_next=has_next, has_previous=has_previous)
+
+
+class EstimatedCountPaginator(Paginator):
+    #for admin changelists over very big tables: past ESTIMATE_THRESHOLD rows the planner's row estimate is used
+    #instead of a COUNT(*) that has to read every matching row, the page links are then approximate
+    ESTIMATE_THRESHOLD = 100000
+
+    @cached_property
+    def count(self):
+        estimate = self.estimated_count()
+        if estimate is not None and estimate > self.ESTIMATE_THRESHOLD:
+            return estimate
+        return super().count
+
+    def estimated_count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+        sql, params = queryset.order_by().query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
@@ -0,0 +1,165 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+import asyncio
+import logging
+import random
+import threading
+import time
+import uuid
+
+import stripe
+stripe.api_key = settings.STRIPE_SECRET_KEY
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentError(Exception):
+    #message is what the customer gets to see
+    message = 'Something went wrong, you were not charge. Please try again'
+
+    def __init__(self, message=None):
+        if message:
+            self.message = message
+        super().__init__(self.message)
+
+
+class CardDeclined(PaymentError):
+    message = 'Your card was declined'
+
+
+#what the real gateway answers when a key comes back on another endpoint
+KEY_REUSED = 'Keys for idempotent requests can only be used for the same endpoint they were first used for'
+
+
+class PaymentGateway:
+    def charge(self, amount, currency, source, idempotency_key):
+        #amount is in cents, returns the gateway's charge id
+        raise NotImplementedError
+
+    def refund(self, charge_id, amount=None, idempotency_key=None):
+        #returns the gateway's refund id, the whole charge is refunded when amount is None
+        raise NotImplementedError
+
+    async def acharge(self, amount, currency, source, idempotency_key):
+        #off the event loop and off the thread the ORM uses, so a slow gateway only holds up this request
+        return await sync_to_async(self.charge, thread_sensitive=False)(amount, currency, source, idempotency_key)
+
+
+class StripeGateway(PaymentGateway):
+    def charge(self, amount, currency, source, idempotency_key):
+        try:
+            charge = stripe.Charge.create(
+                amount=amount,
+                currency=currency,
+                source=source,
+                idempotency_key=idempotency_key
+            )
+            return charge['id']
+        except stripe.error.StripeError as e:
+            raise self.translate_error(e)
+
+    def refund(self, charge_id, amount=None, idempotency_key=None):
+        try:
+            refund = stripe.Refund.create(
+                charge=charge_id,
+                amount=amount,
+                idempotency_key=idempotency_key
+            )
+            return refund['id']
+        except stripe.error.StripeError as e:
+            raise self.translate_error(e)
+
+    def translate_error(self, e):
+        if isinstance(e, stripe.error.CardError):
+            # Since it's a decline, stripe.error.CardError will be caught
+            err = (e.json_body or {}).get('error', {})
+            return CardDeclined(err.get('message'))
+        if isinstance(e, stripe.error.RateLimitError):
+            # Too many requests made to the API too quickly
+            return PaymentError('Rate limit error')
+        if isinstance(e, stripe.error.InvalidRequestError):
+            # Invalid parameters were supplied to Stripe's API
+            return PaymentError('Invalid Parameters')
+        if isinstance(e, stripe.error.AuthenticationError):
+            # Authentication with Stripe's API failed
+            # (maybe you changed API keys recently)
+            return PaymentError('Not Authenticated')
+        if isinstance(e, stripe.error.APIConnectionError):
+            # Network communication with Stripe failed
+            return PaymentError('Network Error')
+        return PaymentError()
+
+
+class FakeGateway(PaymentGateway):
+    #in-process stand in for load testing checkout, never talks to the network
+    #latency is in seconds, failure_rate is the share of charges that are declined
+
+    def __init__(self, latency=0, failure_rate=0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.charges = {}
+        self.refunds = {}
+
+    def declined(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+    def record_charge(self, amount, idempotency_key):
+        with self.lock:
+            if idempotency_key in self.refunds:
+                raise PaymentError(KEY_REUSED)
+            #same key, same charge, like the real gateway
+            if idempotency_key not in self.charges:
+                self.charges[idempotency_key] = (f'fake_ch_{uuid.uuid4().hex}', amount)
+            return self.charges[idempotency_key][0]
+
+    def charge(self, amount, currency, source, idempotency_key):
+        time.sleep(self.latency)
+        if self.declined():
+            raise CardDeclined()
+        return self.record_charge(amount, idempotency_key)
+
+    async def acharge(self, amount, currency, source, idempotency_key):
+        await asyncio.sleep(self.latency)
+        if self.declined():
+            raise CardDeclined()
+        return self.record_charge(amount, idempotency_key)
+
+    def refund(self, charge_id, amount=None, idempotency_key=None):
+        time.sleep(self.latency)
+        if self.declined():
+            raise PaymentError('Network Error')
+        with self.lock:
+            key = idempotency_key or uuid.uuid4().hex
+            if key in self.charges:
+                raise PaymentError(KEY_REUSED)
+            if key not in self.refunds:
+                self.refunds[key] = (f'fake_re_{uuid.uuid4().hex}', charge_id, amount)
+            return self.refunds[key][0]
+
+
+_gateways = {}
+
+
+def get_payment_gateway():
+    #one instance per configuration, so the fake gateway keeps its ledger between requests
+    backend = settings.PAYMENT_GATEWAY['BACKEND']
+    options = settings.PAYMENT_GATEWAY.get('OPTIONS', {})
+    key = (backend, tuple(sorted(options.items())))
+    if key not in _gateways:
+        _gateways[key] = import_string(backend)(**options)
+    return _gateways[key]
+
+
+def refund_unrecorded_charge(charge_id, idempotency_key):
+    #gives back a charge the checkout could not record, the refund's key is derived from the charge's
+    #since a key can't be reused on another endpoint, returns None and logs the charge when the refund fails
+    try:
+        return get_payment_gateway().refund(charge_id, idempotency_key=f'refund-{idempotency_key}')
+    except Exception:
+        logger.exception('Refunding charge %s failed, it has to be refunded by hand', charge_id)
+        return None
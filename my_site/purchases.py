@@ -0,0 +1,45 @@
+from django.db.models import Exists, Min, OuterRef
+from django.utils import timezone
+
+from .models import Product, PurchasedProduct, Review, ShoppingCartOrderItem
+
+
+def record_purchases(order, user, purchased_at=None):
+    #two statements however big the order, products bought before keep their first purchase date
+    product_ids = ShoppingCartOrderItem.objects.filter(shoppingcartorder=order).values_list('item_id', flat=True)
+    purchased_at = purchased_at or timezone.now()
+    PurchasedProduct.objects.bulk_create(
+        [PurchasedProduct(user=user, product_id=product_id, first_purchased_at=purchased_at) for product_id in product_ids],
+        ignore_conflicts=True
+    )
+
+
+def has_purchased(user, product):
+    return PurchasedProduct.objects.filter(user=user, product=product).exists()
+
+
+def reviewable_products(user):
+    #bought and not reviewed yet, one join on the (user, product) unique index
+    return Product.objects.filter(purchasedproduct__user=user).exclude(
+        id__in=Review.objects.filter(user=user, product__isnull=False).values('product_id')
+    )
+
+
+def rebuild_purchases(batch_size=1000):
+    #backfill from the finished orders, safe to rerun since existing rows are left alone
+    rows = ShoppingCartOrderItem.objects.filter(
+        ordered=True,
+        shoppingcartorder__ordered=True
+    ).values('user_id', 'item_id').annotate(first=Min('shoppingcartorder__ordered_date')).order_by()
+
+    batch = []
+    for row in rows.iterator(chunk_size=batch_size):
+        batch.append(PurchasedProduct(user_id=row['user_id'], product_id=row['item_id'], first_purchased_at=row['first']))
+        if len(batch) >= batch_size:
+            PurchasedProduct.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    PurchasedProduct.objects.bulk_create(batch, ignore_conflicts=True)
+
+    #reviews written before the index existed get their badge if the purchase is on record
+    purchased = PurchasedProduct.objects.filter(user=OuterRef('user'), product=OuterRef('product'))
+    return Review.objects.filter(verified_purchase=False).filter(Exists(purchased)).update(verified_purchase=True)
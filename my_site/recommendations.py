@@ -0,0 +1,105 @@
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Product, ProductRecommendation, ShoppingCartOrder
+
+import numpy as np
+from itertools import islice
+from scipy import sparse
+
+
+METRICS = ('cosine', 'lift')
+
+
+def order_lines(chunk_size):
+    #(order id, product id) for every finished order, in order id order so an order's lines come out together
+    lines = ShoppingCartOrder.items.through.objects.filter(
+        shoppingcartorder__ordered=True
+    ).order_by('shoppingcartorder_id').values_list('shoppingcartorder_id', 'shoppingcartorderitem__item_id')
+    return lines.iterator(chunk_size=chunk_size)
+
+
+def basket_chunks(lines, chunk_size):
+    #numpy (order ids, product ids) pairs of about chunk_size lines each, only ever holding whole orders
+    carried = np.empty((0, 2), dtype=np.int64)
+    while True:
+        rows = list(islice(lines, chunk_size))
+        if not rows:
+            break
+        chunk = np.concatenate([carried, np.array(rows, dtype=np.int64)])
+        #the last order may carry on in the next chunk, it waits for the rest of its lines
+        last = chunk[-1, 0]
+        split = np.searchsorted(chunk[:, 0], last)
+        carried = chunk[split:]
+        if split:
+            yield chunk[:split, 0], chunk[:split, 1]
+    if len(carried):
+        yield carried[:, 0], carried[:, 1]
+
+
+def cooccurrence_matrix(chunks, product_ids):
+    #product x product counts of the orders two products were bought in together, the diagonal is each product's own order count
+    #memory is bounded by one chunk of lines plus the distinct pairs, however many orders there are
+    size = len(product_ids)
+    counts = sparse.csr_matrix((size, size), dtype=np.int64)
+    baskets = 0
+    for orders, items in chunks:
+        columns = np.searchsorted(product_ids, items)
+        #lines pointing at products deleted since are dropped
+        known = (columns < size) & (product_ids[np.minimum(columns, size - 1)] == items)
+        orders, columns = orders[known], columns[known]
+        order_ids, rows = np.unique(orders, return_inverse=True)
+        incidence = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, columns)),
+                                      shape=(len(order_ids), size))
+        #the same product twice in one order still counts once
+        incidence.sum_duplicates()
+        incidence.data[:] = 1
+        counts = counts + incidence.T @ incidence
+        baskets += len(order_ids)
+    return counts.tocsr(), baskets
+
+
+def top_neighbours(counts, baskets, metric='cosine', top_k=10, min_support=2):
+    #(product index, neighbour index, rank, score) arrays, best first within each product
+    support = counts.diagonal().astype(np.float64)
+    pairs = counts.tocoo()
+    keep = (pairs.row != pairs.col) & (pairs.data >= min_support)
+    rows, columns, together = pairs.row[keep], pairs.col[keep], pairs.data[keep].astype(np.float64)
+
+    if metric == 'cosine':
+        scores = together / np.sqrt(support[rows] * support[columns])
+    else:
+        #how much more often the pair sells together than two independent products would
+        scores = together * baskets / (support[rows] * support[columns])
+
+    #sorted by product then best score, the column breaks ties so reruns write the same table
+    order = np.lexsort((columns, -scores, rows))
+    rows, columns, scores = rows[order], columns[order], scores[order]
+    ranks = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    best = ranks < top_k
+    return rows[best], columns[best], ranks[best], scores[best]
+
+
+def build_recommendations(metric='cosine', top_k=10, min_support=2, chunk_size=100000, batch_size=5000):
+    product_ids = np.array(Product.objects.order_by('id').values_list('id', flat=True), dtype=np.int64)
+    if not len(product_ids):
+        return 0, 0
+    chunks = basket_chunks(order_lines(chunk_size), chunk_size)
+    counts, baskets = cooccurrence_matrix(chunks, product_ids)
+    rows, columns, ranks, scores = top_neighbours(counts, baskets, metric, top_k, min_support)
+
+    computed_at = timezone.now()
+    recommendations = (
+        ProductRecommendation(product_id=int(product_ids[row]), recommended_id=int(product_ids[column]),
+                              rank=int(rank), score=float(score), computed_at=computed_at)
+        for row, column, rank, score in zip(rows, columns, ranks, scores)
+    )
+    #readers see either the old table or the new one
+    with transaction.atomic():
+        ProductRecommendation.objects.all().delete()
+        while True:
+            batch = list(islice(recommendations, batch_size))
+            if not batch:
+                break
+            ProductRecommendation.objects.bulk_create(batch)
+    return len(rows), baskets
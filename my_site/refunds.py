@@ -0,0 +1,92 @@
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Refund, ShoppingCartOrder
+from .payments import PaymentError, get_payment_gateway
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+
+PENDING = 'P'
+PROCESSING = 'R'
+REFUNDED = 'S'
+FAILED = 'F'
+
+MAX_ATTEMPTS = 3
+#a claim older than this belongs to a worker that died, its refunds are picked up again
+STALE_CLAIM = timedelta(minutes=10)
+
+
+def claimable(queryset, now):
+    return queryset.filter(accepted=True).filter(
+        Q(status=PENDING) | Q(status=PROCESSING, claimed_at__lt=now - STALE_CLAIM)
+    )
+
+
+def claim_batch(queryset, batch_size):
+    #SKIP LOCKED lets several processors run side by side, each takes rows nobody else is holding
+    #the claim is committed before the gateway is called so no lock is held across the network
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(claimable(queryset, now).select_for_update(skip_locked=True).order_by('id').values_list(
+            'id', flat=True)[:batch_size])
+        #checked again in the update and read back by claim time, for databases without SKIP LOCKED
+        claimable(Refund.objects.filter(id__in=ids), now).update(
+            status=PROCESSING, claimed_at=now, attempts=F('attempts') + 1)
+    return list(Refund.objects.filter(id__in=ids, status=PROCESSING, claimed_at=now).select_related(
+        'order__payment').order_by('id'))
+
+
+def issue_refund(gateway, refund):
+    #(gateway refund id, error message), the whole charge goes back
+    payment = refund.order.payment
+    if payment is None:
+        return None, 'The order has no payment to refund'
+    try:
+        return gateway.refund(payment.stripe_charge_id, idempotency_key=refund.idempotency_key), ''
+    except PaymentError as e:
+        return None, e.message
+    except Exception as e:
+        return None, str(e) or e.__class__.__name__
+
+
+def record_results(refunds, results):
+    #two bulk writes a batch, the orders of the refunds that went through are marked as granted with them
+    now = timezone.now()
+    for refund, (gateway_refund_id, error) in zip(refunds, results):
+        refund.processed_at = now
+        refund.error = error
+        if gateway_refund_id:
+            refund.status = REFUNDED
+            refund.gateway_refund_id = gateway_refund_id
+        else:
+            #given back to the queue until it has had its tries
+            refund.status = FAILED if refund.attempts >= MAX_ATTEMPTS else PENDING
+
+    with transaction.atomic():
+        Refund.objects.bulk_update(refunds, ['status', 'gateway_refund_id', 'error', 'processed_at'])
+        ShoppingCartOrder.objects.filter(
+            refund__in=[refund for refund in refunds if refund.status == REFUNDED]
+        ).update(refund_requested=False, refund_granted=True)
+
+
+def process_refunds(queryset=None, batch_size=50, workers=8, gateway=None):
+    #pays out accepted refunds batch by batch until none are left, returns how many ended up in each status
+    queryset = Refund.objects.all() if queryset is None else queryset
+    gateway = gateway or get_payment_gateway()
+    counts = {REFUNDED: 0, PENDING: 0, FAILED: 0}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            refunds = claim_batch(queryset, batch_size)
+            if not refunds:
+                break
+            #the worker threads only talk to the gateway, the database work stays on this thread
+            results = list(pool.map(lambda refund: issue_refund(gateway, refund), refunds))
+            record_results(refunds, results)
+            for refund in refunds:
+                counts[refund.status] += 1
+            #a refund sent back to pending is retried by the next run rather than in this loop
+            queryset = queryset.exclude(id__in=[refund.id for refund in refunds if refund.status == PENDING])
+    return counts
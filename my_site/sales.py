@@ -0,0 +1,134 @@
+from django.db import connection
+from django.db.models import IntegerField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Product, ProductSalesDay, ShoppingCartOrderItem
+
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+
+#days in each rolling window and the Product column holding its unit count
+SALES_WINDOWS = {
+    7: 'units_sold_7d',
+    30: 'units_sold_30d',
+}
+CENT = Decimal('0.01')
+
+
+def line_revenue(quantity, price, discount_price):
+    #what the cart charged for the line, discount_price is a float column
+    unit_price = Decimal(str(discount_price)) if discount_price else price
+    return (quantity * unit_price).quantize(CENT)
+
+
+def order_sales(order):
+    #{product id: (units, revenue)} for one order, the same product on two lines is added up
+    totals = defaultdict(lambda: (0, Decimal('0')))
+    lines = ShoppingCartOrderItem.objects.filter(shoppingcartorder=order).values_list(
+        'item_id', 'quantity', 'item__price', 'item__discount_price')
+    for product_id, quantity, price, discount_price in lines:
+        units, revenue = totals[product_id]
+        totals[product_id] = (units + quantity, revenue + line_revenue(quantity, price, discount_price))
+    return totals
+
+
+def quote(model, field_name=None):
+    if field_name is None:
+        return connection.ops.quote_name(model._meta.db_table)
+    return connection.ops.quote_name(model._meta.get_field(field_name).column)
+
+
+def record_sales(order, day=None):
+    #three statements however many lines the order has, run inside the checkout transaction
+    #the buckets are upserted and the product counters added to in place, nothing is regrouped from the order lines
+    totals = order_sales(order)
+    if not totals:
+        return
+    day = day or timezone.localdate()
+
+    bucket_table = quote(ProductSalesDay)
+    units, revenue = quote(ProductSalesDay, 'units'), quote(ProductSalesDay, 'revenue')
+    upsert = (
+        f'INSERT INTO {bucket_table} ({quote(ProductSalesDay, "product")}, {quote(ProductSalesDay, "day")}, {units}, {revenue}) '
+        f'VALUES (%s, %s, %s, %s) '
+        f'ON CONFLICT ({quote(ProductSalesDay, "product")}, {quote(ProductSalesDay, "day")}) '
+        f'DO UPDATE SET {units} = {bucket_table}.{units} + EXCLUDED.{units}, '
+        f'{revenue} = {bucket_table}.{revenue} + EXCLUDED.{revenue}'
+    )
+    revenue_field = ProductSalesDay._meta.get_field('revenue')
+    day = ProductSalesDay._meta.get_field('day').get_db_prep_save(day, connection)
+
+    #a sale today is inside every window, so the windowed counters go up with the all time one
+    counters = ['units_sold'] + list(SALES_WINDOWS.values())
+    assignments = [f'{quote(Product, name)} = {quote(Product, name)} + %s' for name in counters]
+    assignments.append(f'{quote(Product, "revenue")} = {quote(Product, "revenue")} + %s')
+    update = f'UPDATE {quote(Product)} SET {", ".join(assignments)} WHERE {quote(Product, "id")} = %s'
+
+    bucket_params = []
+    product_params = []
+    for product_id, (product_units, product_revenue) in sorted(totals.items()):
+        product_revenue = revenue_field.get_db_prep_save(product_revenue, connection)
+        bucket_params.append([product_id, day, product_units, product_revenue])
+        product_params.append([product_units] * len(counters) + [product_revenue, product_id])
+
+    #sorted by product so concurrent checkouts take the row locks in the same order
+    with connection.cursor() as cursor:
+        cursor.executemany(upsert, bucket_params)
+        cursor.executemany(update, product_params)
+
+
+def window_units(days, today):
+    window = ProductSalesDay.objects.filter(product=OuterRef('pk'), day__gt=today - timedelta(days=days))
+    units = window.values('product').annotate(total=Sum('units')).values('total')
+    return Coalesce(Subquery(units, output_field=IntegerField()), Value(0))
+
+
+def roll_sales_windows(today=None):
+    #recounts the windowed columns from at most 30 bucket rows a product, only products that sold inside a window are touched
+    today = today or timezone.localdate()
+    selling = Q()
+    for column in SALES_WINDOWS.values():
+        selling |= Q(**{f'{column}__gt': 0})
+    return Product.objects.filter(selling).update(**{
+        column: window_units(days, today) for days, column in SALES_WINDOWS.items()
+    })
+
+
+def rebuild_sales(batch_size=1000):
+    #backfill from the order history, priced at today's product prices since the lines don't keep what was paid
+    lines = ShoppingCartOrderItem.objects.filter(
+        ordered=True,
+        shoppingcartorder__ordered=True
+    ).values_list('item_id', 'quantity', 'item__price', 'item__discount_price', 'shoppingcartorder__ordered_date')
+
+    buckets = defaultdict(lambda: [0, Decimal('0')])
+    for product_id, quantity, price, discount_price, ordered_date in lines.iterator(chunk_size=batch_size):
+        bucket = buckets[(product_id, timezone.localdate(ordered_date))]
+        bucket[0] += quantity
+        bucket[1] += line_revenue(quantity, price, discount_price)
+
+    today = timezone.localdate()
+    fields = ['units_sold', 'revenue'] + list(SALES_WINDOWS.values())
+    products = {}
+    for (product_id, day), (units, revenue) in buckets.items():
+        product = products.get(product_id)
+        if product is None:
+            product = products[product_id] = Product(pk=product_id, **{field: 0 for field in fields})
+        product.units_sold += units
+        product.revenue += revenue
+        for days, column in SALES_WINDOWS.items():
+            if day > today - timedelta(days=days):
+                setattr(product, column, getattr(product, column) + units)
+
+    ProductSalesDay.objects.all().delete()
+    ProductSalesDay.objects.bulk_create(
+        [ProductSalesDay(product_id=product_id, day=day, units=units, revenue=revenue)
+         for (product_id, day), (units, revenue) in buckets.items()],
+        batch_size=batch_size
+    )
+    Product.objects.update(**{field: 0 for field in fields})
+    Product.objects.bulk_update(products.values(), fields, batch_size=batch_size)
+    return len(buckets), len(products)
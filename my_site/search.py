@@ -0,0 +1,152 @@
+from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
+from django.core.paginator import Paginator
+from django.db import connection
+from django.db.models import F, OuterRef, Subquery
+
+from .models import Artist, Product
+
+import re
+import threading
+from collections import defaultdict
+
+
+SEARCH_CONFIG = 'english'
+
+#same weights postgres uses by default for A, B, C and D
+FIELD_WEIGHTS = (
+    ('name', 'A', 1.0),
+    ('artist_name', 'B', 0.4),
+    ('school', 'C', 0.2),
+    ('history', 'D', 0.1),
+)
+
+
+def search_vector_expression():
+    #the artist name is pulled in with a subquery because update() can't follow the foreign key
+    artist_name = Subquery(Artist.objects.filter(pk=OuterRef('artist_id')).values('name')[:1])
+    vector = SearchVector('name', weight='A', config=SEARCH_CONFIG)
+    vector += SearchVector(artist_name, weight='B', config=SEARCH_CONFIG)
+    vector += SearchVector('school', weight='C', config=SEARCH_CONFIG)
+    vector += SearchVector('history', weight='D', config=SEARCH_CONFIG)
+    return vector
+
+
+class PostgresSearchBackend:
+    #reads the stored, GIN indexed Product.search_vector and lets the database rank and page the matches
+
+    def search(self, q, page_number=1, per_page=9):
+        query = SearchQuery(q, config=SEARCH_CONFIG)
+        results = Product.objects.filter(search_vector=query).annotate(
+            rank=SearchRank(F('search_vector'), query, cover_density=True)
+        ).order_by('-rank', 'id').defer('search_vector')
+        return Paginator(results, per_page).get_page(page_number)
+
+    def update_products(self, queryset):
+        queryset.update(search_vector=search_vector_expression())
+
+    def update_product(self, product):
+        self.update_products(Product.objects.filter(pk=product.pk))
+
+    def update_artist(self, artist):
+        self.update_products(Product.objects.filter(artist=artist))
+
+    def remove_product(self, product_id):
+        pass
+
+    def clear(self):
+        pass
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+class InMemorySearchBackend:
+    #inverted index kept in the process, for SQLite setups and tests where there is no tsvector support
+    #it is built from the database on the first search and kept current by the same signals as the postgres backend
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = None
+        self.documents = {}
+
+    def build(self):
+        self.index = defaultdict(dict)
+        self.documents = {}
+        rows = Product.objects.values_list('id', 'name', 'artist__name', 'school', 'history')
+        for product_id, name, artist_name, school, history in rows.iterator():
+            self.add_document(product_id, (name, artist_name, school, history))
+
+    def add_document(self, product_id, values):
+        scores = defaultdict(float)
+        for (field, label, weight), value in zip(FIELD_WEIGHTS, values):
+            for token in tokenize(value):
+                scores[token] += weight
+        for token, score in scores.items():
+            self.index[token][product_id] = score
+        self.documents[product_id] = list(scores)
+
+    def drop_document(self, product_id):
+        for token in self.documents.pop(product_id, []):
+            postings = self.index.get(token)
+            if postings is not None:
+                postings.pop(product_id, None)
+                if not postings:
+                    del self.index[token]
+
+    def clear(self):
+        with self.lock:
+            self.index = None
+            self.documents = {}
+
+    def ensure_built(self):
+        if self.index is None:
+            self.build()
+
+    def search(self, q, page_number=1, per_page=9):
+        tokens = tokenize(q)
+        with self.lock:
+            self.ensure_built()
+            ranked = []
+            if tokens:
+                #every term has to match, like plainto_tsquery
+                postings = [self.index.get(token, {}) for token in tokens]
+                postings.sort(key=len)
+                for product_id in postings[0]:
+                    if all(product_id in posting for posting in postings[1:]):
+                        ranked.append((-sum(posting[product_id] for posting in postings), product_id))
+            ranked.sort()
+        page = Paginator([product_id for score, product_id in ranked], per_page).get_page(page_number)
+        products = Product.objects.in_bulk(page.object_list)
+        page.object_list = [products[product_id] for product_id in page.object_list if product_id in products]
+        return page
+
+    def update_products(self, queryset):
+        with self.lock:
+            if self.index is None:
+                return
+            rows = queryset.values_list('id', 'name', 'artist__name', 'school', 'history')
+            for product_id, name, artist_name, school, history in rows.iterator():
+                self.drop_document(product_id)
+                self.add_document(product_id, (name, artist_name, school, history))
+
+    def update_product(self, product):
+        self.update_products(Product.objects.filter(pk=product.pk))
+
+    def update_artist(self, artist):
+        self.update_products(Product.objects.filter(artist=artist))
+
+    def remove_product(self, product_id):
+        with self.lock:
+            if self.index is not None:
+                self.drop_document(product_id)
+
+
+_backends = {}
+
+
+def get_search_backend():
+    backend_class = PostgresSearchBackend if connection.vendor == 'postgresql' else InMemorySearchBackend
+    if backend_class not in _backends:
+        _backends[backend_class] = backend_class()
+    return _backends[backend_class]
@@ -0,0 +1,78 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .catalog import bump_catalog_version, invalidate_product_counts
+from .coupons import coupon_cache
+from .images import schedule_renditions
+from .models import Artist, Coupon, Product, Review
+from .search import get_search_backend
+
+
+@receiver(pre_save, sender=Review)
+def remember_previous_rating(sender, instance, **kwargs):
+    #an edit has to take the old rating back out of the aggregates before the new one goes in
+    instance._previous_rating = None
+    if instance.pk:
+        instance._previous_rating = Review.objects.filter(pk=instance.pk).values('product_id', 'rating').first()
+
+
+@receiver(post_save, sender=Review)
+def add_review_rating(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_previous_rating', None)
+    if previous and previous['product_id']:
+        Product.apply_rating(previous['product_id'], previous['rating'], sign=-1)
+    if instance.product_id:
+        Product.apply_rating(instance.product_id, instance.rating)
+
+
+@receiver(post_delete, sender=Review)
+def remove_review_rating(sender, instance, **kwargs):
+    if instance.product_id:
+        Product.apply_rating(instance.product_id, instance.rating, sign=-1)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    invalidate_product_counts()
+    if not raw:
+        get_search_backend().update_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    invalidate_product_counts()
+    get_search_backend().remove_product(instance.pk)
+
+
+@receiver(post_save, sender=Product)
+def render_product_image(sender, instance, raw=False, **kwargs):
+    #renditions that are already newer than the upload are skipped by the worker
+    if instance.image and not raw:
+        name = instance.image.name
+        transaction.on_commit(lambda: schedule_renditions(name))
+
+
+@receiver(post_save, sender=Artist)
+def reindex_artist_products(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().update_artist(instance)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Artist)
+@receiver(post_delete, sender=Artist)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def expire_catalog_pages(sender, **kwargs):
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Coupon)
+@receiver(post_delete, sender=Coupon)
+def expire_cached_coupons(sender, **kwargs):
+    #the code may have changed as well, so the whole process cache goes
+    coupon_cache.clear()
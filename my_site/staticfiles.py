@@ -0,0 +1,77 @@
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+#already compressed, gzip or brotli would only make them bigger
+INCOMPRESSIBLE_EXTENSIONS = ('.gz', '.br', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.woff', '.woff2', '.zip')
+
+#what is left of a file after compression has to save at least this much to be worth keeping
+MIN_COMPRESSION_SAVING = 0.05
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content, quality=11)
+    #mtime=0 keeps the output identical between builds
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+
+def available_encodings():
+    return ('br', 'gzip') if brotli else ('gzip',)
+
+
+ENCODING_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    #collectstatic writes content hashed names plus .gz and, when brotli is installed, .br siblings of them
+    #the missing manifest is tolerated so that templates still render before the first collectstatic
+    manifest_strict = False
+
+    def stored_name(self, name):
+        try:
+            return super().stored_name(name)
+        except ValueError:
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = {}
+        for name, hashed_name, processed in super().post_process(paths, dry_run=dry_run, **options):
+            if processed and not isinstance(processed, Exception):
+                #the css passes can yield the same file more than once, the last name is the one in the manifest
+                hashed_names[name] = hashed_name
+            yield name, hashed_name, processed
+        if dry_run:
+            return
+        for hashed_name in hashed_names.values():
+            for compressed_name in self.compress_file(hashed_name):
+                yield hashed_name, compressed_name, True
+
+    def compress_file(self, name):
+        if name.lower().endswith(INCOMPRESSIBLE_EXTENSIONS):
+            return
+        with self.open(name) as original:
+            content = original.read()
+        for encoding in available_encodings():
+            compressed = compress(content, encoding)
+            if len(compressed) > len(content) * (1 - MIN_COMPRESSION_SAVING):
+                continue
+            compressed_name = name + ENCODING_EXTENSIONS[encoding]
+            if self.exists(compressed_name):
+                self.delete(compressed_name)
+            self._save(compressed_name, ContentFile(compressed))
+            yield compressed_name
+
+    def is_hashed(self, name):
+        #only names that came out of the manifest are safe to cache forever
+        if not hasattr(self, '_hashed_names'):
+            self._hashed_names = set(self.hashed_files.values())
+        return name in self._hashed_names
+
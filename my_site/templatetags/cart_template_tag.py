@@ -1,13 +1,19 @@
 from django import template
-from my_site.models import ShoppingCartOrder
+from my_site.cart import get_cart_summary
 
 register = template.Library()
 
 @register.filter
 def cart_item_count(user):
     if user.is_authenticated:
-        qs = ShoppingCartOrder.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
+        return get_cart_summary(user)['count']
     else:
-        return 0
\ No newline at end of file
+        return 0
+
+
+@register.filter
+def cart_subtotal(user):
+    if user.is_authenticated:
+        return get_cart_summary(user)['subtotal']
+    else:
+        return 0
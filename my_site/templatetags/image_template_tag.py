@@ -0,0 +1,33 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+from my_site.images import available_renditions
+
+register = template.Library()
+
+#what share of the viewport a product card takes, matches the col-sm-4 grid
+CARD_SIZES = '(min-width: 576px) 33vw, 100vw'
+
+
+def srcset(renditions):
+    return ', '.join(f'{url} {width}w' for width, url in renditions)
+
+
+@register.simple_tag
+def responsive_image(image, alt='', css_class='', sizes=CARD_SIZES, lazy=True):
+    #a <picture> with WebP and JPEG srcsets, falls back to the original upload until the renditions exist
+    if not image:
+        return ''
+    loading = 'lazy' if lazy else 'eager'
+    renditions = available_renditions(image.name)
+    jpegs = renditions.get('jpg')
+    if not jpegs:
+        return format_html('<img src="{}" class="{}" alt="{}" loading="{}">', image.url, css_class, alt, loading)
+
+    sources = format_html_join(
+        '', '<source type="image/webp" srcset="{}" sizes="{}">',
+        [(srcset(renditions['webp']), sizes)] if renditions.get('webp') else []
+    )
+    return format_html(
+        '<picture>{}<img src="{}" srcset="{}" sizes="{}" class="{}" alt="{}" loading="{}" decoding="async"></picture>',
+        sources, jpegs[0][1], srcset(jpegs), sizes, css_class, alt, loading
+    )
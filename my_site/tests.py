@@ -1,3 +1,1400 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.test.signals import template_rendered
+from django.test import TestCase, TransactionTestCase, RequestFactory, AsyncClient, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
 
-# Create your tests here.
+from datetime import timedelta
+from PIL import Image
+from decimal import Decimal
+from io import StringIO
+import csv
+import os
+import tempfile
+import threading
+from unittest import mock, skipIf
+
+from . import benchmark, cart
+from .cart import get_cart_summary
+from .checkout import finalize_order
+from .coupons import CouponCache, CouponError, apply_coupon, coupon_cache, get_coupon, redeem_coupon
+from .forms import ReviewForm
+from .catalog import catalog_cache_stats, get_product_counts, get_recommendations
+from .images import MISSING_RENDITIONS_TIMEOUT, build_renditions, rendition_name, renditions_key, schedule_renditions
+from .search import InMemorySearchBackend, get_search_backend
+from .payments import FakeGateway, PaymentError, get_payment_gateway
+from .recommendations import build_recommendations
+from .refunds import STALE_CLAIM, process_refunds
+from .sales import record_sales, roll_sales_windows
+from .metrics import registry
+from .models import (Address, Artist, Coupon, Payment, Product, ProductRecommendation, ProductSalesDay, PurchasedProduct,
+                     Refund, Review, ShoppingCartOrder, ShoppingCartOrderItem)
+
+
+def make_product(name, price=10, **kwargs):
+    fields = {
+        'shortened_name': name,
+        'history': 'Some history',
+        'school': 'France',
+        'image': 'images/test.jpg'
+    }
+    fields.update(kwargs)
+    return Product.objects.create(name=name, price=price, **fields)
+
+
+def make_cart(user, products, ordered=False):
+    order = ShoppingCartOrder.objects.create(user=user, ordered_date=timezone.now(), ordered=ordered)
+    for product in products:
+        order_item = ShoppingCartOrderItem.objects.create(user=user, item=product, ordered=ordered)
+        order.items.add(order_item)
+    return order
+
+
+class CartSummaryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.products = [make_product(f'painting {i}', price=10 + i) for i in range(3)]
+        make_cart(self.user, self.products)
+
+    def render_nav_bar(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return render_to_string('includes/nav_bar.html', {'user': user}, request=request)
+
+    def test_summary_counts_lines_and_subtotal(self):
+        summary = get_cart_summary(self.user)
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['subtotal'], 33)
+
+    def test_nav_bar_is_query_free_on_warm_cache(self):
+        self.render_nav_bar(User.objects.get(pk=self.user.pk))
+
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            html = self.render_nav_bar(user)
+        self.assertIn('>3</span>', html)
+
+    def test_mixed_cart_renders_the_nav_bar(self):
+        order = ShoppingCartOrder.objects.get(user=self.user, ordered=False)
+        order.items.add(ShoppingCartOrderItem.objects.create(
+            user=self.user, item=make_product('discounted painting', price=50, discount_price=40.5)))
+        self.client.force_login(self.user)
+        response = self.client.get('/')
+        self.assertContains(response, '>4</span>')
+        self.assertEqual(get_cart_summary(User.objects.get(pk=self.user.pk))['subtotal'], Decimal('73.50'))
+
+    def test_cart_views_invalidate_summary(self):
+        self.client.force_login(self.user)
+        self.assertEqual(get_cart_summary(User.objects.get(pk=self.user.pk))['count'], 3)
+
+        extra = make_product('another painting')
+        self.client.get(reverse('add_to_cart', args=[extra.slug]))
+        self.assertEqual(get_cart_summary(User.objects.get(pk=self.user.pk))['count'], 4)
+
+        self.client.get(reverse('remove_from_cart', args=[extra.slug]))
+        self.assertEqual(get_cart_summary(User.objects.get(pk=self.user.pk))['count'], 3)
+
+
+class ActiveOrderQueryCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [make_product(f'painting {i}', price=10 + i) for i in range(30)]
+
+    def count_queries(self, lines, url_name, **kwargs):
+        user = User.objects.create_user(f'buyer{lines}', password='secret-pass')
+        order = make_cart(user, self.products[:lines])
+        order.coupon = Coupon.objects.create(code=f'TEN{lines}', amount=10)
+        order.billing_address = Address.objects.create(
+            user=user, street_address='1 Main St', apartment='', country='US', zip_code='12345', address_type='B')
+        order.save()
+
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(url_name, kwargs=kwargs))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_order_summary_query_count_is_constant(self):
+        self.assertEqual(self.count_queries(1, 'order_summary'), self.count_queries(30, 'order_summary'))
+
+    def test_checkout_query_count_is_constant(self):
+        self.assertEqual(self.count_queries(1, 'checkout'), self.count_queries(30, 'checkout'))
+
+    def test_payment_query_count_is_constant(self):
+        self.assertEqual(
+            self.count_queries(1, 'payment', payment_option='stripe'),
+            self.count_queries(30, 'payment', payment_option='stripe'))
+
+
+class MyOrdersPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [make_product(f'painting {i}') for i in range(3)]
+
+    def make_orders(self, user, count):
+        now = timezone.now()
+        for i in range(count):
+            order = make_cart(user, self.products, ordered=True)
+            ShoppingCartOrder.objects.filter(pk=order.pk).update(ordered_date=now - timedelta(days=i))
+
+    def count_queries(self, orders):
+        user = User.objects.create_user(f'buyer{orders}', password='secret-pass')
+        self.make_orders(user, orders)
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('my_orders'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_history(self):
+        self.assertEqual(self.count_queries(10), self.count_queries(40))
+
+    def test_pages_walk_forwards_and_backwards(self):
+        user = User.objects.create_user('buyer', password='secret-pass')
+        self.make_orders(user, 20)
+        self.client.force_login(user)
+
+        first = self.client.get(reverse('my_orders')).context['page']
+        self.assertFalse(first.has_previous)
+        self.assertTrue(first.has_next)
+
+        second = self.client.get(reverse('my_orders'), {'after': first.next_cursor}).context['page']
+        self.assertEqual(len(second), 9)
+        self.assertTrue(set(o.pk for o in first).isdisjoint(o.pk for o in second))
+
+        third = self.client.get(reverse('my_orders'), {'after': second.next_cursor}).context['page']
+        self.assertEqual(len(third), 2)
+        self.assertFalse(third.has_next)
+
+        back = self.client.get(reverse('my_orders'), {'before': second.previous_cursor}).context['page']
+        self.assertEqual([o.pk for o in back], [o.pk for o in first])
+
+
+class RatingAggregateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('reviewer', password='secret-pass')
+        self.product = make_product('painting')
+
+    def review(self, rating):
+        return Review.objects.create(user=self.user, product=self.product, rating=Decimal(rating), comment='A lovely painting')
+
+    def test_create_edit_and_delete_update_aggregates(self):
+        first = self.review('4.5')
+        self.review('2.0')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_count, 2)
+        self.assertEqual(self.product.rating_sum, Decimal('6.5'))
+        self.assertEqual(self.product.average_rating, Decimal('3.3'))
+        self.assertEqual(self.product.rating_histogram, {1: 0, 2: 1, 3: 0, 4: 0, 5: 1})
+
+        first.rating = Decimal('1.0')
+        first.save()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_sum, Decimal('3.0'))
+        self.assertEqual(self.product.rating_histogram, {1: 1, 2: 1, 3: 0, 4: 0, 5: 0})
+
+        first.delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_count, 1)
+        self.assertEqual(self.product.rating_histogram, {1: 0, 2: 1, 3: 0, 4: 0, 5: 0})
+
+    def test_rebuild_ratings_command(self):
+        self.review('3.0')
+        self.review('5.0')
+        Product.objects.update(rating_count=0, rating_sum=0, rating_3=0, rating_5=0)
+
+        call_command('rebuild_ratings', stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.rating_count, 2)
+        self.assertEqual(self.product.rating_sum, Decimal('8.0'))
+        self.assertEqual(self.product.rating_histogram, {1: 0, 2: 0, 3: 1, 4: 0, 5: 1})
+
+
+class InMemorySearchTests(TestCase):
+    def setUp(self):
+        self.backend = InMemorySearchBackend()
+        self.monet = Artist.objects.create(name='Claude Monet')
+        self.water_lilies = make_product('Water Lilies', artist=self.monet)
+        self.poppies = make_product('Poppies', artist=self.monet, history='Painted near water')
+
+    def test_ranks_name_matches_above_history_matches(self):
+        results = self.backend.search('water')
+        self.assertEqual(list(results), [self.water_lilies, self.poppies])
+
+    def test_requires_every_term(self):
+        self.assertEqual(list(self.backend.search('monet poppies')), [self.poppies])
+        self.assertEqual(list(self.backend.search('monet tulips')), [])
+
+    def test_results_are_paginated(self):
+        for i in range(12):
+            make_product(f'landscape {i}')
+        first = self.backend.search('landscape', 1, per_page=9)
+        second = self.backend.search('landscape', 2, per_page=9)
+        self.assertEqual(first.paginator.count, 12)
+        self.assertEqual(len(second), 3)
+
+    def test_index_follows_product_and_artist_changes(self):
+        self.backend.search('monet')
+        self.backend.update_product(make_product('Haystacks', artist=self.monet))
+        self.assertEqual(self.backend.search('haystacks monet').paginator.count, 1)
+
+        self.monet.name = 'Oscar-Claude Monet'
+        self.monet.save()
+        self.backend.update_artist(self.monet)
+        self.assertEqual(self.backend.search('oscar').paginator.count, 3)
+
+        self.backend.remove_product(self.poppies.pk)
+        self.assertEqual(list(self.backend.search('poppies')), [])
+
+    def test_search_view(self):
+        get_search_backend().clear()
+        response = self.client.get(reverse('product_search'), {'q': 'lilies'})
+        self.assertEqual(list(response.context['results']), [self.water_lilies])
+
+
+class AllProductPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i in range(25):
+            make_product(f'painting {i}', price=100 - i, school='Italy' if i % 5 == 0 else 'France')
+
+    def walk(self, sort):
+        seen = []
+        params = {'sort': sort}
+        while True:
+            response = self.client.get(reverse('all_products', kwargs={'school': 'all'}), params)
+            page = response.context['page_obj']
+            seen.extend(product.pk for product in page)
+            if not page.has_next:
+                return seen
+            params = {'sort': sort, 'after': page.next_cursor}
+
+    def test_cursor_pages_cover_catalog_in_order(self):
+        by_id = self.walk('default')
+        self.assertEqual(by_id, sorted(by_id))
+        self.assertEqual(len(by_id), 25)
+
+        by_price = self.walk('price')
+        self.assertEqual(by_price, list(Product.objects.order_by('price', 'id').values_list('id', flat=True)))
+
+    def test_deep_pages_cost_the_same_as_the_first(self):
+        #logged in so the anonymous page cache stays out of the way
+        self.client.force_login(User.objects.create_user('browser', password='secret-pass'))
+        url = reverse('all_products', kwargs={'school': 'all'})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as first:
+            page = self.client.get(url).context['page_obj']
+        second = self.client.get(url, {'after': page.next_cursor}).context['page_obj']
+        with CaptureQueriesContext(connection) as deep:
+            self.client.get(url, {'after': second.next_cursor})
+        self.assertEqual(len(first), len(deep))
+
+    def test_school_counts_are_cached_and_invalidated(self):
+        self.assertEqual(get_product_counts()['Italy'], 5)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_product_counts()['all'], 25)
+
+        make_product('new painting', school='Italy')
+        self.assertEqual(get_product_counts()['Italy'], 6)
+
+
+class CatalogPageCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = make_product('painting')
+        self.url = reverse('product', args=[self.product.slug])
+
+    def test_anonymous_pages_are_served_from_cache(self):
+        hits = catalog_cache_stats.as_dict()['hits']
+        first = self.client.get(self.url)
+        with self.assertNumQueries(0):
+            second = self.client.get(self.url)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(catalog_cache_stats.as_dict()['hits'], hits + 1)
+
+    def test_edits_are_visible_straight_away(self):
+        self.client.get(self.url)
+        self.product.history = 'Freshly restored'
+        self.product.save()
+        self.assertContains(self.client.get(self.url), 'Freshly restored')
+
+    def test_logged_in_users_are_not_cached(self):
+        self.client.force_login(User.objects.create_user('buyer', password='secret-pass'))
+        misses = catalog_cache_stats.as_dict()['misses']
+        self.client.get(self.url)
+        self.client.get(self.url)
+        self.assertEqual(catalog_cache_stats.as_dict()['misses'], misses)
+
+
+class CartServiceTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.product = make_product('painting')
+
+    def line(self):
+        return ShoppingCartOrderItem.objects.get(user=self.user, item=self.product, ordered=False)
+
+    def test_add_and_remove(self):
+        self.assertEqual(cart.add_item(self.user, self.product), cart.ADDED)
+        self.assertEqual(cart.add_item(self.user, self.product), cart.UPDATED)
+        self.assertEqual(self.line().quantity, 2)
+
+        self.assertEqual(cart.remove_single_item(self.user, self.product), cart.UPDATED)
+        self.assertEqual(self.line().quantity, 1)
+        self.assertEqual(cart.remove_single_item(self.user, self.product), cart.REMOVED)
+        self.assertFalse(ShoppingCartOrderItem.objects.exists())
+        self.assertEqual(cart.remove_item(self.user, self.product), cart.NOT_IN_CART)
+
+        cart.add_item(self.user, self.product)
+        self.assertEqual(ShoppingCartOrder.objects.get(user=self.user, ordered=False).items.get(), self.line())
+
+    def test_mutations_take_at_most_two_statements(self):
+        cart.add_item(self.user, self.product)
+        cart.add_item(self.user, self.product)
+        for mutate in (cart.add_item, cart.remove_single_item, cart.remove_item):
+            with CaptureQueriesContext(connection) as queries:
+                mutate(self.user, self.product)
+            statements = [q for q in queries if not q['sql'].startswith(('SAVEPOINT', 'RELEASE SAVEPOINT'))]
+            self.assertLessEqual(len(statements), 2, mutate.__name__)
+
+    def test_removing_a_line_takes_its_link_rows_with_it(self):
+        cart.add_item(self.user, self.product)
+        other = make_product('sculpture')
+        cart.add_item(self.user, other)
+        self.assertEqual(cart.remove_single_item(self.user, self.product), cart.REMOVED)
+        order = ShoppingCartOrder.objects.get(user=self.user, ordered=False)
+        self.assertEqual(list(order.items.values_list('item_id', flat=True)), [other.id])
+        self.assertEqual(ShoppingCartOrder.items.through.objects.count(), 1)
+
+
+@skipIf(connection.vendor == 'sqlite', 'the in-memory SQLite test database locks whole tables, run this against postgres')
+class CartConcurrencyTests(TransactionTestCase):
+    threads = 8
+    clicks = 10
+
+    def test_concurrent_adds_lose_no_updates(self):
+        user = User.objects.create_user('buyer', password='secret-pass')
+        product = make_product('painting')
+        errors = []
+
+        def click():
+            try:
+                for i in range(self.clicks):
+                    cart.add_item(user, product)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=click) for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(ShoppingCartOrder.objects.filter(user=user, ordered=False).count(), 1)
+        line = ShoppingCartOrderItem.objects.get(user=user, item=product, ordered=False)
+        self.assertEqual(line.quantity, self.threads * self.clicks)
+
+    def test_concurrent_add_and_remove_leave_no_orphaned_line(self):
+        user = User.objects.create_user('buyer', password='secret-pass')
+        product = make_product('painting')
+        errors = []
+
+        def click(mutate):
+            try:
+                for i in range(self.clicks):
+                    mutate(user, product)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=click, args=(mutate,))
+                   for i in range(self.threads // 2) for mutate in (cart.add_item, cart.remove_single_item)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        #every open line is still linked to the open cart
+        orphaned = ShoppingCartOrderItem.objects.filter(user=user, ordered=False, shoppingcartorder__isnull=True)
+        self.assertFalse(orphaned.exists())
+
+
+@skipIf(connection.vendor == 'sqlite', 'the in-memory SQLite test database locks whole tables, run this against postgres')
+class CouponConcurrencyTests(TransactionTestCase):
+    threads = 16
+
+    def test_parallel_redemptions_never_exceed_the_limit(self):
+        coupon = Coupon.objects.create(code='FLASH', amount=5, max_uses=5)
+        redeemed = []
+        errors = []
+        start = threading.Barrier(self.threads)
+
+        def redeem():
+            try:
+                start.wait()
+                redeemed.append(redeem_coupon(coupon))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=redeem) for i in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(redeemed.count(True), 5)
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.used, 5)
+
+
+@skipIf(connection.vendor == 'sqlite', 'SQLite has no SELECT ... FOR UPDATE SKIP LOCKED, run this against postgres')
+class RefundConcurrencyTests(TransactionTestCase):
+    def test_parallel_processors_pay_each_refund_once(self):
+        user = User.objects.create_user('buyer')
+        for i in range(20):
+            order = ShoppingCartOrder.objects.create(
+                user=user, ordered=True, ordered_date=timezone.now(), refund_requested=True,
+                payment=Payment.objects.create(stripe_charge_id=f'ch_{i}', user=user, amount=10))
+            Refund.objects.create(order=order, reason='damaged', email='buyer@example.com', accepted=True)
+        gateway = FakeGateway(latency=0.01)
+        errors = []
+
+        def run():
+            try:
+                process_refunds(batch_size=3, workers=2, gateway=gateway)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=run) for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Refund.objects.filter(status='S', attempts=1).count(), 20)
+        self.assertEqual(len(gateway.refunds), 20)
+
+
+class CheckoutFinalizationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.products = [make_product(f'painting {i}') for i in range(30)]
+
+    def make_order(self, name, lines):
+        user = User.objects.create_user(name, password='secret-pass')
+        make_cart(user, self.products[:lines])
+        return user, cart.get_active_order(user)
+
+    def test_finalize_flips_order_and_items(self):
+        user, order = self.make_order('buyer', 3)
+        payment, created = finalize_order(order, user, 'ch_1', order.get_total(), 'key-1')
+        self.assertTrue(created)
+
+        order.refresh_from_db()
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment, payment)
+        self.assertEqual(len(order.ref_code), 20)
+        self.assertFalse(ShoppingCartOrderItem.objects.filter(user=user, ordered=False).exists())
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        counts = []
+        for lines in (1, 30):
+            user, order = self.make_order(f'buyer{lines}', lines)
+            with CaptureQueriesContext(connection) as queries:
+                finalize_order(order, user, 'ch', order.get_total(), f'key-{lines}')
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    @mock.patch('my_site.payments.stripe.Charge.create', return_value={'id': 'ch_1'})
+    def test_double_submit_charges_and_records_once(self, charge):
+        user, order = self.make_order('buyer', 2)
+        self.client.force_login(user)
+        url = reverse('payment', kwargs={'payment_option': 'stripe'})
+        for i in range(2):
+            response = self.client.post(url, {'stripeToken': 'tok', 'idempotency_key': 'same-form'})
+            self.assertRedirects(response, '/', fetch_redirect_response=False)
+
+        self.assertEqual(charge.call_count, 1)
+        self.assertEqual(charge.call_args.kwargs['idempotency_key'], 'same-form')
+        self.assertEqual(Payment.objects.filter(user=user).count(), 1)
+        self.assertTrue(ShoppingCartOrder.objects.get(pk=order.pk).ordered)
+
+    def test_second_payment_form_for_the_same_cart_counts_nothing(self):
+        user, order = self.make_order('buyer', 2)
+        first, created = finalize_order(order, user, 'ch_1', order.get_total(), 'key-1')
+        counters = list(Product.objects.order_by('id').values_list('units_sold', 'units_sold_7d', 'units_sold_30d', 'revenue'))
+        buckets = list(ProductSalesDay.objects.order_by('id').values_list('units', 'revenue'))
+
+        self.assertEqual(finalize_order(order, user, 'ch_2', order.get_total(), 'key-2'), (first, False))
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(list(Product.objects.order_by('id').values_list('units_sold', 'units_sold_7d', 'units_sold_30d', 'revenue')), counters)
+        self.assertEqual(list(ProductSalesDay.objects.order_by('id').values_list('units', 'revenue')), buckets)
+        self.assertEqual(PurchasedProduct.objects.count(), 2)
+
+    def test_retried_finalize_returns_first_payment(self):
+        user, order = self.make_order('buyer', 2)
+        first, created = finalize_order(order, user, 'ch_1', order.get_total(), 'key-1')
+        self.assertEqual(finalize_order(order, user, 'ch_1', order.get_total(), 'key-1'), (first, False))
+        self.assertEqual(Payment.objects.count(), 1)
+
+
+@override_settings(PAYMENT_GATEWAY={'BACKEND': 'my_site.payments.FakeGateway', 'OPTIONS': {'failure_rate': 0}})
+class FakeGatewayCheckoutTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.order = make_cart(self.user, [make_product('painting')])
+
+    def pay(self, client, url_name, key):
+        return client.post(
+            reverse(url_name, kwargs={'payment_option': 'stripe'}),
+            urlencode({'stripeToken': 'tok', 'idempotency_key': key}),
+            content_type='application/x-www-form-urlencoded')
+
+    async def apay(self, client, url_name, key):
+        return await self.pay(client, url_name, key)
+
+    def test_sync_checkout(self):
+        self.client.force_login(self.user)
+        self.pay(self.client, 'payment', 'key-1')
+        self.assertTrue(ShoppingCartOrder.objects.get(pk=self.order.pk).ordered)
+        self.assertIn('key-1', get_payment_gateway().charges)
+
+    def test_async_checkout(self):
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        self.client.force_login(self.user)
+        response = async_to_sync(self.apay)(client, 'payment_async', 'key-2')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(ShoppingCartOrder.objects.get(pk=self.order.pk).ordered)
+
+    def test_async_checkout_stays_async_through_the_middleware(self):
+        client = AsyncClient()
+        client.cookies = self.client.cookies
+        self.client.force_login(self.user)
+        #any middleware that can't run async makes django wrap the rest of the stack in async_to_sync
+        with mock.patch('django.core.handlers.base.async_to_sync', side_effect=async_to_sync) as adapted:
+            response = async_to_sync(self.apay)(client, 'payment_async', 'key-4')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(adapted.call_count, 0)
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertTrue(ShoppingCartOrder.objects.get(pk=self.order.pk).ordered)
+
+    def test_second_payment_form_for_a_paid_cart_is_refunded(self):
+        self.client.force_login(self.user)
+        gateway = get_payment_gateway()
+        charge = gateway.charge
+
+        def other_tab_finishes_first(amount, currency, source, idempotency_key):
+            #the checkout in the other tab completes while this charge is in flight
+            finalize_order(cart.get_active_order(self.user), self.user, 'ch_first', 10, 'key-a')
+            return charge(amount, currency, source, idempotency_key)
+
+        with mock.patch.object(gateway, 'charge', side_effect=other_tab_finishes_first):
+            response = self.pay(self.client, 'payment', 'key-b')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Payment.objects.get().stripe_charge_id, 'ch_first')
+        self.assertEqual(gateway.refunds['refund-key-b'][1], gateway.charges['key-b'][0])
+
+    def test_resubmitted_form_is_not_refunded(self):
+        self.client.force_login(self.user)
+        self.pay(self.client, 'payment', 'key-c')
+        #the resubmit slips past the early check and charges again under the same key
+        with mock.patch('my_site.views.find_finalized_payment', return_value=None), \
+                mock.patch.object(cart.DatabaseCartBackend, 'get_active_order', return_value=self.order):
+            self.pay(self.client, 'payment', 'key-c')
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertNotIn('refund-key-c', get_payment_gateway().refunds)
+
+    def test_coupon_used_up_during_the_charge_is_refunded(self):
+        coupon = Coupon.objects.create(code='SPRING', amount=5, max_uses=1, used=1)
+        ShoppingCartOrder.objects.filter(pk=self.order.pk).update(coupon=coupon)
+        self.client.force_login(self.user)
+        #the early check still saw a use left
+        with mock.patch('my_site.views.used_up', return_value=False):
+            response = self.pay(self.client, 'payment', 'key-5')
+        self.assertRedirects(response, reverse('checkout'), fetch_redirect_response=False)
+        order = ShoppingCartOrder.objects.get(pk=self.order.pk)
+        self.assertEqual((order.ordered, order.coupon), (False, None))
+        self.assertFalse(Payment.objects.exists())
+        self.assertIn('refund-key-5', get_payment_gateway().refunds)
+
+    def test_failed_refund_of_a_used_up_coupon_is_logged(self):
+        coupon = Coupon.objects.create(code='SPRING', amount=5, max_uses=1, used=1)
+        ShoppingCartOrder.objects.filter(pk=self.order.pk).update(coupon=coupon)
+        self.client.force_login(self.user)
+        with mock.patch('my_site.views.used_up', return_value=False), \
+                mock.patch.object(get_payment_gateway(), 'refund', side_effect=PaymentError('Network Error')), \
+                self.assertLogs('my_site.payments', 'ERROR') as logs:
+            response = self.pay(self.client, 'payment', 'key-6')
+        self.assertRedirects(response, reverse('checkout'), fetch_redirect_response=False)
+        self.assertIn(get_payment_gateway().charges['key-6'][0], logs.output[0])
+        self.assertFalse(ShoppingCartOrder.objects.get(pk=self.order.pk).ordered)
+
+    def test_gateway_rejects_a_key_reused_across_endpoints(self):
+        gateway = FakeGateway()
+        charge_id = gateway.charge(1000, 'usd', 'tok', 'key-7')
+        with self.assertRaisesMessage(PaymentError, 'same endpoint'):
+            gateway.refund(charge_id, idempotency_key='key-7')
+        gateway.refund(charge_id, idempotency_key='refund-key-7')
+        with self.assertRaisesMessage(PaymentError, 'same endpoint'):
+            gateway.charge(1000, 'usd', 'tok', 'refund-key-7')
+
+    @override_settings(PAYMENT_GATEWAY={'BACKEND': 'my_site.payments.FakeGateway', 'OPTIONS': {'failure_rate': 1}})
+    def test_declined_charge_leaves_order_open(self):
+        self.client.force_login(self.user)
+        response = self.pay(self.client, 'payment', 'key-3')
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        self.assertFalse(ShoppingCartOrder.objects.get(pk=self.order.pk).ordered)
+        self.assertFalse(Payment.objects.exists())
+
+
+@override_settings(CART_BACKEND='my_site.cart.CacheCartBackend')
+class CacheCartBackendTests(TestCase):
+    def setUp(self):
+        #the backend refuses a per-process cache, the file based one is shared between processes
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings_override = override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': cache_dir.name,
+        }})
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.clear()
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.painting = make_product('painting', price=10)
+        self.drawing = make_product('drawing', price=15)
+        self.client.force_login(self.user)
+
+    def test_clicks_stay_in_the_cache(self):
+        for product in (self.painting, self.painting, self.drawing):
+            self.client.get(reverse('add_to_cart', kwargs={'slug': product.slug}))
+        self.client.get(reverse('remove_single_item_from_cart', kwargs={'slug': self.painting.slug}))
+        self.assertFalse(ShoppingCartOrderItem.objects.exists())
+
+        user = User.objects.get(pk=self.user.pk)
+        self.assertEqual(get_cart_summary(user), {'count': 2, 'subtotal': Decimal('25')})
+
+    def test_checkout_pages_persist_the_cart(self):
+        backend = cart.get_cart_backend()
+        backend.add_item(self.user, self.painting)
+        backend.add_item(self.user, self.painting)
+        self.client.get(reverse('order_summary'))
+        line = ShoppingCartOrderItem.objects.get(user=self.user, ordered=False)
+        self.assertEqual((line.item, line.quantity), (self.painting, 2))
+
+        backend.remove_item(self.user, self.painting)
+        backend.add_item(self.user, self.drawing)
+        self.client.get(reverse('order_summary'))
+        order = ShoppingCartOrder.objects.get(user=self.user, ordered=False)
+        self.assertEqual([line.item for line in order.items.all()], [self.drawing])
+
+    def test_flush_carts_command(self):
+        cart.get_cart_backend().add_item(self.user, self.painting)
+        out = StringIO()
+        call_command('flush_carts', stdout=out)
+        self.assertIn('Flushed 1 carts', out.getvalue())
+        self.assertEqual(ShoppingCartOrderItem.objects.get().item, self.painting)
+
+    def test_flush_all_finds_every_dirty_cart(self):
+        backend = cart.get_cart_backend()
+        other = User.objects.create_user('other', password='secret-pass')
+        backend.add_item(self.user, self.painting)
+        backend.add_item(other, self.drawing)
+        self.assertEqual(backend.flush_all(), 2)
+        #nothing dirty, nothing read from the database
+        with self.assertNumQueries(0):
+            self.assertEqual(backend.flush_all(), 0)
+        self.assertEqual(ShoppingCartOrderItem.objects.count(), 2)
+
+    def test_clicks_wait_for_the_cart_lock(self):
+        backend = cart.get_cart_backend()
+        backend.add_item(self.user, self.painting)
+        with cart.cache_lock(backend.lock_key(self.user.pk)):
+            click = threading.Thread(target=backend.add_item, args=(self.user, self.painting))
+            click.start()
+            click.join(0.1)
+            self.assertTrue(click.is_alive())
+        click.join()
+        self.assertEqual(cache.get(backend.key(self.user.pk)), {self.painting.pk: 2})
+
+    def test_refuses_a_per_process_cache(self):
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            with self.assertRaisesMessage(ImproperlyConfigured, 'shared between processes'):
+                cart.CacheCartBackend()
+
+    def test_save_during_a_flush_keeps_the_cart_dirty(self):
+        backend = cart.get_cart_backend()
+        backend.add_item(self.user, self.painting)
+        write = backend.write
+
+        def write_then_save(user, lines):
+            write(user, lines)
+            backend.add_item(user, self.drawing)
+
+        with mock.patch.object(backend, 'write', side_effect=write_then_save):
+            backend.flush(self.user)
+        self.assertEqual(backend.flush_all(), 1)
+        self.assertEqual(set(ShoppingCartOrderItem.objects.values_list('item', flat=True)), {self.painting.pk, self.drawing.pk})
+
+    def test_checkout_clears_the_cached_cart(self):
+        backend = cart.get_cart_backend()
+        backend.add_item(self.user, self.painting)
+        order = backend.get_active_order(self.user)
+        finalize_order(order, self.user, 'ch_1', 10, 'key-1')
+        self.assertEqual(backend.compute_summary(self.user)['count'], 0)
+
+
+class ResponsiveImageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media_root = media.name
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, IMAGE_RENDITION_WORKERS=0)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(self.media_root, 'images'))
+        Image.new('RGB', (800, 600), 'blue').save(os.path.join(self.media_root, 'images', 'test.jpg'))
+        self.product = make_product('painting')
+
+    def render(self):
+        template = Template('{% load image_template_tag %}{% responsive_image product.image alt=product.name %}')
+        return template.render(Context({'product': self.product}))
+
+    def test_renditions_are_never_upscaled(self):
+        written = build_renditions(self.media_root, 'images/test.jpg')
+        self.assertEqual(sorted(written), sorted(
+            rendition_name('images/test.jpg', width, extension) for width in (320, 640) for extension in ('jpg', 'webp')))
+        with Image.open(os.path.join(self.media_root, rendition_name('images/test.jpg', 320, 'webp'))) as image:
+            self.assertEqual(image.size, (320, 240))
+        self.assertEqual(build_renditions(self.media_root, 'images/test.jpg'), [])
+
+    def test_tag_falls_back_to_the_upload(self):
+        html = self.render()
+        self.assertIn('src="/inventory_images/images/test.jpg"', html)
+        self.assertIn('loading="lazy"', html)
+        self.assertNotIn('srcset', html)
+
+    def test_tag_emits_srcsets(self):
+        self.render()
+        schedule_renditions('images/test.jpg')
+        #the build replaces the record the fallback left
+        with mock.patch('my_site.images.os.path.exists') as exists:
+            html = self.render()
+        exists.assert_not_called()
+        self.assertIn('<source type="image/webp" srcset="/inventory_images/renditions/images/test-320w.webp 320w, '
+                      '/inventory_images/renditions/images/test-640w.webp 640w"', html)
+        self.assertIn('srcset="/inventory_images/renditions/images/test-320w.jpg 320w', html)
+
+    def test_missing_renditions_are_only_remembered_briefly(self):
+        #a build may be running in another process whose record never reaches this cache
+        with mock.patch('my_site.images.cache.set') as cache_set:
+            self.assertNotIn('srcset', self.render())
+        cache_set.assert_called_once_with(renditions_key('images/test.jpg'), [], MISSING_RENDITIONS_TIMEOUT)
+
+    def test_backfill_command(self):
+        out = StringIO()
+        call_command('build_renditions', workers=1, stdout=out)
+        self.assertIn('Wrote 4 renditions for 1 images', out.getvalue())
+        self.assertIn('test-640w.webp', self.render())
+
+
+class StaticBuildTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        static_root = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(static_root.cleanup)
+        cls.settings_override = override_settings(STATIC_ROOT=static_root.name)
+        cls.settings_override.enable()
+        cls.addClassCleanup(cls.settings_override.disable)
+        call_command('build_static', verbosity=0)
+        cls.static_root = static_root.name
+
+    def test_build_output(self):
+        hashed = staticfiles_storage.stored_name('css/bootstrap.min.css')
+        self.assertNotEqual(hashed, 'css/bootstrap.min.css')
+        self.assertTrue(os.path.exists(os.path.join(self.static_root, hashed + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(self.static_root, 'css', 'bootstrap.min.css.map')))
+        self.assertFalse(os.path.exists(os.path.join(self.static_root, 'js', 'bootstrap.js')))
+
+    def test_serves_the_compressed_sibling(self):
+        hashed = staticfiles_storage.stored_name('css/bootstrap.min.css')
+        response = self.client.get('/static/' + hashed, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+
+        response = self.client.get('/static/' + hashed, HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_build_output_has_brotli_siblings(self):
+        hashed = staticfiles_storage.stored_name('css/bootstrap.min.css')
+        self.assertTrue(os.path.exists(os.path.join(self.static_root, hashed + '.br')))
+
+    def test_build_fails_without_brotli(self):
+        with mock.patch('my_site.staticfiles.brotli', None):
+            with self.assertRaisesMessage(CommandError, 'brotli is not installed'):
+                call_command('build_static', verbosity=0)
+
+    def test_unhashed_names_are_cached_briefly(self):
+        response = self.client.get('/static/css/bootstrap.min.css')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('critic', password='secret-pass')
+        self.artist = Artist.objects.create(name='Monet')
+        self.product = make_product('water lilies', artist=self.artist)
+        self.url = reverse('product', kwargs={'slug': self.product.slug})
+
+    def rendered_templates(self, **headers):
+        templates = []
+
+        def record(sender, template, **kwargs):
+            templates.append(template.name)
+
+        template_rendered.connect(record)
+        try:
+            response = self.client.get(self.url, **headers)
+        finally:
+            template_rendered.disconnect(record)
+        return response, templates
+
+    def test_revalidation_skips_rendering(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response, templates = self.rendered_templates(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(templates, [])
+
+        response, templates = self.rendered_templates(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(templates, [])
+
+    def test_review_changes_the_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        review = Review.objects.create(user=self.user, product=self.product, rating=4, comment='lovely colours')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        etag = response['ETag']
+        review.delete()
+        self.assertNotEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_listing(self):
+        url = reverse('all_products', kwargs={'school': 'all'})
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        make_product('haystacks')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_logged_in_pages_are_not_validated(self):
+        self.client.force_login(self.user)
+        response = self.client.get(self.url)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class QueryPlanTests(TestCase):
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command('check_query_plans', seed=50, stdout=out)
+        self.assertIn('hot queries use an index', out.getvalue())
+        self.assertFalse(User.objects.filter(username__startswith='plan-check-').exists())
+
+    @skipIf(connection.vendor != 'sqlite', 'checks the sqlite plan format')
+    def test_missing_index_fails(self):
+        queries = {'history text': Product.objects.filter(history='x')}
+        with mock.patch('my_site.management.commands.check_query_plans.hot_queries', return_value=queries):
+            with self.assertRaisesMessage(CommandError, 'history text'):
+                call_command('check_query_plans', seed=0, stdout=StringIO())
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+        self.product = make_product('painting')
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('product', kwargs={'slug': self.product.slug}))
+        timing = response['Server-Timing']
+        self.assertRegex(timing, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertRegex(timing, r'tpl;dur=[\d.]+')
+        #the page cache and the recommendation list
+        self.assertIn('cache;desc="hit=0 miss=2"', timing)
+        self.assertNotIn('pay;', timing)
+
+        response = self.client.get(reverse('product', kwargs={'slug': self.product.slug}))
+        self.assertIn('cache;desc="hit=1 miss=0"', response['Server-Timing'])
+
+    @override_settings(METRICS_TOKEN='scrape-me')
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('product', kwargs={'slug': self.product.slug}))
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+        response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-me')
+        body = response.content.decode()
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        self.assertIn('http_request_duration_seconds_bucket{view="product",le="+Inf"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{view="product"} 1', body)
+        self.assertIn('http_responses_total{view="product",status="200"} 1', body)
+        self.assertIn('cache_misses_total{view="product"} 2', body)
+
+
+class BenchmarkTests(TestCase):
+    def test_every_scenario_runs(self):
+        benchmark.seed(products=20, users=3, orders=4)
+        results = benchmark.run(iterations=2, warmup=0)
+        self.assertEqual(len(results), len(benchmark.scenarios()))
+        for name, result in results.items():
+            self.assertIn(result['status'], (200, 302), name)
+            self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+
+    def test_compare_flags_regressions(self):
+        baseline = {'my_orders': {'p95_ms': 10.0, 'queries': 5}}
+        self.assertEqual(benchmark.compare({'my_orders': {'p95_ms': 11.0, 'queries': 5}}, baseline), [])
+        self.assertEqual(len(benchmark.compare({'my_orders': {'p95_ms': 13.0, 'queries': 6}}, baseline)), 2)
+
+
+class CatalogImportTests(TestCase):
+    def write(self, suffix, content):
+        handle = tempfile.NamedTemporaryFile('w', suffix=suffix, delete=False)
+        handle.write(content)
+        handle.close()
+        self.addCleanup(os.unlink, handle.name)
+        return handle.name
+
+    def test_csv_upsert(self):
+        make_product('old name', shortened_name='Water Lilies', school='France')
+        path = self.write('.csv', (
+            'name,shortened_name,history,price,discount_price,school,artist\n'
+            'water lilies,Water Lilies,pond,12.50,,France,Monet\n'
+            'haystacks,Haystacks,field,20,15,France,Monet\n'
+            'broken,,no short name,5,,France,\n'
+        ))
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', path, batch_size=2, stdout=out, stderr=err)
+        self.assertIn('1 products created, 1 updated, 0 unchanged, 1 rows skipped', out.getvalue())
+        self.assertIn('row 3: missing shortened_name', err.getvalue())
+
+        lilies = Product.objects.get(slug='water-lilies')
+        self.assertEqual((lilies.name, lilies.price, lilies.artist.name), ('water lilies', Decimal('12.50'), 'Monet'))
+        self.assertEqual(Product.objects.get(slug='haystacks').artist_id, lilies.artist_id)
+        self.assertEqual(Artist.objects.count(), 1)
+        self.assertEqual(get_product_counts()['France'], 2)
+
+        out = StringIO()
+        call_command('import_catalog', path, stdout=out, stderr=StringIO())
+        self.assertIn('0 products created, 0 updated, 2 unchanged, 1 rows skipped', out.getvalue())
+
+    def test_jsonl(self):
+        path = self.write('.jsonl', (
+            '{"name": "the night watch", "shortened_name": "Night Watch", "history": "militia", "price": 99, "school": "Dutch"}\n'
+            'not json\n'
+        ))
+        out, err = StringIO(), StringIO()
+        call_command('import_catalog', path, stdout=out, stderr=err)
+        self.assertIn('1 products created, 0 updated, 0 unchanged, 1 rows skipped', out.getvalue())
+        self.assertIsNone(Product.objects.get(slug='night-watch').artist)
+
+
+class CsvExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.order = make_cart(self.user, [make_product('painting'), make_product('drawing')], ordered=True)
+        self.order.ref_code = 'ref-1'
+        self.order.coupon = Coupon.objects.create(code='SPRING', amount=5)
+        self.order.payment = Payment.objects.create(stripe_charge_id='ch_1', user=self.user, amount=15)
+        self.order.save()
+        make_cart(self.user, [])
+
+    def test_admin_action_streams_every_line(self):
+        admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret-pass')
+        self.client.force_login(admin)
+        response = self.client.post(reverse('admin:my_site_shoppingcartorder_changelist'), {
+            'action': 'export_orders_csv',
+            '_selected_action': [order.pk for order in ShoppingCartOrder.objects.all()],
+        })
+        self.assertTrue(response.streaming)
+        self.assertIn('attachment; filename="orders-', response['Content-Disposition'])
+        rows = list(csv.DictReader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual([row['product'] for row in rows[:2]], ['painting', 'drawing'])
+        self.assertEqual((rows[0]['coupon'], rows[0]['payment_amount'], rows[0]['ref_code']), ('SPRING', '15.0', 'ref-1'))
+        #the empty cart still gets a row
+        self.assertEqual(rows[2]['product'], '')
+
+    def test_command(self):
+        Refund.objects.create(order=self.order, reason='damaged', email='buyer@example.com')
+        out = StringIO()
+        call_command('export_csv', 'refunds', stdout=out)
+        rows = list(csv.DictReader(out.getvalue().splitlines()))
+        self.assertEqual((rows[0]['ref_code'], rows[0]['reason'], rows[0]['refund_granted']), ('ref-1', 'damaged', 'False'))
+
+
+class AdminChangelistTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret-pass')
+        self.client.force_login(self.admin)
+
+    def add_orders(self, count):
+        for i in range(count):
+            user = User.objects.create_user(f'buyer-{ShoppingCartOrder.objects.count()}')
+            address = Address.objects.create(user=user, street_address='1 Main St', apartment='1', country='FR',
+                                             zip_code=f'7500{i}', address_type='B', default=True)
+            ShoppingCartOrder.objects.create(
+                user=user, ordered=True, ordered_date=timezone.now(), billing_address=address, shipping_address=address,
+                payment=Payment.objects.create(stripe_charge_id=f'ch_{user.pk}', user=user, amount=10),
+                coupon=Coupon.objects.create(code=f'C{user.pk}', amount=1))
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(queries)
+
+    def test_order_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse('admin:my_site_shoppingcartorder_changelist')
+        self.add_orders(1)
+        few = self.count_queries(url)
+        self.add_orders(5)
+        self.assertEqual(self.count_queries(url), few)
+
+    def test_address_search_by_zip_code(self):
+        self.add_orders(2)
+        response = self.client.get(reverse('admin:my_site_address_changelist'), {'q': '75001'})
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+
+class PurchaseIndexTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.products = [make_product(f'painting {i}') for i in range(3)]
+
+    def buy(self, products):
+        make_cart(self.user, products)
+        order = cart.get_active_order(self.user)
+        finalize_order(order, self.user, f'ch_{order.pk}', order.get_total(), f'key-{order.pk}')
+
+    def test_finalize_records_each_product_once(self):
+        self.buy(self.products[:2])
+        self.buy(self.products[:1])
+        self.assertEqual(
+            sorted(PurchasedProduct.objects.filter(user=self.user).values_list('product_id', flat=True)),
+            [self.products[0].pk, self.products[1].pk])
+
+    def test_review_form_offers_bought_products_not_yet_reviewed(self):
+        self.buy(self.products[:2])
+        Review.objects.create(user=self.user, product=self.products[0], rating=4, comment='fine')
+        form = ReviewForm(user=self.user)
+        self.assertEqual(list(form.fields['product'].queryset), [self.products[1]])
+
+    def test_posted_review_is_a_verified_purchase(self):
+        self.buy(self.products[:1])
+        self.client.force_login(self.user)
+        self.client.post(reverse('my_orders'), {'product': self.products[0].pk, 'rating': 5, 'comment': 'lovely colours'})
+        review = Review.objects.get(user=self.user)
+        self.assertTrue(review.verified_purchase)
+        response = self.client.post(reverse('my_orders'), {'product': self.products[0].pk, 'rating': 1, 'comment': 'second thoughts'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Review.objects.filter(user=self.user).count(), 1)
+
+    def test_rebuild_backfills_from_order_history(self):
+        make_cart(self.user, self.products[:2], ordered=True)
+        Review.objects.create(user=self.user, product=self.products[0], rating=4, comment='fine')
+        out = StringIO()
+        call_command('rebuild_purchases', stdout=out)
+        self.assertEqual(PurchasedProduct.objects.filter(user=self.user).count(), 2)
+        self.assertTrue(Review.objects.get(user=self.user).verified_purchase)
+        self.assertIn('2 purchases indexed, 1 reviews', out.getvalue())
+
+
+class RecommendationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.lilies, self.haystacks, self.poppies, self.unsold = [
+            make_product(name) for name in ('water lilies', 'haystacks', 'poppies', 'unsold')]
+        for basket in ([self.lilies, self.haystacks], [self.lilies, self.haystacks, self.lilies],
+                       [self.lilies, self.poppies], [self.haystacks]):
+            make_cart(self.user, basket, ordered=True)
+        #an open cart is not a purchase
+        make_cart(self.user, [self.lilies, self.unsold])
+
+    def recommended(self, product):
+        return list(ProductRecommendation.objects.filter(product=product).order_by('rank')
+                    .values_list('recommended__name', flat=True))
+
+    def test_neighbours_are_ranked_by_orders_in_common(self):
+        written, baskets = build_recommendations(min_support=1)
+        self.assertEqual(baskets, 4)
+        self.assertEqual(written, 4)
+        self.assertEqual(self.recommended(self.lilies), ['haystacks', 'poppies'])
+        self.assertEqual(self.recommended(self.poppies), ['water lilies'])
+        self.assertEqual(self.recommended(self.unsold), [])
+
+    def test_chunks_never_split_an_order(self):
+        build_recommendations(metric='lift', min_support=1, chunk_size=1)
+        small = list(ProductRecommendation.objects.order_by('product', 'rank').values_list('recommended', 'score'))
+        build_recommendations(metric='lift', min_support=1)
+        self.assertEqual(small, list(ProductRecommendation.objects.order_by('product', 'rank')
+                                     .values_list('recommended', 'score')))
+
+    def test_min_support_and_top_k(self):
+        build_recommendations(min_support=2)
+        self.assertEqual(self.recommended(self.lilies), ['haystacks'])
+        build_recommendations(min_support=1, top_k=1)
+        self.assertEqual(ProductRecommendation.objects.filter(product=self.lilies).count(), 1)
+
+    def test_product_page_reads_the_table_once(self):
+        out = StringIO()
+        call_command('build_recommendations', '--min-support', '1', stdout=out)
+        self.assertIn('4 recommendations written from 4 orders', out.getvalue())
+        self.assertEqual(get_recommendations(self.lilies), [self.haystacks, self.poppies])
+        with self.assertNumQueries(0):
+            get_recommendations(self.lilies)
+        self.assertContains(self.client.get(reverse('product', args=[self.lilies.slug])), self.haystacks.get_absolute_url())
+
+
+class SalesCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.lilies = make_product('water lilies', price=100)
+        self.haystacks = make_product('haystacks', price=50, discount_price=40.5)
+        self.poppies = make_product('poppies', price=20)
+
+    def buy(self, products):
+        make_cart(self.user, products)
+        order = cart.get_active_order(self.user)
+        #the total isn't what is being tested, and get_total can't add a float discount to a Decimal price
+        finalize_order(order, self.user, f'ch_{order.pk}', 0, f'key-{order.pk}')
+        return order
+
+    def test_checkout_adds_to_todays_bucket_and_the_counters(self):
+        self.buy([self.lilies, self.haystacks])
+        ShoppingCartOrderItem.objects.filter(item=self.haystacks).update(quantity=2)
+        self.buy([self.haystacks])
+
+        bucket = ProductSalesDay.objects.get(product=self.haystacks)
+        self.assertEqual(bucket.day, timezone.localdate())
+        self.assertEqual(bucket.units, 2)
+        self.assertEqual(bucket.revenue, Decimal('81.00'))
+        self.haystacks.refresh_from_db()
+        self.assertEqual((self.haystacks.units_sold, self.haystacks.units_sold_7d, self.haystacks.units_sold_30d), (2, 2, 2))
+        self.assertEqual(self.haystacks.revenue, Decimal('81.00'))
+        self.assertEqual(ProductSalesDay.objects.count(), 2)
+
+    def test_windows_roll_from_the_buckets(self):
+        today = timezone.localdate()
+        self.buy([self.lilies])
+        ProductSalesDay.objects.filter(product=self.lilies).update(day=today - timedelta(days=10))
+        self.buy([self.lilies])
+        self.lilies.refresh_from_db()
+        self.assertEqual((self.lilies.units_sold, self.lilies.units_sold_7d), (2, 2))
+
+        roll_sales_windows(today)
+        self.lilies.refresh_from_db()
+        self.assertEqual((self.lilies.units_sold, self.lilies.units_sold_7d, self.lilies.units_sold_30d), (2, 1, 2))
+
+        roll_sales_windows(today + timedelta(days=30))
+        self.lilies.refresh_from_db()
+        self.assertEqual((self.lilies.units_sold, self.lilies.units_sold_7d, self.lilies.units_sold_30d), (2, 0, 0))
+
+    def test_rebuild_matches_the_incremental_counters(self):
+        self.buy([self.lilies, self.haystacks])
+        self.buy([self.haystacks])
+        counters = list(Product.objects.order_by('id').values_list('units_sold', 'revenue', 'units_sold_7d', 'units_sold_30d'))
+        buckets = list(ProductSalesDay.objects.order_by('product').values_list('product', 'day', 'units', 'revenue'))
+
+        Product.objects.update(units_sold=0, revenue=0, units_sold_7d=0, units_sold_30d=0)
+        call_command('rebuild_sales', stdout=StringIO())
+        self.assertEqual(list(Product.objects.order_by('id').values_list('units_sold', 'revenue', 'units_sold_7d', 'units_sold_30d')), counters)
+        self.assertEqual(list(ProductSalesDay.objects.order_by('product').values_list('product', 'day', 'units', 'revenue')), buckets)
+
+    def test_listings_sort_by_sales(self):
+        self.buy([self.poppies, self.haystacks])
+        self.buy([self.poppies])
+        response = self.client.get(reverse('all_products', kwargs={'school': 'all'}), {'sort': 'best_sellers'})
+        self.assertEqual(list(response.context['all_products']), [self.poppies, self.haystacks, self.lilies])
+        response = self.client.get(reverse('starting_page'), {'sort': 'trending'})
+        self.assertEqual(list(response.context['products']), [self.poppies, self.haystacks, self.lilies])
+
+    def test_sale_changes_the_listing_etag(self):
+        url = reverse('all_products', kwargs={'school': 'all'})
+        etag = self.client.get(url, {'sort': 'best_sellers'})['ETag']
+        self.buy([self.poppies])
+        cache.clear()
+        self.assertEqual(self.client.get(url, {'sort': 'best_sellers'}, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+
+class CouponTests(TestCase):
+    def setUp(self):
+        coupon_cache.clear()
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.order = make_cart(self.user, [make_product('painting')])
+
+    def test_lookups_are_cached_until_a_save(self):
+        coupon = Coupon.objects.create(code='SPRING', amount=5)
+        self.assertEqual(get_coupon('SPRING'), coupon)
+        self.assertIsNone(get_coupon('SPRNIG'))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_coupon('SPRING'), coupon)
+            self.assertIsNone(get_coupon('SPRNIG'))
+        Coupon.objects.create(code='SPRNIG', amount=1)
+        self.assertIsNotNone(get_coupon('SPRNIG'))
+
+    def test_cache_evicts_least_recently_used_and_expired(self):
+        coupons = [Coupon.objects.create(code=f'C{i}', amount=1) for i in range(3)]
+        lru = CouponCache(2, 60)
+        lru.set('C0', coupons[0])
+        lru.set('C1', coupons[1])
+        lru.get('C0')
+        lru.set('C2', coupons[2])
+        self.assertEqual(lru.get('C1'), (False, None))
+        self.assertEqual(lru.get('C0'), (True, coupons[0]))
+        with mock.patch('my_site.coupons.time.monotonic', return_value=10 ** 9):
+            self.assertEqual(lru.get('C0'), (False, None))
+
+    def test_limit_expiry_and_swaps(self):
+        spring = Coupon.objects.create(code='SPRING', amount=5, max_uses=1)
+        summer = Coupon.objects.create(code='SUMMER', amount=3)
+        Coupon.objects.create(code='OLD', amount=3, expires_at=timezone.now() - timedelta(days=1))
+
+        apply_coupon(self.order, 'SPRING')
+        with self.assertRaisesMessage(CouponError, 'already on your order'):
+            apply_coupon(self.order, 'SPRING')
+        with self.assertRaisesMessage(CouponError, 'not valid'):
+            apply_coupon(self.order, 'OLD')
+        apply_coupon(self.order, 'SUMMER')
+        self.assertEqual(ShoppingCartOrder.objects.get(pk=self.order.pk).coupon, summer)
+
+        #putting a coupon on a cart doesn't use it up
+        spring.refresh_from_db()
+        summer.refresh_from_db()
+        self.assertEqual((spring.used, summer.used), (0, 0))
+
+    def test_abandoned_carts_hold_no_uses(self):
+        spring = Coupon.objects.create(code='SPRING', amount=5, max_uses=1)
+        apply_coupon(self.order, 'SPRING')
+        buyer = User.objects.create_user('other')
+        order = make_cart(buyer, [make_product('sculpture')])
+        apply_coupon(order, 'SPRING')
+        finalize_order(order, buyer, 'ch_1', 0, 'key-1')
+        spring.refresh_from_db()
+        self.assertEqual(spring.used, 1)
+
+        #the abandoned cart comes back after the last use went, its checkout is rolled back
+        self.order.refresh_from_db()
+        with self.assertRaisesMessage(CouponError, 'used up'):
+            finalize_order(self.order, self.user, 'ch_2', 0, 'key-2')
+        self.assertFalse(ShoppingCartOrder.objects.get(pk=self.order.pk).ordered)
+        self.assertFalse(Payment.objects.filter(idempotency_key='key-2').exists())
+        spring.refresh_from_db()
+        self.assertEqual(spring.used, 1)
+        with self.assertRaisesMessage(CouponError, 'used up'):
+            apply_coupon(make_cart(User.objects.create_user('third'), []), 'SPRING')
+
+    def test_add_coupon_view(self):
+        Coupon.objects.create(code='SPRING', amount=5, max_uses=1, used=1)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('add_coupon'), {'code': 'SPRING'}, follow=True)
+        self.assertContains(response, 'This coupon has been used up')
+        self.assertIsNone(ShoppingCartOrder.objects.get(pk=self.order.pk).coupon)
+
+
+class RefundProcessingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='secret-pass')
+        self.gateway = FakeGateway()
+
+    def request_refund(self, accepted=True, **kwargs):
+        number = Refund.objects.count()
+        order = ShoppingCartOrder.objects.create(
+            user=self.user, ordered=True, ordered_date=timezone.now(), refund_requested=True,
+            payment=Payment.objects.create(stripe_charge_id=f'ch_{number}', user=self.user, amount=10))
+        return Refund.objects.create(order=order, reason='arrived damaged', email='buyer@example.com',
+                                     accepted=accepted, **kwargs)
+
+    def test_accepted_refunds_are_paid_out_in_batches(self):
+        refunds = [self.request_refund() for i in range(5)]
+        waiting = self.request_refund(accepted=False)
+        counts = process_refunds(batch_size=2, workers=3, gateway=self.gateway)
+
+        self.assertEqual(counts, {'S': 5, 'P': 0, 'F': 0})
+        self.assertEqual(sorted(self.gateway.refunds), sorted(refund.idempotency_key for refund in refunds))
+        for refund in refunds:
+            refund.refresh_from_db()
+            self.assertEqual((refund.status, refund.attempts), ('S', 1))
+            self.assertTrue(refund.gateway_refund_id.startswith('fake_re_'))
+            self.assertTrue(refund.order.refund_granted)
+            self.assertFalse(refund.order.refund_requested)
+        waiting.refresh_from_db()
+        self.assertEqual(waiting.status, 'P')
+        self.assertEqual(process_refunds(gateway=self.gateway), {'S': 0, 'P': 0, 'F': 0})
+
+    def test_resumes_after_a_crash_without_paying_twice(self):
+        refund = self.request_refund()
+        #the worker died after the gateway paid out and before the result was written
+        paid = self.gateway.refund('ch_0', idempotency_key=refund.idempotency_key)
+        Refund.objects.filter(pk=refund.pk).update(status='R', attempts=1, claimed_at=timezone.now())
+        self.assertEqual(process_refunds(gateway=self.gateway)['S'], 0)
+
+        Refund.objects.filter(pk=refund.pk).update(claimed_at=timezone.now() - STALE_CLAIM - timedelta(seconds=1))
+        self.assertEqual(process_refunds(gateway=self.gateway)['S'], 1)
+        refund.refresh_from_db()
+        self.assertEqual(refund.gateway_refund_id, paid)
+        self.assertEqual(len(self.gateway.refunds), 1)
+
+    def test_failures_are_retried_then_given_up(self):
+        refund = self.request_refund()
+        gateway = FakeGateway(failure_rate=1)
+        for expected in ('P', 'P', 'F'):
+            process_refunds(gateway=gateway)
+            refund.refresh_from_db()
+            self.assertEqual(refund.status, expected)
+        self.assertEqual((refund.attempts, refund.error), (3, 'Network Error'))
+        self.assertFalse(refund.order.refund_granted)
+
+    @override_settings(PAYMENT_GATEWAY={'BACKEND': 'my_site.payments.FakeGateway', 'OPTIONS': {'failure_rate': 0}})
+    def test_order_admin_action_pays_out_the_refunds(self):
+        refund = self.request_refund(accepted=False)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'secret-pass'))
+        response = self.client.post(reverse('admin:my_site_shoppingcartorder_changelist'), {
+            'action': 'make_refund_accepted', '_selected_action': [refund.order_id]}, follow=True)
+        self.assertContains(response, '1 refunded, 0 will be retried, 0 failed')
+        refund.refresh_from_db()
+        self.assertEqual(refund.status, 'S')
+        self.assertTrue(refund.order.refund_granted)
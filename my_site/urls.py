@@ -14,7 +14,10 @@ urlpatterns = [
     path('remove-item-from-cart/<slug>/', views.remove_single_item_from_cart, name='remove_single_item_from_cart'),
     path('checkout/', views.CheckOutView.as_view(), name='checkout'),
     path('payment/<payment_option>/', views.PaymentView.as_view(), name='payment'),
+    path('payment/<payment_option>/async/', views.async_payment, name='payment_async'),
     path('request-refund/', views.RequestRefundView.as_view(), name='request_refund'),
     path('my-orders/', views.MyOrdersView.as_view(), name='my_orders'),
-    path('search/', views.product_search, name='product_search')
+    path('search/', views.product_search, name='product_search'),
+    path('cache-stats/', views.cache_stats, name='cache_stats'),
+    path('metrics', views.metrics, name='metrics')
 ]
\ No newline at end of file
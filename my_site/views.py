@@ -1,49 +1,83 @@
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.messages.views import SuccessMessageMixin
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Count, Max, Prefetch, Sum
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views.generic import ListView, DetailView, View
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.contrib.postgres.search import SearchVector, SearchQuery, SearchRank
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse
 from django.urls import reverse
-from django.utils import timezone
 
 from .forms import SignUpForm, CheckoutForm, CouponForm, RefundForm, ReviewForm, ProductSearchForm
 
-from .models import Product, ShoppingCartOrder, ShoppingCartOrderItem, Address, Payment, Coupon, Refund, Review
+from .models import Product, ShoppingCartOrder, ShoppingCartOrderItem, Address, Refund, Review
+from . import cart
+from .metrics import payment_timer, registry
+from .checkout import create_idempotency_key, find_finalized_payment, finalize_order
+from .coupons import CouponError, apply_coupon, drop_coupon, used_up
+from .catalog import CatalogCacheMixin, ConditionalCatalogMixin, catalog_cache_stats, catalog_validators, get_product_count, get_recommendations
+from .pagination import keyset_paginate
+from .payments import PaymentError, get_payment_gateway, refund_unrecorded_charge
+from .search import get_search_backend
 
-import random
-import string
-import stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
 
 
-def create_ref_code():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-
-
-class StartingPageView(ListView):
+class StartingPageView(ConditionalCatalogMixin, CatalogCacheMixin, ListView):
     template_name = 'my_site/index.html'
     model = Product
     ordering = ['id']
     context_object_name = 'products'
+    #the sales orderings read the counters kept at checkout through their own indexes
+    sort_options = {
+        'default': ['id'],
+        'best_sellers': ['-units_sold', 'id'],
+        'trending': ['-units_sold_7d', 'id']
+    }
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort')
+        return sort if sort in self.sort_options else 'default'
+
+    def get_ordering(self):
+        return self.sort_options[self.get_sort()]
+
+    def get_validators(self):
+        #the counters go into the etag, a sale reorders the preview without touching updated_at
+        rows = Product.objects.order_by(*self.get_ordering()).values_list(
+            'updated_at', 'artist__updated_at', 'units_sold', 'units_sold_7d')[:5]
+        return catalog_validators([timestamp for row in rows for timestamp in row[:2]], [row[2:] for row in rows])
 
     def get_queryset(self):
         base_query = super().get_queryset()
         data = base_query[:5]
         return data
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['sort'] = self.get_sort()
+        return context
 
-class AllProductView(ListView):
+
+class AllProductView(ConditionalCatalogMixin, CatalogCacheMixin, ListView):
     template_name = 'my_site/all_products.html'
     model = Product
     ordering=['id']
     paginate_by = 9
     context_object_name = 'all_products'
+    #keyset orderings offered on the listing, each ends in id so the cursor is unique
+    sort_options = {
+        'default': ['id'],
+        'price': ['price', 'id'],
+        '-price': ['-price', 'id'],
+        'reviews': ['-rating_count', 'id'],
+        'best_sellers': ['-units_sold', 'id'],
+        'trending': ['-units_sold_7d', 'id']
+    }
 
     def get_queryset(self, *args, **kwargs):
         qs = super().get_queryset(*args, **kwargs)
@@ -52,24 +86,65 @@ class AllProductView(ListView):
             qs = qs.filter(school=self.kwargs['school'])
         return qs
 
+    def paginate_queryset(self, queryset, page_size):
+        #cursor paging instead of OFFSET so deep pages cost the same as the first one, and no COUNT(*) per page
+        sort = self.request.GET.get('sort')
+        if sort not in self.sort_options:
+            sort = 'default'
+        self.sort = sort
+        page = keyset_paginate(
+            queryset,
+            self.sort_options[sort],
+            page_size,
+            after=self.request.GET.get('after'),
+            before=self.request.GET.get('before')
+        )
+        return (None, page, page.object_list, page.has_next or page.has_previous)
+
+    def get_validators(self):
+        #the whole school rather than just this page, still one query and it covers the product count too
+        totals = self.get_queryset().aggregate(updated_at=Max('updated_at'), count=Count('id'),
+                                               units_sold=Sum('units_sold'), units_sold_7d=Sum('units_sold_7d'))
+        #sales reorder the listing without touching updated_at
+        return catalog_validators([totals['updated_at']], totals['count'], totals['units_sold'], totals['units_sold_7d'])
 
-class ProductDetailView(DetailView):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['sort'] = self.sort
+        context['school'] = self.kwargs['school']
+        context['product_count'] = get_product_count(self.kwargs['school'])
+        return context
+
+
+class ProductDetailView(ConditionalCatalogMixin, CatalogCacheMixin, DetailView):
     model = Product
     template_name = 'my_site/product_detail.html'
     context_object_name = 'product'
 
+    def get_validators(self):
+        totals = Product.objects.filter(slug=self.kwargs['slug']).aggregate(
+            product=Max('updated_at'),
+            artist=Max('artist__updated_at'),
+            reviews=Max('review__updated_at'),
+            review_count=Count('review', distinct=True),
+            recommendations=Max('recommendations__computed_at')
+        )
+        return catalog_validators([totals['product'], totals['artist'], totals['reviews'], totals['recommendations']],
+                                  totals['review_count'])
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         product = context['object']
         reviews = Review.objects.filter(product=product)
         context['reviews'] = reviews
+        context['recommendations'] = get_recommendations(product)
         return context
      
     
 class OrderSummaryView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         try:
-            order = ShoppingCartOrder.objects.get(user=self.request.user, ordered=False)
+            order = cart.get_cart_backend().get_active_order(self.request.user)
             context = {
                 'object': order
             }
@@ -79,6 +154,10 @@ class OrderSummaryView(LoginRequiredMixin, View):
             return redirect('all_products', school='all')
 
 
+def payment_url_name():
+    return 'payment_async' if settings.ASYNC_PAYMENT_VIEW else 'payment'
+
+
 def is_valid_form(values):
     valid = True
     for field in values:
@@ -90,7 +169,7 @@ def is_valid_form(values):
 class CheckOutView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         try:
-            order = ShoppingCartOrder.objects.get(user=request.user, ordered=False)
+            order = cart.get_cart_backend().get_active_order(request.user)
             form = CheckoutForm()
             context = {
                 'form': form,
@@ -132,7 +211,6 @@ class CheckOutView(LoginRequiredMixin, View):
 
                 use_default_shipping = form.cleaned_data.get('use_default_shipping')
                 if use_default_shipping:
-                    print('using default data')
                     address_qs = Address.objects.filter(
                     user=request.user, 
                     address_type='S', 
@@ -145,7 +223,6 @@ class CheckOutView(LoginRequiredMixin, View):
                         messages.info(request, 'No default shipping address available')
                         return redirect(request,'checkout')
                 else:
-                    print('user is entering a new shipping address')
 
                     shipping_address = form.cleaned_data.get('shipping_address')
                     shipping_address2 = form.cleaned_data.get('shipping_address2')
@@ -186,7 +263,6 @@ class CheckOutView(LoginRequiredMixin, View):
                     order.save()
 
                 elif use_default_billing:
-                    print('using default data')
                     address_qs = Address.objects.filter(
                     user=request.user, 
                     address_type='B', 
@@ -199,7 +275,6 @@ class CheckOutView(LoginRequiredMixin, View):
                         messages.info(request, 'No default billing address available')
                         return redirect(request,'checkout')
                 else:
-                    print('user is entering a new billing address')
 
                     billing_address = form.cleaned_data.get('billing_address')
                     billing_address2 = form.cleaned_data.get('billing_address2')
@@ -231,9 +306,9 @@ class CheckOutView(LoginRequiredMixin, View):
                 payment_option = form.cleaned_data.get('payment_option')
                 
                 if payment_option == 'S':
-                    return redirect('payment', payment_option='stripe')
+                    return redirect(payment_url_name(), payment_option='stripe')
                 elif payment_option == 'P':
-                    return redirect('payment', payment_option='paypal')
+                    return redirect(payment_url_name(), payment_option='paypal')
                 else:
                     messages.warning(request, 'Invalid payment option selected')
                     return redirect('checkout')
@@ -244,119 +319,140 @@ class CheckOutView(LoginRequiredMixin, View):
         
 class PaymentView(View):
     def get(self, request, *args, **kwargs):
-        order = ShoppingCartOrder.objects.get(user=self.request.user, ordered=False)
+        order = cart.get_cart_backend().get_active_order(self.request.user)
         if order.billing_address:
             context = {
                 'STRIPE_PUBLIC_KEY': settings.STRIPE_PUBLIC_KEY,
                 'order': order,
-                'DISPLAY_COUPON_FORM': False
+                'DISPLAY_COUPON_FORM': False,
+                'idempotency_key': create_idempotency_key()
             }
             return render(request,'my_site/payment.html', context)
         else:
             messages.warning(request,'You have not added a billing address')
             return redirect('checkout')
 
+    def prepare_payment(self, request):
+        #returns a response when there is nothing left to charge, otherwise what the gateway needs
+        idempotency_key = request.POST.get('idempotency_key') or create_idempotency_key()
+        if find_finalized_payment(idempotency_key):
+            #the form was submitted twice, the first submit already paid for the order
+            messages.success(request, 'Your order was successful!')
+            return redirect('/'), None
+
+        order = cart.get_cart_backend().get_active_order(request.user)
+        if order.coupon and used_up(order.coupon):
+            drop_coupon(order)
+            messages.warning(request, 'This coupon has been used up')
+            return redirect('checkout'), None
+        total = order.get_total()
+        return None, {
+            'order': order,
+            'total': total,
+            'amount': int(total * 100), #cents
+            'source': request.POST.get('stripeToken'),
+            'idempotency_key': idempotency_key
+        }
+
+    def payment_succeeded(self, request, payment, charge_id):
+        try:
+            recorded, created = finalize_order(
+                payment['order'], request.user, charge_id, payment['total'], payment['idempotency_key'])
+        except CouponError as e:
+            #the last use went to somebody else while the card was charged, the charge goes back and the cart loses the coupon
+            drop_coupon(payment['order'])
+            if refund_unrecorded_charge(charge_id, payment['idempotency_key']):
+                messages.warning(request, f'{e.message}, your payment has been refunded')
+            else:
+                messages.warning(request, f'{e.message}, your payment will be refunded')
+            return redirect('checkout')
+        if not created and (recorded is None or recorded.stripe_charge_id != charge_id):
+            #another payment form paid for the order first, this charge went through as well and goes back
+            refund_unrecorded_charge(charge_id, payment['idempotency_key'])
+        messages.success(request, 'Your order was successful!')
+        return redirect('/')
+
+    def payment_failed(self, request, error):
+        if isinstance(error, PaymentError):
+            messages.warning(request, error.message)
+        else:
+            # Something else happened, completely unrelated to the gateway #send email to ourselves, means somethign went wrong w/ code
+            messages.warning(request, 'Serious error has occured, we have been notifed of this issue')
+        return redirect('/')
 
     def post(self, request, *args, **kwargs):
-        order = ShoppingCartOrder.objects.get(user=self.request.user, ordered=False)
-        token = request.POST.get('stripeToken')
-        amount = int(order.get_total() * 100) #cents
+        response, payment = self.prepare_payment(request)
+        if response:
+            return response
 
         try:
-            charge = stripe.Charge.create(
-                amount=amount,
-                currency="usd",
-                source=token,
-            )
-
-            #create the payment
-            payment = Payment()
-            payment.stripe_charge_id = charge['id']
-            payment.user = self.request.user
-            payment.amount = order.get_total()
-            payment.save()
-
-            #assign the payment to order
-            order_items = order.items.all()
-            #this would be a query set, .update() will update the entire qs for us
-            order_items.update(ordered=True)
-            for item in order_items:
-                item.save()
-
-            order.ordered = True
-            order.payment = payment
-            order.ref_code = create_ref_code()
-            order.save()
-
-            messages.success(self.request, 'Your order was successful!')
-            return redirect('/')
-
-        except stripe.error.CardError as e:
-            # Since it's a decline, stripe.error.CardError will be caught
-            body = e.json_body
-            err = body.get('error', {})
-            messages.warning(self.request, f"{err.get('message')}")
-        except stripe.error.RateLimitError as e:
-            # Too many requests made to the API too quickly
-            messages.warning(self.request, "Rate limit error")
-            return redirect('/')
-            
-        except stripe.error.InvalidRequestError as e:
-            # Invalid parameters were supplied to Stripe's API
-            messages.warning(self.request, 'Invalid Parameters')
-            return redirect('/')
-            
-        except stripe.error.AuthenticationError as e:
-            # Authentication with Stripe's API failed
-            # (maybe you changed API keys recently)
-            messages.warning(self.request, 'Not Authenticated')
-            return redirect('/')
-            
-        except stripe.error.APIConnectionError as e:
-            # Network communication with Stripe failed
-            messages.warning(self.request, 'Network Error')
-            return redirect('/')
-
-        except stripe.error.StripeError as e:
-            # Display a very generic error to the user, and maybe send yourself an email
-             messages.warning(self.request, 'Something went wrong, you were not charge. Please try again')
-             return redirect('/')
-            
+            with payment_timer():
+                charge_id = get_payment_gateway().charge(
+                    payment['amount'], 'usd', payment['source'], payment['idempotency_key'])
+            return self.payment_succeeded(request, payment, charge_id)
         except Exception as e:
-            # Something else happened, completely unrelated to Stripe #send email to ourselves, means somethign went wrong w/ code
-            messages.warning(self.request, 'Serious error has occured, we have been notifed of this issue')
-            return redirect('/')
+            return self.payment_failed(request, e)
+
+
+async def async_payment(request, payment_option):
+    #same checkout as PaymentView for ASGI deployments, the gateway call is awaited so it doesn't hold a worker thread
+    view = PaymentView()
+    view.setup(request, payment_option=payment_option)
+    if request.method != 'POST':
+        return await sync_to_async(view.get)(request, payment_option=payment_option)
+
+    response, payment = await sync_to_async(view.prepare_payment)(request)
+    if response:
+        return response
+
+    try:
+        with payment_timer():
+            charge_id = await get_payment_gateway().acharge(
+                payment['amount'], 'usd', payment['source'], payment['idempotency_key'])
+        return await sync_to_async(view.payment_succeeded)(request, payment, charge_id)
+    except Exception as e:
+        return await sync_to_async(view.payment_failed)(request, e)
 
 
 class MyOrdersView(LoginRequiredMixin, View):
+    paginate_by = 9
+
+    def get_page(self):
+        orders = ShoppingCartOrder.objects.filter(user=self.request.user, ordered=True).prefetch_related(
+            Prefetch('items', queryset=ShoppingCartOrderItem.objects.select_related('item').order_by('id'))
+        )
+        return keyset_paginate(
+            orders,
+            ['-ordered_date', '-id'],
+            self.paginate_by,
+            after=self.request.GET.get('after'),
+            before=self.request.GET.get('before')
+        )
+
+    def render_orders(self, form):
+        page = self.get_page()
+        context = {
+            'object': page.object_list,
+            'page': page,
+            'form': form
+        }
+        return render(self.request, 'my_site/my_orders.html', context)
+
     def get(self, request, *args, **kwargs):
-        try:
-            order = ShoppingCartOrder.objects.filter(user=self.request.user, ordered=True)
-            form = ReviewForm(user=self.request.user)
-            context = {
-                'object': order,
-                'form': form
-            }
-            return render(request, 'my_site/my_orders.html', context)
-        except ObjectDoesNotExist:
-            messages.warning(request, 'You do not have any orders')
-            return redirect('all_products', school='all')
+        form = ReviewForm(user=self.request.user)
+        return self.render_orders(form)
 
     def post (self, request, *args, **kwargs):
         form = ReviewForm(request.POST, user=self.request.user)
         if form.is_valid():
             form = form.save(commit=False)
             form.user = request.user
+            #the form only offers products from the purchase index
+            form.verified_purchase = True
             form.save()
             return redirect('starting_page')
         else:
-            order = ShoppingCartOrder.objects.filter(user=self.request.user, ordered=True)
-            form = ReviewForm(request.POST, user=self.request.user)
-            context = {
-                'object': order,
-                'form': form
-            }
-            return render(request, 'my_site/my_orders.html', context)
+            return self.render_orders(form)
 
 
 
@@ -400,52 +496,22 @@ class RequestRefundView(View):
 @login_required
 def add_to_cart(request, slug):
     item = get_object_or_404(Product, slug=slug)
-    order_item, created = ShoppingCartOrderItem.objects.get_or_create(
-        item=item,
-        user=request.user,
-        ordered=False)
-    order = ShoppingCartOrder.objects.filter(user=request.user, ordered=False)
-    if order.exists():
-        order = order[0]
-        #check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request,'This item quantity was updated')
-            return redirect('product', slug=slug)
-        else:
-            order.items.add(order_item)
-            messages.info(request,'This item was added to your cart')
-            return redirect('product', slug=slug)
+    if cart.get_cart_backend().add_item(request.user, item) == cart.ADDED:
+        messages.info(request,'This item was added to your cart')
     else:
-        ordered_date = timezone.now()
-        order = ShoppingCartOrder.objects.create(user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
-        messages.info(request,'This item was added to your cart') 
-        return redirect('product', slug=slug)
+        messages.info(request,'This item quantity was updated')
+    return redirect('product', slug=slug)
 
 
 
 @login_required
 def remove_from_cart(request, slug):
     item = get_object_or_404(Product, slug=slug)
-    order = ShoppingCartOrder.objects.filter(user=request.user, ordered=False)
-    if order.exists():
-        order = order[0]
-        #check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = ShoppingCartOrderItem.objects.filter(
-            item=item,
-            user=request.user,
-            ordered=False)[0]
-            order.items.remove(order_item)
-            messages.info(request,'This item was removed from your cart')
-            return redirect('order_summary')
-        else:
-            messages.info(request,'This item is not in your cart')
-            return redirect('product', slug=slug)
+    if cart.get_cart_backend().remove_item(request.user, item) == cart.REMOVED:
+        messages.info(request,'This item was removed from your cart')
+        return redirect('order_summary')
     else:
-        messages.info(request,'You do not have an active order')
+        messages.info(request,'This item is not in your cart')
         return redirect('product', slug=slug)
 
 
@@ -453,71 +519,24 @@ def remove_from_cart(request, slug):
 @login_required
 def remove_single_item_from_cart(request, slug):
     item = get_object_or_404(Product, slug=slug)
-    order = ShoppingCartOrder.objects.filter(user=request.user, ordered=False)
-    if order.exists():
-        order = order[0]
-        #check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = ShoppingCartOrderItem.objects.filter(
-            item=item,
-            user=request.user,
-            ordered=False)[0]
-            if order_item.quantity >1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order.items.remove(order_item)
-            messages.info(request,'This item quantity was updated')
-            return redirect('order_summary')
-        else:
-            #add nessage saying orderitem doesn't contain the item
-            messages.info(request,'This item is not in your cart')
-            return redirect('product', slug=slug)
-    else:
-        #add a message saying user doesn't have order
-        messages.info(request,'You do not have an active order')
+    if cart.get_cart_backend().remove_single_item(request.user, item) == cart.NOT_IN_CART:
+        messages.info(request,'This item is not in your cart')
         return redirect('product', slug=slug)
+    else:
+        messages.info(request,'This item quantity was updated')
+        return redirect('order_summary')
 
 @login_required
 def add_single_item_to_cart(request, slug):
     item = get_object_or_404(Product, slug=slug)
-    order_item, created = ShoppingCartOrderItem.objects.get_or_create(
-        item=item,
-        user=request.user,
-        ordered=False)
-    order = ShoppingCartOrder.objects.filter(user=request.user, ordered=False)
-    if order.exists():
-        order = order[0]
-        #check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request,'This item quantity was updated')
-            return redirect('order_summary')
-        else:
-            order.items.add(order_item)
-            messages.info(request,'This item was added to your cart')
-            return redirect('order_summary')
+    if cart.get_cart_backend().add_item(request.user, item) == cart.ADDED:
+        messages.info(request,'This item was added to your cart')
     else:
-        ordered_date = timezone.now()
-        order = ShoppingCartOrder.objects.create(user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
-        messages.info(request,'This item was added to your cart') 
-        return redirect('order_summary')
-
-
-def get_coupon(request, code):
-    
-    try:
-        coupon = Coupon.objects.get(code=code)
-        return coupon
-    except ObjectDoesNotExist:
-        messages.info(request,'This coupon does not exist')
-        return redirect('checkout')
+        messages.info(request,'This item quantity was updated')
+    return redirect('order_summary')
 
 
-##############KEEP IN MIND, NO VALIDATION FOR THIS COUPON##########################################
-#EXAMPLE: not keeping track of how many times it has been used, if its still active, things like that
+#validity, expiry and the usage limit are checked by my_site.coupons, lookups come from a per-process cache
 class AddCouponView(View):
     def post(self, request, *args, **kwargs):
             form = CouponForm(request.POST or None)
@@ -525,14 +544,14 @@ class AddCouponView(View):
                 try:
                     code = form.cleaned_data.get('code')
                     order = ShoppingCartOrder.objects.get(user=request.user, ordered=False)
-                    order.coupon = get_coupon(request, code)
-                    order.save()
+                    apply_coupon(order, code)
                     messages.success(request,'Sucessfully added coupon!')
-                    return redirect('checkout')
 
                 except ObjectDoesNotExist:
                     messages.info(request,'You do not have an active order')
-                    return redirect('checkout')
+                except CouponError as e:
+                    messages.info(request, e.message)
+            return redirect('checkout')
 
 
 def product_search(request):
@@ -544,22 +563,27 @@ def product_search(request):
         form = ProductSearchForm(request.GET)
         if form.is_valid():
             q = form.cleaned_data['q']
-            ##############postgres single search term
-            # results = Product.objects.filter(name__search=q)
-            ###############searching multiple fields
-            # results = Product.objects.annotate(search=SearchVector('name', 'artist')).filter(search=q)
-            ################improvement of above, words are passed through stemming algo, searching logical terms etc
-            # results = Product.objects.annotate(search=SearchVector('name', 'artist')).filter(search=SearchQuery(q))
-            ################rankings
-            vector = SearchVector('name', weight='A') + \
-                SearchVector('artist', weight='B')
-            query = SearchQuery(q)
-            results = Product.objects.annotate(rank=SearchRank(vector, query, cover_density=True)).order_by('-rank')
-
-            results = Product.objects.annotate(search=SearchVector('name', 'artist')).filter(search=SearchQuery(q))
+            #ranked and paged by the search backend, postgres uses the stored GIN indexed Product.search_vector
+            results = get_search_backend().search(q, request.GET.get('page'), per_page=9)
 
     return render(request, 'my_site/search.html',{
         # 'form': form,
         'q': q,
         'results': results
-        })
\ No newline at end of file
+        })
+
+
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse({
+        'catalog': catalog_cache_stats.as_dict()
+    })
+
+
+def metrics(request):
+    #prometheus scrapes with the METRICS_TOKEN bearer token
+    token = settings.METRICS_TOKEN
+    authorized = token and request.META.get('HTTP_AUTHORIZATION') == f'Bearer {token}'
+    if not (authorized or request.user.is_staff):
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
\ No newline at end of file